@@ -0,0 +1,173 @@
+import os
+import io
+import re
+import json
+import hashlib
+import tempfile
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+from PIL import Image
+
+logger = logging.getLogger("ImageDiskCache")
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "reasoning_with_text_and_image", "images")
+
+class ImageDiskCache:
+    """
+    On-disk, content-addressed cache of generated images keyed by
+    (model_name, size, negative_prompt, prompt).
+    Entries keep the provider's encoding (PNG, JPEG, WebP) whatever the file extension.
+    Files are written atomically (temp file + rename), so several worker processes
+    can share one directory. The total size is bounded by evicting least recently used files.
+    """
+    def __init__(self, directory: str, max_bytes: int, normalize_prompts: bool = False) -> None:
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.normalize_prompts = normalize_prompts
+        self._approx_size: Optional[int] = None
+        self._lock = threading.Lock()
+        # Encoding and writing happen off the request path
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="image-cache")
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def normalize_prompt(prompt: str) -> str:
+        """
+        Case, whitespace and trailing punctuation insensitive form of a prompt.
+        """
+        prompt = re.sub(r"\s+", " ", prompt.strip().lower())
+        return prompt.strip(" .,;:!")
+
+    def key(self, model_name: str, size: str, negative_prompt: str, prompt: str) -> str:
+        if self.normalize_prompts:
+            prompt = self.normalize_prompt(prompt)
+        raw = json.dumps([model_name, size, negative_prompt, prompt], ensure_ascii=False)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key + ".png")
+
+    def get(self, key: str) -> Optional[Image.Image]:
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            # Touch for LRU ordering
+            os.utime(path, None)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        except OSError as e:
+            logger.warning(f"Image cache read failed: {e}")
+            self.misses += 1
+            return None
+        try:
+            image = Image.open(io.BytesIO(data)).convert("RGB")
+        except Exception as e:
+            logger.warning(f"Corrupt image cache entry {key}: {e}")
+            self._unlink(path)
+            self.misses += 1
+            return None
+        self.hits += 1
+        return image
+
+    def put(self, key: str, data: bytes) -> None:
+        """
+        Atomically store encoded image bytes.
+        """
+        path = self._path(key)
+        directory = os.path.dirname(path)
+        try:
+            os.makedirs(directory, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+            except BaseException:
+                self._unlink(tmp_path)
+                raise
+        except OSError as e:
+            logger.warning(f"Image cache write failed: {e}")
+            return
+        self._account(len(data))
+
+    def put_async(self, key: str, data: bytes) -> None:
+        """
+        Store encoded image bytes in the background.
+        """
+        self._writer.submit(self.put, key, data)
+
+    def put_image(self, key: str, image: Image.Image) -> None:
+        """
+        Encode and store an image in the background.
+        """
+        def _write() -> None:
+            buffered = io.BytesIO()
+            image.save(buffered, format="PNG")
+            self.put(key, buffered.getvalue())
+
+        self._writer.submit(_write)
+
+    def _account(self, added: int) -> None:
+        with self._lock:
+            if self._approx_size is None:
+                self._approx_size = self._scan_size()
+            else:
+                self._approx_size += added
+            if self._approx_size <= self.max_bytes:
+                return
+            self._approx_size = self._evict()
+
+    def _entries(self) -> list:
+        entries = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if not name.endswith(".png"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+        return entries
+
+    def _scan_size(self) -> int:
+        return sum(size for _, size, _ in self._entries())
+
+    def _evict(self) -> int:
+        """
+        Delete least recently used files until the cache is at 90% of its budget.
+        Other processes may evict concurrently, missing files are ignored.
+        """
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        target = int(self.max_bytes * 0.9)
+        for _, size, path in entries:
+            if total <= target:
+                break
+            self._unlink(path)
+            total -= size
+        logger.info(f"Image cache evicted down to {total} bytes")
+        return total
+
+    @staticmethod
+    def _unlink(path: str) -> None:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+def _env_flag(name: str) -> bool:
+    return os.getenv(name, "").lower() in ("1", "true", "yes")
+
+# Shared by every ImageApiCall in the process, None when disabled
+image_disk_cache = None if _env_flag("IMAGE_CACHE_DISABLE") else ImageDiskCache(
+    os.getenv("IMAGE_CACHE_DIR", DEFAULT_CACHE_DIR),
+    int(os.getenv("IMAGE_CACHE_MAX_BYTES", str(2 * 1024 * 1024 * 1024))),
+    normalize_prompts=_env_flag("IMAGE_CACHE_NORMALIZE_PROMPTS")
+)
@@ -0,0 +1,134 @@
+import os
+import io
+import asyncio
+import threading
+import logging
+from functools import lru_cache
+from typing import Any, Dict, Optional, Tuple
+from PIL import Image
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger("ImageClients")
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+CONNECT_TIMEOUT = float(os.getenv("IMAGE_HTTP_CONNECT_TIMEOUT", "10"))
+READ_TIMEOUT = float(os.getenv("IMAGE_HTTP_READ_TIMEOUT", "120"))
+POOL_SIZE = int(os.getenv("IMAGE_HTTP_POOL_SIZE", "16"))
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+@lru_cache(maxsize=None)
+def load_huggingface_hub() -> Any:
+    """
+    Import huggingface_hub the first time an HF backend is used, None if not installed.
+    """
+    try:
+        import huggingface_hub
+    except ImportError:
+        logger.error("huggingface_hub library not installed. Install with `pip install huggingface_hub`")
+        return None
+    return huggingface_hub
+
+_lock = threading.Lock()
+_sessions: Dict[str, requests.Session] = {}
+_clients: Dict[Tuple[Any, ...], Any] = {}
+
+def get_http_session(provider: str) -> requests.Session:
+    """
+    Keep-alive requests.Session per provider, shared by every ImageApiCall.
+    """
+    session = _sessions.get(provider)
+    if session is None:
+        with _lock:
+            session = _sessions.get(provider)
+            if session is None:
+                session = requests.Session()
+                retry = Retry(total=2, backoff_factor=0.5, status_forcelist=(502, 503, 504), allowed_methods=("GET",))
+                adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE, max_retries=retry)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                _sessions[provider] = session
+    return session
+
+def get_inference_client(provider: str, token: str) -> Any:
+    """
+    Shared huggingface_hub InferenceClient per (provider, token).
+    """
+    key = ("sync", provider, token)
+    client = _clients.get(key)
+    if client is None:
+        with _lock:
+            client = _clients.get(key)
+            if client is None:
+                client = load_huggingface_hub().InferenceClient(provider=provider, api_key=token, timeout=READ_TIMEOUT)
+                _clients[key] = client
+    return client
+
+def get_async_inference_client(provider: str, token: str) -> Any:
+    """
+    Shared AsyncInferenceClient per (provider, token, event loop); async sessions are loop bound.
+    """
+    key = ("async", provider, token, id(asyncio.get_running_loop()))
+    client = _clients.get(key)
+    if client is None:
+        with _lock:
+            client = _clients.get(key)
+            if client is None:
+                client = load_huggingface_hub().AsyncInferenceClient(provider=provider, api_key=token, timeout=READ_TIMEOUT)
+                _clients[key] = client
+    return client
+
+def get_async_http_client() -> "httpx.AsyncClient":
+    key = ("httpx", id(asyncio.get_running_loop()))
+    client = _clients.get(key)
+    if client is None:
+        with _lock:
+            client = _clients.get(key)
+            if client is None:
+                client = httpx.AsyncClient(
+                    timeout=httpx.Timeout(READ_TIMEOUT, connect=CONNECT_TIMEOUT),
+                    limits=httpx.Limits(max_connections=POOL_SIZE, max_keepalive_connections=POOL_SIZE)
+                )
+                _clients[key] = client
+    return client
+
+def _buffer_for(content_length: Optional[str]) -> io.BytesIO:
+    buffer = io.BytesIO()
+    if content_length and content_length.isdigit():
+        # Reserve the full size up front so the buffer is not regrown while streaming
+        buffer.seek(int(content_length) - 1)
+        buffer.write(b"\0")
+        buffer.seek(0)
+    return buffer
+
+def _decode(buffer: io.BytesIO) -> Tuple[Image.Image, bytes]:
+    buffer.truncate()
+    buffer.seek(0)
+    return Image.open(buffer).convert("RGB"), buffer.getvalue()
+
+def download_image(provider: str, url: str) -> Tuple[Image.Image, bytes]:
+    """
+    Stream an image over the provider's pooled session straight into the decode buffer.
+    Returns the decoded image and the bytes as served, for the disk cache.
+    """
+    session = get_http_session(provider)
+    with session.get(url, stream=True, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT)) as response:
+        response.raise_for_status()
+        buffer = _buffer_for(response.headers.get("Content-Length"))
+        for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+            buffer.write(chunk)
+    return _decode(buffer)
+
+async def adownload_image(url: str) -> Tuple[Image.Image, bytes]:
+    client = get_async_http_client()
+    async with client.stream("GET", url) as response:
+        response.raise_for_status()
+        buffer = _buffer_for(response.headers.get("Content-Length"))
+        async for chunk in response.aiter_bytes(chunk_size=DOWNLOAD_CHUNK_SIZE):
+            buffer.write(chunk)
+    return _decode(buffer)
@@ -0,0 +1,135 @@
+import os
+import io
+import time
+import hashlib
+import tempfile
+import threading
+import logging
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Tuple
+from PIL import Image
+
+logger = logging.getLogger("ImageDelivery")
+
+class ImageDelivery:
+    """
+    Content-addressed files for images shown in the chat UI.
+    Each distinct image is encoded and written once, on a background thread, and the
+    returned Future resolves to its path. Files not delivered again within ttl seconds,
+    and the oldest ones beyond max_files, are garbage collected.
+    """
+    def __init__(self, directory: str, ttl: float = 3600.0, max_files: int = 2000, gc_interval: float = 60.0) -> None:
+        self.directory = os.path.abspath(directory)
+        self.ttl = ttl
+        self.max_files = max_files
+        self.gc_interval = gc_interval
+        # key -> (write future, last delivery time)
+        self._entries: Dict[str, Tuple[Future, float]] = {}
+        self._lock = threading.Lock()
+        self._writer = ThreadPoolExecutor(max_workers=2, thread_name_prefix="image-delivery")
+        self._last_gc = 0.0
+        self.writes = 0
+        self.reuses = 0
+
+    @staticmethod
+    def key(image: Image.Image) -> str:
+        h = hashlib.blake2b(digest_size=16)
+        h.update(f"{image.mode}:{image.size}".encode())
+        h.update(image.tobytes())
+        return h.hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"gen_{key}.png")
+
+    def deliver(self, image: Image.Image) -> Future:
+        """
+        Schedule an image for delivery, returns a Future with its file path.
+        """
+        key = self.key(image)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and not (entry[0].done() and entry[0].exception()):
+                self._entries[key] = (entry[0], now)
+                self.reuses += 1
+                return entry[0]
+            future = self._writer.submit(self._write, key, image)
+            self._entries[key] = (future, now)
+            self.writes += 1
+            run_gc = now - self._last_gc >= self.gc_interval
+            if run_gc:
+                self._last_gc = now
+        if run_gc:
+            self._writer.submit(self.collect)
+        return future
+
+    def _write(self, key: str, image: Image.Image) -> str:
+        path = self._path(key)
+        if os.path.exists(path):
+            # Written by an earlier process, refresh it so the sweep keeps it
+            os.utime(path, None)
+            return path
+        buffered = io.BytesIO()
+        image.save(buffered, format="PNG")
+        os.makedirs(self.directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(buffered.getvalue())
+            os.replace(tmp_path, path)
+        except BaseException:
+            self._unlink(tmp_path)
+            raise
+        return path
+
+    def collect(self) -> int:
+        """
+        Delete expired and excess files, including ones left behind by earlier runs.
+        """
+        now = time.monotonic()
+        with self._lock:
+            expired = [key for key, (_, seen) in self._entries.items() if now - seen > self.ttl]
+            for key in expired:
+                del self._entries[key]
+            live = {self._path(key) for key in self._entries}
+        removed = 0
+        for key in expired:
+            removed += self._unlink(self._path(key))
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return removed
+        files = []
+        for name in names:
+            path = os.path.join(self.directory, name)
+            try:
+                mtime = os.stat(path).st_mtime
+            except FileNotFoundError:
+                continue
+            if path in live:
+                continue
+            if time.time() - mtime > self.ttl:
+                removed += self._unlink(path)
+            elif name.endswith(".png"):
+                files.append((mtime, path))
+        excess = len(files) + len(live) - self.max_files
+        for _, path in sorted(files)[:max(0, excess)]:
+            removed += self._unlink(path)
+        if removed:
+            logger.info(f"Image delivery removed {removed} files")
+        return removed
+
+    @staticmethod
+    def _unlink(path: str) -> int:
+        try:
+            os.remove(path)
+            return 1
+        except OSError:
+            return 0
+
+# Shared by every chat session in the process
+image_delivery = ImageDelivery(
+    os.getenv("IMAGE_DELIVERY_DIR", "temp_images"),
+    ttl=float(os.getenv("IMAGE_DELIVERY_TTL", "3600")),
+    max_files=int(os.getenv("IMAGE_DELIVERY_MAX_FILES", "2000"))
+)
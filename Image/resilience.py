@@ -0,0 +1,88 @@
+import time
+import threading
+import logging
+from collections import deque
+from typing import Dict, Optional
+
+logger = logging.getLogger("ImageResilience")
+
+class LatencyTracker:
+    """
+    Sliding window of recent successful call latencies for one backend.
+    """
+    def __init__(self, window: int = 50) -> None:
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float) -> None:
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, q: float, min_samples: int = 5) -> Optional[float]:
+        """
+        q-th percentile (0-100) of the window, None until enough samples were seen.
+        """
+        with self._lock:
+            if len(self._samples) < min_samples:
+                return None
+            ordered = sorted(self._samples)
+        index = min(len(ordered) - 1, max(0, int(round(q / 100 * (len(ordered) - 1)))))
+        return ordered[index]
+
+class CircuitBreaker:
+    """
+    Per-backend circuit breaker: after failure_threshold consecutive failures the backend
+    is skipped for reset_timeout seconds, then it is tried again (half-open).
+    """
+    def __init__(self, name: str, failure_threshold: int = 3, reset_timeout: float = 60.0) -> None:
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            if time.monotonic() - self._opened_at >= self.reset_timeout:
+                return "half_open"
+            return "open"
+
+    def allow(self) -> bool:
+        """
+        False while the circuit is open; once reset_timeout has passed calls go through
+        again and the next outcome closes or re-opens it.
+        """
+        return self.state != "open"
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            if self._failures >= self.failure_threshold:
+                if self._opened_at is None:
+                    logger.warning(f"Circuit opened for image backend {self.name}")
+                self._opened_at = time.monotonic()
+
+_lock = threading.Lock()
+_trackers: Dict[str, LatencyTracker] = {}
+_breakers: Dict[str, CircuitBreaker] = {}
+
+def get_latency_tracker(backend: str) -> LatencyTracker:
+    with _lock:
+        if backend not in _trackers:
+            _trackers[backend] = LatencyTracker()
+        return _trackers[backend]
+
+def get_circuit_breaker(backend: str) -> CircuitBreaker:
+    with _lock:
+        if backend not in _breakers:
+            _breakers[backend] = CircuitBreaker(backend)
+        return _breakers[backend]
@@ -1,55 +1,256 @@
 import requests
+import asyncio
+import time
 import json
 import os
 import base64
 import io
 from PIL import Image
-from typing import Dict, List, Any, Optional
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from functools import lru_cache
+from typing import Dict, List, Any, Optional, Tuple
 from http import HTTPStatus
 from urllib.parse import urlparse, unquote
 from pathlib import PurePosixPath
 import logging
+from ratelimit import get_limiter, is_throttle_error
+from .cache import image_disk_cache
+from .resilience import get_latency_tracker, get_circuit_breaker
+from .clients import (
+    httpx, load_huggingface_hub,
+    get_inference_client, get_async_inference_client, download_image, adownload_image
+)
 
 logger = logging.getLogger("ImageService")
 
-# Attempt imports for specific providers
-try:
-    import dashscope
-    from dashscope import MultiModalConversation
-except ImportError:
-    MultiModalConversation = None
+@lru_cache(maxsize=None)
+def load_dashscope() -> Any:
+    """
+    Import the DashScope SDK the first time a DashScope model is used, None if not installed.
+    """
+    try:
+        import dashscope
+    except ImportError:
+        logger.error("dashscope library not installed. Install with `pip install dashscope`")
+        return None
+    return dashscope
+
 
-try:
-    from huggingface_hub import InferenceClient
-except ImportError:
-    InferenceClient = None
+NEGATIVE_PROMPT = "Low resolution, low image quality, blurry images, unclear mathematical symbols, unclear mathematical formulas, incomplete mathematical symbols, incorrect mathematical symbols, unclear mathematical diagrams, excessive smoothing, the image has an artificial intelligence feel. Chaotic composition. Text is blurry and distorted."
+DASHSCOPE_MODELS = ["stable-diffusion-3.5-large-turbo", "qwen-image-max"]
+HF_MODEL = "zai-org/GLM-Image"
+
+# Hedging: send the prompt to the secondary backend once the primary is slower than
+# its own HEDGE_PERCENTILE latency (HEDGE_DEFAULT_DELAY until enough samples are seen)
+HEDGE_PERCENTILE = float(os.getenv("IMAGE_HEDGE_PERCENTILE", "90"))
+HEDGE_DEFAULT_DELAY = float(os.getenv("IMAGE_HEDGE_DEFAULT_DELAY", "15"))
+HEDGE_MIN_DELAY = float(os.getenv("IMAGE_HEDGE_MIN_DELAY", "2"))
+
+_hedge_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="image-hedge")
 
 class ImageApiCall:
-    def __init__(self, model_name: str) -> None:
+    def __init__(self, model_name: str, hedge: Optional[bool] = None) -> None:
         self.model_name = model_name
+        self.hedge = hedge if hedge is not None else os.getenv("IMAGE_HEDGING", "").lower() in ("1", "true", "yes")
+
+    def _use_dashscope(self) -> bool:
+        return any(m in self.model_name for m in DASHSCOPE_MODELS)
+
+    def _backends(self) -> List[str]:
+        """
+        Backends in preference order, the one selected by model_name first.
+        """
+        return ["dashscope", "hf"] if self._use_dashscope() else ["hf", "dashscope"]
+
+    def _hedge_delay(self, backend: str) -> float:
+        delay = get_latency_tracker(backend).percentile(HEDGE_PERCENTILE)
+        return max(HEDGE_MIN_DELAY, delay if delay is not None else HEDGE_DEFAULT_DELAY)
+
+    def _record_outcome(self, backend: str, result: Dict[str, Any], started: float) -> None:
+        breaker = get_circuit_breaker(backend)
+        if result.get("images"):
+            get_latency_tracker(backend).record(time.monotonic() - started)
+            breaker.record_success()
+        else:
+            breaker.record_failure()
+
+    def _call_backend(self, backend: str, prompt: str) -> Dict[str, Any]:
+        started = time.monotonic()
+        result = self._generate_dashscope(prompt) if backend == "dashscope" else self._generate_hf(prompt)
+        self._record_outcome(backend, result, started)
+        return result
+
+    async def _acall_backend(self, backend: str, prompt: str) -> Dict[str, Any]:
+        started = time.monotonic()
+        result = await (self._agenerate_dashscope(prompt) if backend == "dashscope" else self._agenerate_hf(prompt))
+        self._record_outcome(backend, result, started)
+        return result
+
+    def _hedge_plan(self) -> List[str]:
+        # Skip backends whose circuit is open, but always keep one to try
+        backends = self._backends()
+        return [b for b in backends if get_circuit_breaker(b).allow()] or backends[:1]
+
+    def _generate_hedged(self, prompt: str) -> Tuple[str, Dict[str, Any]]:
+        """
+        Race the primary backend against a delayed secondary, first success wins.
+        Returns (winning backend, result).
+        """
+        plan = self._hedge_plan()
+        futures = {_hedge_executor.submit(self._call_backend, plan[0], prompt): plan[0]}
+        pending = set(futures)
+        last = (plan[0], {"error": "no image backend available"})
+        launched = 1
+        while pending:
+            timeout = self._hedge_delay(plan[0]) if launched < len(plan) else None
+            done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                backend = futures[future]
+                result = future.result()
+                if result.get("images"):
+                    for loser in pending:
+                        loser.cancel()
+                    if backend != plan[0]:
+                        logger.info(f"Hedged image request won by {backend}")
+                    return backend, result
+                last = (backend, result)
+            if launched < len(plan):
+                # Primary is slow or failed: hedge to the next backend
+                backend = plan[launched]
+                launched += 1
+                logger.info(f"Hedging image request to {backend}")
+                future = _hedge_executor.submit(self._call_backend, backend, prompt)
+                futures[future] = backend
+                pending.add(future)
+        return last
+
+    async def _agenerate_hedged(self, prompt: str) -> Tuple[str, Dict[str, Any]]:
+        plan = self._hedge_plan()
+        tasks = {asyncio.ensure_future(self._acall_backend(plan[0], prompt)): plan[0]}
+        pending = set(tasks)
+        last = (plan[0], {"error": "no image backend available"})
+        launched = 1
+        try:
+            while pending:
+                timeout = self._hedge_delay(plan[0]) if launched < len(plan) else None
+                done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    backend = tasks[task]
+                    result = task.result()
+                    if result.get("images"):
+                        if backend != plan[0]:
+                            logger.info(f"Hedged image request won by {backend}")
+                        return backend, result
+                    last = (backend, result)
+                if launched < len(plan):
+                    backend = plan[launched]
+                    launched += 1
+                    logger.info(f"Hedging image request to {backend}")
+                    task = asyncio.ensure_future(self._acall_backend(backend, prompt))
+                    tasks[task] = backend
+                    pending.add(task)
+            return last
+        finally:
+            # The loser is cancelled outright
+            for task in pending:
+                task.cancel()
+
+    def _record_dashscope_status(self, response: Any) -> None:
+        limiter = get_limiter("dashscope-image")
+        if response.status_code == HTTPStatus.OK:
+            limiter.on_success()
+        elif response.status_code == HTTPStatus.TOO_MANY_REQUESTS or "Throttling" in str(response.code):
+            limiter.on_throttle()
+
+    def _record_error(self, provider: str, error: Exception) -> None:
+        if is_throttle_error(error):
+            get_limiter(provider).on_throttle()
 
     def generate(self, prompt: str) -> Dict[str, Any]:
         """
         Dispatch generation to the appropriate backend based on model_name.
         """
         logger.info(f"Image Request: model={self.model_name}, prompt_length={len(prompt)}")
+        cached = self._cache_lookup(prompt)
+        if cached:
+            return cached
         
-        # DashScope supported models
-        dashscope_models = ["stable-diffusion-3.5-large-turbo", "qwen-image-max"]
-        
-        if any(m in self.model_name for m in dashscope_models):
-            return self._generate_dashscope(prompt)
+        if self.hedge:
+            backend, result = self._generate_hedged(prompt)
         else:
             # Fallback or specific mapping for HF
             # Mapping other models to HF if possible, or defaulting to User's example model
-            return self._generate_hf(prompt)
+            backend = self._backends()[0]
+            result = self._call_backend(backend, prompt)
+        return self._cache_store(self._cache_key(prompt), result)
 
-    def _generate_dashscope(self, prompt: str) -> Dict[str, Any]:
+    async def agenerate(self, prompt: str) -> Dict[str, Any]:
+        """
+        Async counterpart of generate.
+        """
+        logger.info(f"Async Image Request: model={self.model_name}, prompt_length={len(prompt)}")
+        cached = await asyncio.to_thread(self._cache_lookup, prompt)
+        if cached:
+            return cached
         
-        api_key = os.getenv("DASHSCOPE_API_KEY")
-        if api_key:
-            dashscope.api_key = api_key
-            
+        if self.hedge:
+            backend, result = await self._agenerate_hedged(prompt)
+        else:
+            backend = self._backends()[0]
+            result = await self._acall_backend(backend, prompt)
+        return self._cache_store(self._cache_key(prompt), result)
+
+    def _backend_config(self, backend: str) -> List[str]:
+        if backend == "dashscope":
+            model, size = self._dashscope_model()
+            return [model, size, NEGATIVE_PROMPT]
+        return [HF_MODEL, "default", ""]
+
+    def _cache_key(self, prompt: str) -> Optional[str]:
+        """
+        One key per model group, the backends serving model_name in preference order:
+        an image any of them produced is a hit, whichever won a hedged request.
+        """
+        if image_disk_cache is None:
+            return None
+        configs = [self._backend_config(backend) for backend in self._backends()]
+        models = "|".join(config[0] for config in configs)
+        sizes = "|".join(config[1] for config in configs)
+        negative_prompts = "|".join(config[2] for config in configs)
+        return image_disk_cache.key(models, sizes, negative_prompts, prompt)
+
+    def _cache_lookup(self, prompt: str) -> Optional[Dict[str, Any]]:
+        """
+        Return the cached result for this model group, if any.
+        """
+        cache_key = self._cache_key(prompt)
+        if cache_key is None:
+            return None
+        image = image_disk_cache.get(cache_key)
+        if image is None:
+            return None
+        logger.info(f"Image cache hit: model={self.model_name}, key={cache_key[:12]}")
+        return {"images": [image]}
+
+    def _cache_store(self, cache_key: Optional[str], result: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Cache the first image and return the result without its encoded bytes.
+        """
+        encoded = result.pop("encoded", None)
+        if cache_key is None or not result.get("images"):
+            return result
+        if encoded and encoded[0]:
+            # The provider's own bytes, written as served
+            image_disk_cache.put_async(cache_key, encoded[0])
+        else:
+            # The HF client only hands out decoded images
+            image_disk_cache.put_image(cache_key, result["images"][0])
+        return result
+
+    def _dashscope_model(self) -> Tuple[str, str]:
+        """
+        Resolve the DashScope (model, size) for this model_name.
+        """
         model = "qwen-image-max" 
         size = "1328*1328"   
         
@@ -59,63 +260,142 @@ class ImageApiCall:
         elif "qwen-image-max" in self.model_name:
             model = "qwen-image-max"
             size = "1328*1328" # Specific size requested by user
+        return model, size
+
+    def _dashscope_kwargs(self, prompt: str, api_key: Optional[str]) -> Dict[str, Any]:
+        model, size = self._dashscope_model()
+        messages = [
+            {
+                "role": "user",
+                "content": [
+                    {"text": prompt}
+                ]
+            }
+        ]
+        return dict(
+            api_key=api_key,
+            model=model,
+            messages=messages,
+            result_format='message',
+            stream=False,
+            watermark=False,
+            prompt_extend=True,
+            negative_prompt=NEGATIVE_PROMPT,
+            size=size
+        )
+
+    def _generate_dashscope(self, prompt: str) -> Dict[str, Any]:
+        
+        dashscope = load_dashscope()
+        if dashscope is None:
+            return {"error": "dashscope library not installed."}
+
+        api_key = os.getenv("DASHSCOPE_API_KEY")
+        if api_key:
+            dashscope.api_key = api_key
             
         try:
-            messages = [
-                {
-                    "role": "user",
-                    "content": [
-                        {"text": prompt}
-                    ]
-                }
-            ]
-            response = MultiModalConversation.call(
-                        api_key=api_key,
-                        model=model,
-                        messages=messages,
-                        result_format='message',
-                        stream=False,
-                        watermark=False,
-                        prompt_extend=True,
-                        negative_prompt="Low resolution, low image quality, blurry images, unclear mathematical symbols, unclear mathematical formulas, incomplete mathematical symbols, incorrect mathematical symbols, unclear mathematical diagrams, excessive smoothing, the image has an artificial intelligence feel. Chaotic composition. Text is blurry and distorted.",
-                        size=size
-                        )
+            kwargs = self._dashscope_kwargs(prompt, api_key)
+            get_limiter("dashscope-image").acquire()
+            response = dashscope.MultiModalConversation.call(**kwargs)
+            self._record_dashscope_status(response)
             
             if response.status_code == HTTPStatus.OK:
                 logger.info(f"DashScope Response: {response}")
                 url = response.output.choices[0].message.content[0]["image"]
-                img_data = requests.get(url).content
-                img = Image.open(io.BytesIO(img_data)).convert("RGB")
+                img, data = download_image("dashscope-image", url)
                 images = [img]
-                logger.info(f"DashScope Response: success, model={model}, num_images={len(images)}")
-                return {"images": images}
+                logger.info(f"DashScope Response: success, model={kwargs['model']}, num_images={len(images)}")
+                return {"images": images, "encoded": [data]}
             else:
                 error_msg = f"DashScope Failed: {response.code} - {response.message}"
                 logger.error(error_msg)
                 return {"error": error_msg}
         except Exception as e:
             logger.exception("DashScope Error")
+            self._record_error("dashscope-image", e)
+            return {"error": str(e)}
+
+    async def _agenerate_dashscope(self, prompt: str) -> Dict[str, Any]:
+        dashscope = await asyncio.to_thread(load_dashscope)
+        AioMultiModalConversation = getattr(dashscope, "AioMultiModalConversation", None)
+        if AioMultiModalConversation is None or httpx is None:
+            # Older SDKs have no asyncio client, fall back to a worker thread
+            return await asyncio.to_thread(self._generate_dashscope, prompt)
+
+        api_key = os.getenv("DASHSCOPE_API_KEY")
+        if api_key:
+            dashscope.api_key = api_key
+
+        try:
+            kwargs = self._dashscope_kwargs(prompt, api_key)
+            await get_limiter("dashscope-image").aacquire()
+            response = await AioMultiModalConversation.call(**kwargs)
+            self._record_dashscope_status(response)
+            
+            if response.status_code == HTTPStatus.OK:
+                logger.info(f"DashScope Async Response: {response}")
+                url = response.output.choices[0].message.content[0]["image"]
+                img, data = await adownload_image(url)
+                images = [img]
+                logger.info(f"DashScope Async Response: success, model={kwargs['model']}, num_images={len(images)}")
+                return {"images": images, "encoded": [data]}
+            else:
+                error_msg = f"DashScope Failed: {response.code} - {response.message}"
+                logger.error(error_msg)
+                return {"error": error_msg}
+        except Exception as e:
+            logger.exception("DashScope Async Error")
+            self._record_error("dashscope-image", e)
             return {"error": str(e)}
 
     def _generate_hf(self, prompt: str) -> Dict[str, Any]:
-        
+        if load_huggingface_hub() is None:
+            return {"error": "huggingface_hub library not installed."}
+
         token = os.getenv("HF_TOKEN")
         if not token:
              return {"error": "HF_TOKEN not set in environment."}
              
         try:
             # Using user's example provider and model
-            client = InferenceClient(provider="fal-ai", api_key=token)
+            client = get_inference_client("fal-ai", token)
             # Default to "zai-org/GLM-Image" as per user example, or map others
-            model = "zai-org/GLM-Image" 
+            model = HF_MODEL
             
             # Returns PIL Image
+            limiter = get_limiter("hf-fal")
+            limiter.acquire()
             image = client.text_to_image(prompt, model=model).convert("RGB")
+            limiter.on_success()
             images = [image]
             logger.info("HF Image Response: success")
             return {"images": images}
         except Exception as e:
             logger.exception("HF Image Error")
+            self._record_error("hf-fal", e)
+            return {"error": str(e)}
+
+    async def _agenerate_hf(self, prompt: str) -> Dict[str, Any]:
+        if await asyncio.to_thread(load_huggingface_hub) is None:
+            return await asyncio.to_thread(self._generate_hf, prompt)
+
+        token = os.getenv("HF_TOKEN")
+        if not token:
+             return {"error": "HF_TOKEN not set in environment."}
+
+        try:
+            client = get_async_inference_client("fal-ai", token)
+            limiter = get_limiter("hf-fal")
+            await limiter.aacquire()
+            image = await client.text_to_image(prompt, model=HF_MODEL)
+            limiter.on_success()
+            images = [image.convert("RGB")]
+            logger.info("HF Async Image Response: success")
+            return {"images": images}
+        except Exception as e:
+            logger.exception("HF Async Image Error")
+            self._record_error("hf-fal", e)
             return {"error": str(e)}
 
 class ImageService:
@@ -124,7 +404,14 @@ class ImageService:
     """
     def __init__(self, api_client: ImageApiCall) -> None:
         self.api_client = api_client
+
+    @property
+    def model_name(self) -> str:
+        return self.api_client.model_name
     
     def generate_image(self, prompt: str) -> Dict[str, Any]:
-        # Delegate directly to smart client
-        return self.api_client.generate(prompt)
\ No newline at end of file
+        # Delegate directly to smart client, the prompt labels the images in memory
+        return {**self.api_client.generate(prompt), "prompt": prompt}
+
+    async def agenerate_image(self, prompt: str) -> Dict[str, Any]:
+        return {**await self.api_client.agenerate(prompt), "prompt": prompt}
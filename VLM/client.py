@@ -0,0 +1,127 @@
+import os
+import asyncio
+import threading
+import logging
+from typing import Dict, Tuple, Optional
+
+logger = logging.getLogger("VLMClient")
+
+# Attempt imports for specific providers
+try:
+    import httpx
+    from openai import OpenAI, AsyncOpenAI
+except ImportError:
+    httpx = None
+    OpenAI = None
+    AsyncOpenAI = None
+
+# Connection pool limits and timeouts, overridable from the environment
+MAX_CONNECTIONS = int(os.getenv("VLM_HTTP_MAX_CONNECTIONS", "64"))
+MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("VLM_HTTP_MAX_KEEPALIVE", "32"))
+KEEPALIVE_EXPIRY = float(os.getenv("VLM_HTTP_KEEPALIVE_EXPIRY", "120"))
+CONNECT_TIMEOUT = float(os.getenv("VLM_HTTP_CONNECT_TIMEOUT", "10"))
+READ_TIMEOUT = float(os.getenv("VLM_HTTP_READ_TIMEOUT", "300"))
+MAX_RETRIES = int(os.getenv("VLM_HTTP_MAX_RETRIES", "2"))
+
+class ClientRegistry:
+    """
+    Process-wide registry of OpenAI clients keyed by (base_url, api_key).
+    Every client keeps its own keep-alive connection pool, so all sessions
+    talking to the same endpoint reuse established TLS connections.
+    """
+    def __init__(self) -> None:
+        self._clients: Dict[Tuple[str, Optional[str]], "OpenAI"] = {}
+        self._lock = threading.Lock()
+
+    def _limits(self) -> "httpx.Limits":
+        return httpx.Limits(
+            max_connections=MAX_CONNECTIONS,
+            max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=KEEPALIVE_EXPIRY
+        )
+
+    def _timeout(self) -> "httpx.Timeout":
+        return httpx.Timeout(READ_TIMEOUT, connect=CONNECT_TIMEOUT)
+
+    def get(self, base_url: str, api_key: Optional[str]) -> "OpenAI":
+        """
+        Return the shared client for an endpoint, creating it on first use.
+        """
+        if not OpenAI:
+            raise ImportError("openai library not installed. Install with `pip install openai`")
+        key = (base_url, api_key)
+        client = self._clients.get(key)
+        if client is not None:
+            return client
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                logger.info(f"Creating pooled OpenAI client: base_url={base_url}")
+                client = OpenAI(
+                    api_key=api_key,
+                    base_url=base_url,
+                    timeout=self._timeout(),
+                    max_retries=MAX_RETRIES,
+                    http_client=httpx.Client(limits=self._limits(), timeout=self._timeout())
+                )
+                self._clients[key] = client
+        return client
+
+    def close(self) -> None:
+        """
+        Close every pooled client and drop them from the registry.
+        """
+        with self._lock:
+            clients = list(self._clients.values())
+            self._clients.clear()
+        for client in clients:
+            try:
+                client.close()
+            except Exception as e:
+                logger.warning(f"Failed to close OpenAI client: {e}")
+
+class AsyncClientRegistry(ClientRegistry):
+    """
+    AsyncOpenAI counterpart of ClientRegistry.
+    httpx async pools are bound to the event loop that created them, so clients are keyed per loop as well.
+    """
+    def get(self, base_url: str, api_key: Optional[str]) -> "AsyncOpenAI":
+        if not AsyncOpenAI:
+            raise ImportError("openai library not installed. Install with `pip install openai`")
+        key = (base_url, api_key, id(asyncio.get_running_loop()))
+        client = self._clients.get(key)
+        if client is not None:
+            return client
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                logger.info(f"Creating pooled AsyncOpenAI client: base_url={base_url}")
+                client = AsyncOpenAI(
+                    api_key=api_key,
+                    base_url=base_url,
+                    timeout=self._timeout(),
+                    max_retries=MAX_RETRIES,
+                    http_client=httpx.AsyncClient(limits=self._limits(), timeout=self._timeout())
+                )
+                self._clients[key] = client
+        return client
+
+    async def aclose(self) -> None:
+        with self._lock:
+            clients = list(self._clients.values())
+            self._clients.clear()
+        for client in clients:
+            try:
+                await client.close()
+            except Exception as e:
+                logger.warning(f"Failed to close AsyncOpenAI client: {e}")
+
+# Shared by every VLMService instance in the process
+client_registry = ClientRegistry()
+async_client_registry = AsyncClientRegistry()
+
+def get_client(base_url: str, api_key: Optional[str]) -> "OpenAI":
+    return client_registry.get(base_url, api_key)
+
+def get_async_client(base_url: str, api_key: Optional[str]) -> "AsyncOpenAI":
+    return async_client_registry.get(base_url, api_key)
@@ -0,0 +1,106 @@
+import os
+import re
+from typing import Dict, List, Any, Optional, Tuple
+from PIL import Image
+from .preprocess import ImagePreprocessor
+
+DEFAULT_BUDGET_TOKENS = 16000
+# CJK characters are roughly one token each, other text roughly four characters per token
+_CJK = re.compile(r"[\u3000-\u303f\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uff00-\uffef]")
+
+def estimate_text_tokens(text: str) -> int:
+    if not text:
+        return 0
+    cjk = len(_CJK.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+# ImageLabels value of images the user uploaded with the question
+UPLOAD_LABEL = "upload"
+
+def split_images(entry: Any) -> Tuple[List[Any], List[Tuple[Any, str]]]:
+    """
+    Uploaded images and (image, label) pairs of generated ones in a memory entry.
+    """
+    labels = getattr(entry, "ImageLabels", [])
+    uploads, generated = [], []
+    for i, img in enumerate(entry.Images):
+        if not img:
+            continue
+        label = labels[i] if i < len(labels) else ""
+        if label == UPLOAD_LABEL:
+            uploads.append(img)
+        else:
+            generated.append((img, label))
+    return uploads, generated
+
+def figure_key(label: str) -> str:
+    """
+    Name of the figure an image belongs to. Image prompts follow the
+    "Image Name: Image Prompt" convention of the skills, so the part before the colon is used.
+    """
+    label = (label or "").strip().lstrip("-* ").strip()
+    name, sep, _ = label.partition(":")
+    key = name if sep and name.strip() else label
+    return re.sub(r"\s+", " ", key.strip().lower())
+
+class ContextBudget:
+    """
+    Token budget of the memory sent to the VLM, applied by PromptBuilder when it compacts
+    the history: the original problem and the most recent rounds are kept verbatim, older
+    rounds are collapsed to a short excerpt. Uploaded images are always kept; of the
+    generated ones only the latest valid image per figure is kept, newest figures first,
+    up to max_images.
+    """
+    def __init__(self, max_tokens: int = DEFAULT_BUDGET_TOKENS, preprocessor: Optional[ImagePreprocessor] = None,
+                 recent_rounds: int = 2, max_images: int = 6, excerpt_chars: int = 240) -> None:
+        self.max_tokens = max_tokens
+        self.preprocessor = preprocessor or ImagePreprocessor()
+        self.recent_rounds = recent_rounds
+        self.max_images = max_images
+        self.excerpt_chars = excerpt_chars
+
+    @classmethod
+    def from_config(cls, config: Optional[Dict[str, Any]], preprocessor: Optional[ImagePreprocessor] = None) -> "ContextBudget":
+        """
+        Build a budget from a VLMService.model_config entry, VLM_CONTEXT_BUDGET_TOKENS overrides the model default.
+        """
+        config = config or {}
+        max_tokens = int(os.getenv("VLM_CONTEXT_BUDGET_TOKENS", config.get("context_budget", DEFAULT_BUDGET_TOKENS)))
+        return cls(
+            max_tokens=max_tokens,
+            preprocessor=preprocessor or ImagePreprocessor.from_config(config),
+            recent_rounds=int(os.getenv("VLM_CONTEXT_RECENT_ROUNDS", config.get("context_recent_rounds", 2))),
+            max_images=int(os.getenv("VLM_CONTEXT_MAX_IMAGES", config.get("context_max_images", 6)))
+        )
+
+    def image_tokens(self, image: Any) -> int:
+        return self.preprocessor.estimate_tokens(image)
+
+    def select_images(self, entries: List[Any]) -> List[Image.Image]:
+        """
+        Uploaded images plus the latest image of each generated figure.
+        Works on anything with width/height, i.e. PIL images or ImageStore handles.
+        """
+        pinned = []
+        latest: Dict[str, Tuple[int, Image.Image]] = {}
+        order = 0
+        for entry in entries:
+            uploads, generated = split_images(entry)
+            pinned.extend(uploads)
+            for img, label in generated:
+                if img.width == 0 or img.height == 0:
+                    continue
+                # Unlabelled images cannot be matched to a figure, each one counts as its own
+                key = figure_key(label) or f"#{order}"
+                latest[key] = (order, img)
+                order += 1
+        generated = [img for _, img in sorted(latest.values(), key=lambda item: item[0], reverse=True)]
+        budget = max(0, self.max_images - len(pinned))
+        # Newest first for the cut, then back to chronological order
+        return pinned + list(reversed(generated[:budget]))
+
+    def excerpt(self, text: str) -> str:
+        text = re.sub(r"\s+", " ", text).strip()
+        if len(text) <= self.excerpt_chars:
+            return text
+        return text[:self.excerpt_chars].rstrip() + " ..."
@@ -0,0 +1,110 @@
+import os
+import time
+import hashlib
+import tempfile
+import logging
+from typing import Any, Optional
+
+# Only imported by the local backend, torch is already loaded there
+import torch
+
+logger = logging.getLogger("CPUBackend")
+
+# "auto" uses CUDA when available, "cpu"/"cuda" force a backend
+LOCAL_DEVICE = os.getenv("LOCAL_DEVICE", "auto").lower()
+# 0 uses every core available to the process
+LOCAL_NUM_THREADS = int(os.getenv("LOCAL_NUM_THREADS", "0"))
+LOCAL_CPU_QUANTIZE = os.getenv("LOCAL_CPU_QUANTIZE", "1").lower() not in ("0", "false", "no")
+DEFAULT_QUANT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "reasoning_with_text_and_image", "quantized")
+# Empty disables the on-disk cache of quantized models
+LOCAL_QUANT_CACHE_DIR = os.getenv("LOCAL_QUANT_CACHE_DIR", DEFAULT_QUANT_CACHE_DIR)
+
+def select_device() -> str:
+    if LOCAL_DEVICE in ("cpu", "cuda"):
+        return LOCAL_DEVICE
+    return "cuda" if torch.cuda.is_available() else "cpu"
+
+def available_cores() -> int:
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+def configure_threads(num_threads: int = LOCAL_NUM_THREADS) -> int:
+    """
+    Size torch's intra-op pool to the cores this process may use.
+    """
+    threads = num_threads or available_cores()
+    torch.set_num_threads(threads)
+    try:
+        torch.set_num_interop_threads(max(1, min(4, threads // 4)))
+    except RuntimeError:
+        # Can only be set before the first parallel op ran
+        pass
+    logger.info(f"CPU backend: {threads} intra-op threads, {torch.get_num_interop_threads()} inter-op threads")
+    return threads
+
+def quantize_linear(model: Any) -> Any:
+    """
+    Dynamic int8 quantization of the language model's linear layers. The vision tower runs
+    once per image, and its kernels read their weight dtype, so it stays in float32.
+    """
+    spec = {
+        name: torch.ao.quantization.default_dynamic_qconfig
+        for name, module in model.named_modules()
+        if isinstance(module, torch.nn.Linear) and "visual" not in name.split(".")
+    }
+    return torch.ao.quantization.quantize_dynamic(model, qconfig_spec=spec, dtype=torch.qint8, inplace=True)
+
+def quantized_cache_path(model_id: str, cache_dir: str) -> str:
+    import transformers
+    # Pickled modules are only valid for the versions that wrote them
+    key = f"{model_id}:{torch.__version__}:{transformers.__version__}:qint8"
+    digest = hashlib.sha256(key.encode("utf-8")).hexdigest()[:16]
+    return os.path.join(cache_dir, f"{model_id.replace('/', '--')}-{digest}.pt")
+
+def _save(model: Any, path: str) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            torch.save(model, f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+def load_cpu_model(model_class: Any, model_id: str, quantize: bool = LOCAL_CPU_QUANTIZE, cache_dir: Optional[str] = LOCAL_QUANT_CACHE_DIR) -> Any:
+    """
+    Load a model for CPU inference. With quantize, the int8 model is cached on disk
+    after the first conversion and later startups load it directly.
+    """
+    configure_threads()
+    path = quantized_cache_path(model_id, cache_dir) if quantize and cache_dir else None
+    if path and os.path.exists(path):
+        start = time.perf_counter()
+        try:
+            # A full pickle, only ever read from the cache directory this backend writes
+            model = torch.load(path, weights_only=False, mmap=True)
+            logger.info(f"Loaded quantized {model_id} from {path} in {time.perf_counter() - start:.1f}s")
+            return model.eval()
+        except Exception as e:
+            logger.warning(f"Quantized cache {path} unusable, converting again: {e}")
+
+    start = time.perf_counter()
+    # bitsandbytes kernels need CUDA; dynamic int8 linears need float32 weights to start from
+    model = model_class.from_pretrained(model_id, torch_dtype=torch.float32, low_cpu_mem_usage=True).eval()
+    if not quantize:
+        return model
+    quantize_linear(model)
+    logger.info(f"Quantized {model_id} to dynamic int8 in {time.perf_counter() - start:.1f}s")
+    if path:
+        try:
+            _save(model, path)
+            logger.info(f"Cached quantized model at {path}")
+        except Exception as e:
+            logger.warning(f"Failed to cache quantized model: {e}")
+    return model
@@ -0,0 +1,116 @@
+import os
+import io
+import base64
+import hashlib
+import threading
+import weakref
+import logging
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional, Tuple
+from PIL import Image
+
+logger = logging.getLogger("ImageCache")
+
+class ImageEncodingCache:
+    """
+    Bounded LRU cache for per-image derived data (base64 payloads, resized copies, ...).
+    Entries are keyed by the image content hash plus a tag such as the target format,
+    so the same pixels are only encoded once no matter how many rounds resend them.
+    """
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[Tuple[str, str], Tuple[Any, int]]" = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        # id(image) -> (weakref, digest); avoids rehashing the same PIL object
+        self._digests: Dict[int, Tuple[weakref.ref, str]] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def digest(self, image: Image.Image) -> str:
+        """
+        Content hash of the decoded pixels, memoized per live image object.
+        """
+        cached = self._digests.get(id(image))
+        if cached is not None and cached[0]() is image:
+            return cached[1]
+        h = hashlib.blake2b(digest_size=20)
+        h.update(f"{image.mode}:{image.size[0]}x{image.size[1]}:".encode("utf-8"))
+        h.update(image.tobytes())
+        digest = h.hexdigest()
+        key = id(image)
+        try:
+            ref = weakref.ref(image, lambda _, key=key: self._digests.pop(key, None))
+            self._digests[key] = (ref, digest)
+        except TypeError:
+            pass
+        return digest
+
+    def get(self, digest: str, tag: str) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get((digest, tag))
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end((digest, tag))
+            self.hits += 1
+            return entry[0]
+
+    def put(self, digest: str, tag: str, value: Any, size: int) -> None:
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            key = (digest, tag)
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= old[1]
+            self._entries[key] = (value, size)
+            self._size += size
+            while self._size > self.max_bytes and self._entries:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._size -= evicted_size
+                self.evictions += 1
+
+    def get_or_compute(self, image: Image.Image, tag: str, compute: Callable[[Image.Image], Any], size_of: Callable[[Any], int]) -> Any:
+        """
+        Return the cached value for (image, tag), computing and storing it on a miss.
+        """
+        digest = self.digest(image)
+        value = self.get(digest, tag)
+        if value is None:
+            value = compute(image)
+            self.put(digest, tag, value, size_of(value))
+        return value
+
+    def encode_base64(self, image: Image.Image, format: str = "PNG", **save_kwargs: Any) -> str:
+        """
+        Encode an image to base64 in the given format, reusing previous encodings.
+        """
+        tag = "b64:" + format.upper() + (":" + repr(sorted(save_kwargs.items())) if save_kwargs else "")
+
+        def _encode(img: Image.Image) -> str:
+            buffered = io.BytesIO()
+            img.save(buffered, format=format, **save_kwargs)
+            return base64.b64encode(buffered.getbuffer()).decode("utf-8")
+
+        return self.get_or_compute(image, tag, _encode, len)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "bytes": self._size,
+                "max_bytes": self.max_bytes
+            }
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+# Shared by VLMService and LocalVLMService across all sessions
+image_cache = ImageEncodingCache(int(os.getenv("VLM_IMAGE_CACHE_MAX_BYTES", str(256 * 1024 * 1024))))
@@ -0,0 +1,119 @@
+import io
+import os
+import shutil
+import tempfile
+import threading
+import weakref
+import logging
+from collections import OrderedDict
+from typing import Optional
+from PIL import Image
+
+logger = logging.getLogger("ImageStore")
+
+DEFAULT_SESSION_MAX_BYTES = int(os.getenv("VLM_MEMORY_IMAGE_MAX_BYTES", str(32 * 1024 * 1024)))
+SPILL_DIR = os.getenv("VLM_MEMORY_SPILL_DIR") or None
+
+class ImageHandle:
+    """
+    Compact stand-in for a PIL image kept in memory: PNG bytes in RAM or a spilled file on disk,
+    decoded on demand. Exposes width/height/size/mode without decoding.
+    """
+    def __init__(self, store: "ImageStore", key: int, image: Image.Image) -> None:
+        self._store = store
+        self.key = key
+        self.size = image.size
+        self.width, self.height = image.size
+        self.mode = image.mode
+        # Reuse the decoded image for as long as someone else keeps it alive
+        self._decoded = weakref.ref(image)
+
+    def load(self) -> Image.Image:
+        image = self._decoded()
+        if image is None:
+            image = self._store.load(self.key)
+            self._decoded = weakref.ref(image)
+        return image
+
+class ImageStore:
+    """
+    Per-session image store with a resident memory cap.
+    Images are kept PNG-encoded; once the encoded bytes exceed max_bytes the oldest ones
+    are written to a private temp directory and only read back when decoded.
+    """
+    def __init__(self, max_bytes: int = DEFAULT_SESSION_MAX_BYTES, spill_dir: Optional[str] = SPILL_DIR) -> None:
+        self.max_bytes = max_bytes
+        self.spill_root = spill_dir
+        self._resident: "OrderedDict[int, bytes]" = OrderedDict()
+        self._spilled = {}
+        self._resident_bytes = 0
+        self._next_key = 0
+        self._dir: Optional[str] = None
+        self._lock = threading.Lock()
+        self._finalizer = None
+
+    @property
+    def resident_bytes(self) -> int:
+        return self._resident_bytes
+
+    def put(self, image: Image.Image) -> ImageHandle:
+        """
+        Encode an image into the store and return its handle.
+        """
+        if image.mode not in ("RGB", "RGBA", "L", "LA", "P", "1"):
+            image = image.convert("RGB")
+        buffered = io.BytesIO()
+        # Fast lossless compression, the images are decoded again before they reach the model
+        image.save(buffered, format="PNG", compress_level=1)
+        data = buffered.getvalue()
+        with self._lock:
+            key = self._next_key
+            self._next_key += 1
+            self._resident[key] = data
+            self._resident_bytes += len(data)
+            self._spill_locked()
+        return ImageHandle(self, key, image)
+
+    def load(self, key: int) -> Image.Image:
+        with self._lock:
+            data = self._resident.get(key)
+            path = self._spilled.get(key)
+        if data is None:
+            if path is None:
+                raise KeyError(f"Image {key} is not in the store")
+            with open(path, "rb") as f:
+                data = f.read()
+        image = Image.open(io.BytesIO(data))
+        image.load()
+        return image
+
+    def _spill_locked(self) -> None:
+        while self._resident_bytes > self.max_bytes and len(self._resident) > 1:
+            key, data = self._resident.popitem(last=False)
+            try:
+                path = os.path.join(self._spill_dir_locked(), f"{key}.png")
+                with open(path, "wb") as f:
+                    f.write(data)
+            except OSError as e:
+                logger.warning(f"Image spill failed, keeping image in memory: {e}")
+                self._resident[key] = data
+                self._resident.move_to_end(key, last=False)
+                return
+            self._spilled[key] = path
+            self._resident_bytes -= len(data)
+
+    def _spill_dir_locked(self) -> str:
+        if self._dir is None:
+            self._dir = tempfile.mkdtemp(prefix="vlm-memory-", dir=self.spill_root)
+            # Remove the directory with the session even if close() is never called
+            self._finalizer = weakref.finalize(self, shutil.rmtree, self._dir, True)
+            logger.info(f"Spilling session images to {self._dir}")
+        return self._dir
+
+    def close(self) -> None:
+        with self._lock:
+            self._resident.clear()
+            self._spilled.clear()
+            self._resident_bytes = 0
+            if self._finalizer is not None:
+                self._finalizer()
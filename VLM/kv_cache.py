@@ -0,0 +1,153 @@
+import os
+import copy
+import threading
+import logging
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, List, Optional, Tuple
+
+# Only imported by the local backend, torch is already loaded there
+import torch
+
+logger = logging.getLogger("KVCache")
+
+# Image placeholder run in a prompt: (start, end, image digest)
+ImageSpan = Tuple[int, int, str]
+
+def cache_nbytes(cache: Any) -> int:
+    """
+    Size of a transformers KV cache across the DynamicCache layouts of different versions.
+    """
+    layers = getattr(cache, "layers", None)
+    if layers is not None:
+        return sum(t.nbytes for layer in layers for t in (getattr(layer, "keys", None), getattr(layer, "values", None)) if t is not None)
+    keys = getattr(cache, "key_cache", None)
+    values = getattr(cache, "value_cache", None)
+    if keys is not None and values is not None:
+        return sum(t.nbytes for t in list(keys) + list(values) if t is not None)
+    return 0
+
+@dataclass
+class PrefixEntry:
+    ids: torch.Tensor # 1-D token ids the cache was computed for
+    spans: List[ImageSpan]
+    cache: Any
+    nbytes: int
+
+class PrefixKVCache:
+    """
+    Memory-bounded LRU of prompt KV caches for the local model.
+    A new prompt reuses the entry sharing its longest prefix, where shared image placeholder
+    runs only count if the images behind them have the same digest. Because the prompt layout
+    keeps a static system prefix and an append-only history, the previous round of a session
+    usually covers everything but the newest turn, and other sessions still share the system prefix.
+    """
+    def __init__(self, max_bytes: int, min_tokens: int = 32) -> None:
+        self.max_bytes = max_bytes
+        self.min_tokens = min_tokens
+        self._entries: "OrderedDict[int, PrefixEntry]" = OrderedDict()
+        self._bytes = 0
+        self._next_key = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.reused_tokens = 0
+
+    @staticmethod
+    def _common_length(entry: PrefixEntry, ids: torch.Tensor, spans: List[ImageSpan]) -> int:
+        n = min(len(entry.ids), len(ids))
+        if n == 0:
+            return 0
+        mismatch = (entry.ids[:n] != ids[:n]).nonzero()
+        length = int(mismatch[0]) if len(mismatch) else n
+        # Identical placeholder tokens do not mean identical images
+        for (start, end, digest), (o_start, o_end, o_digest) in zip(spans, entry.spans):
+            if start >= length:
+                break
+            if (start, end, digest) != (o_start, o_end, o_digest) or end > length:
+                return start
+        return length
+
+    def lookup(self, ids: torch.Tensor, spans: List[ImageSpan], limit: int) -> Tuple[int, Optional[Any]]:
+        """
+        Return (reused length, private copy of the cache cropped to it), or (0, None).
+        At most limit tokens are reused, so the caller always has input left to feed.
+        """
+        with self._lock:
+            best_key, best_len = None, 0
+            for key, entry in self._entries.items():
+                length = min(self._common_length(entry, ids, spans), limit)
+                if length > best_len:
+                    best_key, best_len = key, length
+            if best_key is None or best_len < self.min_tokens:
+                self.misses += 1
+                return 0, None
+            entry = self._entries[best_key]
+            self._entries.move_to_end(best_key)
+            self.hits += 1
+            self.reused_tokens += best_len
+            # generate() extends the cache in place, callers get their own copy
+            cache = copy.deepcopy(entry.cache)
+        cache.crop(best_len)
+        return best_len, cache
+
+    def store(self, ids: torch.Tensor, spans: List[ImageSpan], cache: Any) -> None:
+        nbytes = cache_nbytes(cache)
+        if nbytes == 0 or nbytes > self.max_bytes:
+            return
+        with self._lock:
+            # An entry that is a prefix of the new one is superseded by it
+            for key in [k for k, e in self._entries.items() if len(e.ids) <= len(ids) and self._common_length(e, ids, spans) == len(e.ids)]:
+                self._bytes -= self._entries.pop(key).nbytes
+            self._entries[self._next_key] = PrefixEntry(ids.clone(), list(spans), cache, nbytes)
+            self._next_key += 1
+            self._bytes += nbytes
+            while self._bytes > self.max_bytes and len(self._entries) > 1:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted.nbytes
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self._bytes, "hits": self.hits, "misses": self.misses, "reused_tokens": self.reused_tokens}
+
+class VisionEncoderCache:
+    """
+    Memory-bounded LRU of vision tower outputs keyed by image digest and grid.
+    """
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[Tuple[str, Tuple[int, ...]], torch.Tensor]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Tuple[str, Tuple[int, ...]]) -> Optional[torch.Tensor]:
+        with self._lock:
+            embeds = self._entries.get(key)
+            if embeds is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return embeds
+
+    def put(self, key: Tuple[str, Tuple[int, ...]], embeds: torch.Tensor) -> None:
+        if embeds.nbytes > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = embeds
+            self._bytes += embeds.nbytes
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted.nbytes
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self._bytes, "hits": self.hits, "misses": self.misses}
+
+# Shared by every LocalVLMService instance (they share one model)
+prefix_kv_cache = PrefixKVCache(int(os.getenv("LOCAL_KV_CACHE_MAX_BYTES", str(2 * 1024 * 1024 * 1024))))
+vision_encoder_cache = VisionEncoderCache(int(os.getenv("LOCAL_VISION_CACHE_MAX_BYTES", str(512 * 1024 * 1024))))
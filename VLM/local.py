@@ -0,0 +1,349 @@
+import os
+import json
+import asyncio
+import logging
+import threading
+from typing import Dict, List, Any, Optional, Iterator, AsyncIterator, Tuple
+from PIL import Image
+
+# Heavy imports: this module is only loaded once a local model is selected
+import torch
+from transformers import Qwen2VLForConditionalGeneration, AutoProcessor, BitsAndBytesConfig, TextIteratorStreamer, DynamicCache, StoppingCriteria, StoppingCriteriaList
+from transformers.generation.streamers import BaseStreamer
+
+from .service import VLMService, iterate_in_thread
+from .image_cache import image_cache
+from .kv_cache import ImageSpan, prefix_kv_cache, vision_encoder_cache
+from .scheduler import BatchScheduler, GenerationRequest, QueueFullError
+from .cpu_backend import select_device, load_cpu_model
+from cancellation import CancellationToken
+
+logger = logging.getLogger("VLMService")
+
+# Reuse prompt KV caches and vision tower outputs across requests
+LOCAL_KV_CACHE = os.getenv("LOCAL_KV_CACHE", "1").lower() not in ("0", "false", "no")
+
+class CancelledCriteria(StoppingCriteria):
+    """
+    Stops the rows of a (batched) generate() whose request was cancelled.
+    """
+    def __init__(self, tokens: List[CancellationToken]) -> None:
+        self.tokens = tokens
+
+    def __call__(self, input_ids: "torch.LongTensor", scores: "torch.FloatTensor", **kwargs: Any) -> "torch.BoolTensor":
+        return torch.tensor([token.cancelled for token in self.tokens], dtype=torch.bool, device=input_ids.device)
+
+class BatchStreamer(BaseStreamer):
+    """
+    Splits the tokens of a batched generate() into the streamers of its requests.
+    A request's streamer is ended as soon as that row emits an end-of-sequence token.
+    """
+    def __init__(self, streamers: List[Any], eos_token_ids: List[int]) -> None:
+        self.streamers = streamers
+        self.eos_token_ids = set(eos_token_ids)
+        self.finished = [False] * len(streamers)
+
+    def put(self, value: "torch.Tensor") -> None:
+        if value.dim() > 1:
+            # The prompt, which every streamer skips
+            for i, streamer in enumerate(self.streamers):
+                streamer.put(value[i:i + 1])
+            return
+        for i, streamer in enumerate(self.streamers):
+            if self.finished[i]:
+                continue
+            token = int(value[i])
+            if token in self.eos_token_ids:
+                self.finished[i] = True
+                streamer.end()
+            else:
+                streamer.put(value[i:i + 1])
+
+    def end(self) -> None:
+        for i, streamer in enumerate(self.streamers):
+            if not self.finished[i]:
+                self.finished[i] = True
+                streamer.end()
+
+class LocalVLMService(VLMService):
+    """
+    Local VLM service running Qwen2-VL.
+    """
+    _model = None
+    _processor = None
+    _scheduler = None
+    _load_lock = threading.Lock()
+
+    def __init__(self, model_name: str) -> None: 
+        super().__init__(model_name)
+        self.device = select_device()
+        self._load_model()
+
+    def _load_model(self):
+        with LocalVLMService._load_lock:
+            self._load_model_locked()
+
+    def _load_model_locked(self):
+        if LocalVLMService._model is None:
+            model_id = "Qwen/Qwen2-VL-7B-Instruct"
+            
+            LocalVLMService._processor = AutoProcessor.from_pretrained(model_id)
+            if self.device == "cpu":
+                LocalVLMService._model = load_cpu_model(Qwen2VLForConditionalGeneration, model_id)
+            else:
+                # 4-bit quantization configuration
+                quantization_config = BitsAndBytesConfig(
+                   load_in_4bit=True,
+                   bnb_4bit_quant_type="nf4",
+                   bnb_4bit_compute_dtype=torch.float16
+                )
+                
+                LocalVLMService._model = Qwen2VLForConditionalGeneration.from_pretrained(
+                    model_id, 
+                    torch_dtype="auto", 
+                    device_map="auto",
+                    quantization_config=quantization_config
+                )
+            # Batched prompts are padded on the left so generation continues right after each one
+            LocalVLMService._processor.tokenizer.padding_side = "left"
+            LocalVLMService._scheduler = BatchScheduler(self._run_batch)
+
+    def _prepare_inputs(self, messages: List[Dict[str, Any]]) -> Tuple[Any, List[str]]:
+        """
+        Apply the Qwen2-VL chat template to {"role", "content", "images"} messages and run the processor.
+        Returns the model inputs and the content digest of every image, in prompt order.
+        """
+        chat = []
+        images = []
+        for message in messages:
+            message_images = self._preprocess_images(message.get("images"))
+            content = [{"type": "image", "image": img} for img in message_images]
+            content.append({"type": "text", "text": message["content"]})
+            chat.append({"role": message["role"], "content": content})
+            images.extend(message_images)
+
+        text = self._processor.apply_chat_template(chat, tokenize=False, add_generation_prompt=True)
+        digests = [image_cache.digest(img) for img in images]
+        
+        if images:
+            return self._processor(text=[text], images=images, padding=True, return_tensors="pt").to(self.device), digests
+        return self._processor(text=[text], padding=True, return_tensors="pt").to(self.device), digests
+
+    def _base_model(self) -> Any:
+        # Qwen2VLModel holds the vision tower and rope state; older transformers keep them on the top-level model
+        return getattr(self._model, "model", self._model)
+
+    def _visual(self) -> Any:
+        return getattr(self._model, "visual", None) or self._base_model().visual
+
+    def _image_spans(self, ids: "torch.Tensor", digests: List[str]) -> List[ImageSpan]:
+        """
+        (start, end, digest) of every run of image placeholder tokens.
+        """
+        positions = (ids == self._model.config.image_token_id).nonzero().flatten().tolist()
+        runs = []
+        for pos in positions:
+            if runs and runs[-1][1] == pos:
+                runs[-1][1] = pos + 1
+            else:
+                runs.append([pos, pos + 1])
+        return [(start, end, digest) for (start, end), digest in zip(runs, digests)]
+
+    def _image_embeds(self, inputs: Any, index: int, digest: str) -> "torch.Tensor":
+        """
+        Vision tower output for one image of the prompt, cached by image digest.
+        """
+        grid = inputs["image_grid_thw"]
+        key = (digest, tuple(grid[index].tolist()))
+        embeds = vision_encoder_cache.get(key)
+        if embeds is None:
+            rows = grid.prod(dim=-1)
+            offset = int(rows[:index].sum())
+            visual = self._visual()
+            pixel_values = inputs["pixel_values"][offset:offset + int(rows[index])].type(visual.dtype)
+            with torch.no_grad():
+                embeds = visual(pixel_values, grid_thw=grid[index:index + 1])
+            # Newer versions return a model output, older ones the tensor itself
+            embeds = getattr(embeds, "pooler_output", None) if not torch.is_tensor(embeds) else embeds
+            vision_encoder_cache.put(key, embeds)
+        return embeds
+
+    def _prefill(self, inputs: Any, digests: List[str]) -> Tuple[Any, List[ImageSpan]]:
+        """
+        Fill a KV cache for all prompt tokens but the last, starting from the longest cached prefix
+        and only running the vision tower for images that are neither in that prefix nor cached.
+        """
+        input_ids = inputs["input_ids"]
+        ids = input_ids[0]
+        grid = inputs.get("image_grid_thw")
+        spans = self._image_spans(ids, digests) if grid is not None else []
+        # generate() needs at least one uncached token
+        end = len(ids) - 1
+        reused, cache = prefix_kv_cache.lookup(ids, spans, end)
+        if cache is None:
+            cache = DynamicCache()
+
+        base = self._base_model()
+        position_ids, rope_deltas = base.get_rope_index(input_ids, grid, None, inputs["attention_mask"])
+        if end > reused:
+            embeds = self._model.get_input_embeddings()(input_ids[:, reused:end])
+            for i, (start, stop, digest) in enumerate(spans):
+                if start >= reused and stop <= end:
+                    embeds[0, start - reused:stop - reused] = self._image_embeds(inputs, i, digest).to(embeds.device, embeds.dtype)
+            with torch.no_grad():
+                self._model(
+                    inputs_embeds=embeds,
+                    attention_mask=inputs["attention_mask"][:, :end],
+                    position_ids=position_ids[:, :, reused:end],
+                    past_key_values=cache,
+                    cache_position=torch.arange(reused, end, device=embeds.device),
+                    use_cache=True
+                )
+        # Decoding continues from the rope offsets of the full prompt
+        base.rope_deltas = rope_deltas
+        logger.info(f"Local prefill: reused {reused}/{len(ids)} tokens, kv={prefix_kv_cache.stats()}, vision={vision_encoder_cache.stats()}")
+        return cache, spans
+
+    def _generate(self, inputs: Any, digests: List[str], **generation_kwargs: Any) -> Any:
+        """
+        model.generate with prefix KV and vision-encoder reuse, falling back to a full prefill.
+        """
+        prepared = None
+        if LOCAL_KV_CACHE:
+            try:
+                prepared = self._prefill(inputs, digests)
+            except Exception as e:
+                logger.warning(f"KV prefix reuse unavailable, running full prefill: {e}")
+        if prepared is None:
+            return self._model.generate(**inputs, **generation_kwargs)
+
+        cache, spans = prepared
+        # All images are in the cache already, so no pixel values are passed
+        output = self._model.generate(
+            input_ids=inputs["input_ids"],
+            attention_mask=inputs["attention_mask"],
+            past_key_values=cache,
+            **generation_kwargs
+        )
+        ids = inputs["input_ids"][0]
+        cache.crop(len(ids))
+        prefix_kv_cache.store(ids, spans, cache)
+        return output
+
+    def _collate(self, batch: List[GenerationRequest]) -> Dict[str, Any]:
+        """
+        Left-pad the processed prompts of several requests into one batch.
+        """
+        length = max(r.tokens for r in batch)
+        pad_id = self._processor.tokenizer.pad_token_id
+        input_ids = torch.full((len(batch), length), pad_id, dtype=batch[0].inputs["input_ids"].dtype, device=self.device)
+        attention_mask = torch.zeros((len(batch), length), dtype=batch[0].inputs["attention_mask"].dtype, device=self.device)
+        for i, request in enumerate(batch):
+            input_ids[i, length - request.tokens:] = request.inputs["input_ids"][0]
+            attention_mask[i, length - request.tokens:] = request.inputs["attention_mask"][0]
+        collated = {"input_ids": input_ids, "attention_mask": attention_mask}
+        with_images = [r.inputs for r in batch if r.inputs.get("pixel_values") is not None]
+        if with_images:
+            collated["pixel_values"] = torch.cat([x["pixel_values"] for x in with_images])
+            collated["image_grid_thw"] = torch.cat([x["image_grid_thw"] for x in with_images])
+        return collated
+
+    def _run_batch(self, batch: List[GenerationRequest]) -> None:
+        """
+        Scheduler callback. A lone request keeps the prefix KV reuse path, several requests
+        are decoded together with their tokens split back into each request's streamer.
+        """
+        if len(batch) == 1:
+            request = batch[0]
+            self._generate(
+                request.inputs, request.digests,
+                streamer=request.streamer,
+                max_new_tokens=request.max_new_tokens,
+                stopping_criteria=StoppingCriteriaList([CancelledCriteria([request.cancel])])
+            )
+            return
+
+        eos = self._model.generation_config.eos_token_id
+        eos_token_ids = eos if isinstance(eos, list) else [eos]
+        streamer = BatchStreamer([r.streamer for r in batch], eos_token_ids)
+        self._model.generate(
+            **self._collate(batch),
+            streamer=streamer,
+            max_new_tokens=batch[0].max_new_tokens,
+            pad_token_id=self._processor.tokenizer.pad_token_id,
+            stopping_criteria=StoppingCriteriaList([CancelledCriteria([r.cancel for r in batch])])
+        )
+        logger.info(f"Local scheduler stats: {self._scheduler.stats()}")
+
+    def _submit(self, messages: List[Dict[str, Any]], cancel: CancellationToken, max_new_tokens: int = 512) -> GenerationRequest:
+        inputs, digests = self._prepare_inputs(messages)
+        streamer = TextIteratorStreamer(self._processor.tokenizer, skip_special_tokens=True, skip_prompt=True, clean_up_tokenization_spaces=False)
+        request = GenerationRequest(inputs, digests, streamer, tokens=int(inputs["input_ids"].shape[1]), max_new_tokens=max_new_tokens, cancel=cancel)
+        return self._scheduler.submit(request)
+
+    def generate_stream(self, prompt: str, images: Optional[List[Image.Image]] = None, cancel: Optional[CancellationToken] = None) -> Iterator[str]:
+        return self.generate_chat_stream([{"role": "user", "content": prompt, "images": images}], cancel)
+
+    def generate_chat_stream(self, messages: List[Dict[str, Any]], cancel: Optional[CancellationToken] = None) -> Iterator[str]:
+        """
+        Stream a generation. It stops early when the run is cancelled or the stream is closed.
+        """
+        logger.info(f"VLM Stream Request Start: model={self.model_name}, messages={len(messages)}, num_images={sum(len(m.get('images') or []) for m in messages)}")
+        stop = cancel.child() if cancel is not None else CancellationToken()
+        finished = False
+        try:
+            try:
+                request = self._submit(messages, stop)
+            except QueueFullError as e:
+                logger.warning(f"VLM Stream Rejected: {e}")
+                yield f"Error: {str(e)}"
+                return
+
+            for new_text in request.streamer:
+                yield new_text
+            finished = True
+            if request.error and not stop.cancelled:
+                yield f"Error: {request.error}"
+        finally:
+            if not finished:
+                # Nobody reads the rest, stop generating instead of running to max_new_tokens
+                stop.cancel("stream closed")
+            stop.detach()
+
+    def health_check(self) -> bool:
+        return LocalVLMService._model is not None
+
+    def agenerate_stream(self, prompt: str, images: Optional[List[Image.Image]] = None, cancel: Optional[CancellationToken] = None) -> AsyncIterator[str]:
+        return self.agenerate_chat_stream([{"role": "user", "content": prompt, "images": images}], cancel)
+
+    async def agenerate_chat_stream(self, messages: List[Dict[str, Any]], cancel: Optional[CancellationToken] = None) -> AsyncIterator[str]:
+        # Local generation is blocking, drive the sync streamer from a worker thread.
+        # The sync stream cannot be closed while a worker is inside it, so it is stopped through its token
+        stop = cancel.child() if cancel is not None else CancellationToken()
+        finished = False
+        try:
+            async for text in iterate_in_thread(self.generate_chat_stream(messages, stop)):
+                yield text
+            finished = True
+        finally:
+            if not finished:
+                stop.cancel("stream closed")
+            stop.detach()
+
+    async def agenerate_text(self, prompt: str, images: Optional[List[Image.Image]] = None) -> str:
+        return await asyncio.to_thread(self.generate_text, prompt, images)
+
+    def generate_text(self, prompt: str, images: Optional[List[Image.Image]] = None) -> str:
+        logger.info(f"Local VLM Request: model=Qwen2-VL-7B, prompt_length={len(prompt)}, num_images={len(images) if images else 0}")
+        try:
+            request = self._submit([{"role": "user", "content": prompt, "images": images}], CancellationToken())
+        except QueueFullError as e:
+            logger.warning(f"Local VLM Rejected: {e}")
+            return json.dumps({"error": str(e)})
+
+        response_text = "".join(request.streamer)
+        if request.error:
+            logger.error(f"Local VLM Response: error={request.error}")
+            return json.dumps({"error": request.error})
+        logger.info(f"Local VLM Response: success, length={len(response_text)}, excerpt={response_text}...")
+        return response_text
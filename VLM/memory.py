@@ -1,28 +1,67 @@
+import os
+import logging
 from PIL import Image
-from dataclasses import dataclass
-from typing import Dict, List, Any
+from dataclasses import dataclass, field, replace
+from typing import Dict, List, Any, Optional, Set, Tuple
+from .context import UPLOAD_LABEL
+from .image_store import ImageStore, ImageHandle
+from .phash import dhash, hamming
+
+logger = logging.getLogger("Memory")
+
+# Max dHash bit distance at which a generated image counts as a copy of an earlier one, -1 disables
+MEMORY_DEDUP_DISTANCE = int(os.getenv("VLM_MEMORY_DEDUP_DISTANCE", "4"))
+# "latest": the new copy is kept and the older one leaves every later request,
+# "first": the new copy is collapsed into the older one and not stored
+MEMORY_DEDUP_POLICY = os.getenv("VLM_MEMORY_DEDUP_POLICY", "latest").lower()
 
 @dataclass
 class Memory:
     SkillSelection: str
     Stage: str
     Message: str
-    Images: List[Image.Image] # List of PIL Images
+    Images: List[ImageHandle] # Compact handles into the session ImageStore
+    ImageLabels: List[str] = field(default_factory=list) # Generation prompt per image, "" if unknown
 
 class MemoryService:
-    def __init__(self, input: Dict[str, Any]) -> None:
+    def __init__(self, input: Dict[str, Any], image_store: Optional[ImageStore] = None,
+                 dedup_distance: int = MEMORY_DEDUP_DISTANCE, dedup_policy: str = MEMORY_DEDUP_POLICY) -> None:
         self.memory: List[Memory] = []
         self.input = input
+        self.image_store = image_store or ImageStore()
+        self.dedup_distance = dedup_distance
+        self.dedup_policy = dedup_policy
+        # dHash -> latest stored copy of each generated image
+        self._hash_index: Dict[int, ImageHandle] = {}
+        # Older copies left out of requests ("latest" policy)
+        self._superseded: Set[int] = set()
+        # Entry index -> earlier copies that near-duplicates inserted there were collapsed into ("first" policy)
+        self._collapsed: Dict[int, List[ImageHandle]] = {}
+        self.duplicates = 0
         self.init_memory()
 
     def init_memory(self) -> None:
+        images = [self.image_store.put(img) for img in self.input.get("files", []) if img] # Already PIL Images from main.py
         self.memory.append(Memory(
             SkillSelection="", 
             Stage="Initializing",
             Message=self.input.get("text", ""),
-            Images=self.input.get("files", []) # Already PIL Images from main.py
+            Images=images,
+            ImageLabels=[UPLOAD_LABEL] * len(images)
         ))
 
+    def close(self) -> None:
+        """
+        Release the session's stored images, including spilled files.
+        """
+        self._hash_index.clear()
+        self._collapsed.clear()
+        self.image_store.close()
+
+    @staticmethod
+    def _load_images(handles: List[ImageHandle]) -> List[Image.Image]:
+        return [handle.load() for handle in handles if handle]
+
     def append_message(self, message: Any) -> None:
         if isinstance(message, list):
             message = "\n".join([str(m) for m in message])
@@ -36,13 +75,47 @@ class MemoryService:
             self.memory[-1].SkillSelection = skill
             self.memory[-1].Stage = stage
 
-    def append_image(self, image: Image.Image) -> None:
+    def _find_duplicate(self, image: Image.Image) -> Tuple[Optional[int], Optional[int]]:
+        """
+        (hash of image, hash of the closest earlier copy within dedup_distance or None).
+        """
+        if self.dedup_distance < 0 or self.dedup_policy not in ("latest", "first"):
+            return None, None
+        value = dhash(image)
+        best, best_distance = None, self.dedup_distance + 1
+        for known in self._hash_index:
+            distance = hamming(value, known)
+            if distance < best_distance:
+                best, best_distance = known, distance
+        return value, best
+
+    def append_image(self, image: Image.Image, label: str = "") -> None:
         """
         Add a new PIL image to the current memory entry.
+        Near-duplicates of an earlier generated image are handled by dedup_policy.
         """
         if self.memory:
             if image:
-                self.memory[-1].Images.append(image)
+                entry = self.memory[-1]
+                # Keep labels aligned with Images, which may have been filled directly
+                entry.ImageLabels.extend([""] * (len(entry.Images) - len(entry.ImageLabels)))
+                value, duplicate = self._find_duplicate(image)
+                if duplicate is not None:
+                    self.duplicates += 1
+                    previous = self._hash_index[duplicate]
+                    if self.dedup_policy == "first":
+                        logger.info(f"Near-duplicate image collapsed into image {previous.key}: {(label or "")[:60]}")
+                        self._collapsed.setdefault(len(self.memory) - 1, []).append(previous)
+                        return
+                    # The entries keep the older copy, visible_entries() drops it from the next request on
+                    logger.info(f"Near-duplicate image replaces image {previous.key}: {(label or "")[:60]}")
+                    self._superseded.add(previous.key)
+                    del self._hash_index[duplicate]
+                handle = self.image_store.put(image)
+                entry.Images.append(handle)
+                entry.ImageLabels.append(label or "")
+                if value is not None:
+                    self._hash_index[value] = handle
 
     def update_message(self, message: Any) -> None:
         """
@@ -57,32 +130,27 @@ class MemoryService:
         if not self.memory:
             return {}
         data = self.memory[-1] 
+        # Images collapsed into earlier copies this round are returned as those copies
+        images = list(data.Images)
+        images += [h for h in self._collapsed.get(len(self.memory) - 1, []) if all(h is not other for other in images)]
         return {
             "SkillSelection": data.SkillSelection,
             "Stage": data.Stage,
             "Message": data.Message,
-            "Images": data.Images
+            "Images": self._load_images(images)
         }
 
-    def get_all_memory(self) -> Dict[str, Any]:
+    def visible_entries(self) -> List[Memory]:
         """
-        Produce a summary of all memory entries.
+        Memory entries without the copies superseded by a near-duplicate, what requests are built from.
         """
-        if not self.memory:
-            return {}
-        
-        # Concatenate all messages with index
-        all_messages = "\n".join([f"No.{i}: {m.Message}" for i, m in enumerate(self.memory)])
-        # Collect all images across all memory entries
-        all_images = []
+        if not self._superseded:
+            return self.memory
+        entries = []
         for m in self.memory:
-            for img in m.Images:
-                if img:
-                    all_images.append(img)
-        
-        return {
-            "SkillSelection": self.memory[-1].SkillSelection,
-            "Stage": self.memory[-1].Stage,
-            "Message": all_messages,
-            "Images": all_images
-        }
+            keep = [i for i, h in enumerate(m.Images) if getattr(h, "key", None) not in self._superseded]
+            if len(keep) == len(m.Images):
+                entries.append(m)
+                continue
+            entries.append(replace(m, Images=[m.Images[i] for i in keep], ImageLabels=[m.ImageLabels[i] for i in keep if i < len(m.ImageLabels)]))
+        return entries
@@ -0,0 +1,21 @@
+from PIL import Image
+
+def dhash(image: Image.Image, hash_size: int = 8) -> int:
+    """
+    Difference hash: compares neighbouring pixels of a small grayscale copy, so re-encoded,
+    rescaled or slightly redrawn versions of a figure land within a few bits of each other.
+    """
+    small = image.convert("L").resize((hash_size + 1, hash_size), Image.Resampling.BILINEAR)
+    pixels = small.tobytes() # One byte per grayscale pixel
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+def dhash_hex(image: Image.Image, hash_size: int = 8) -> str:
+    return f"{dhash(image, hash_size):0{hash_size * hash_size // 4}x}"
+
+def hamming(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
@@ -0,0 +1,118 @@
+import math
+import logging
+from typing import Any, Dict, Optional, Tuple
+from PIL import Image
+from .image_cache import image_cache
+
+logger = logging.getLogger("ImagePreprocess")
+
+# Qwen2-VL style defaults: 28px patches, 4..16384 visual tokens
+DEFAULT_FACTOR = 28
+DEFAULT_MIN_PIXELS = 4 * 28 * 28
+DEFAULT_MAX_PIXELS = 16384 * 28 * 28
+
+# An image whose nearest-neighbour thumbnail has at most this many colors is treated as a line diagram
+DIAGRAM_MAX_COLORS = 256
+
+FORMAT_MIME = {
+    "PNG": "image/png",
+    "JPEG": "image/jpeg",
+    "WEBP": "image/webp",
+}
+
+def smart_resize(width: int, height: int, factor: int, min_pixels: int, max_pixels: int) -> Tuple[int, int]:
+    """
+    Pick a size whose sides are multiples of factor and whose area lies in [min_pixels, max_pixels],
+    keeping the aspect ratio as close as possible (same rule as the Qwen2-VL processor).
+    """
+    h_bar = max(factor, round(height / factor) * factor)
+    w_bar = max(factor, round(width / factor) * factor)
+    if h_bar * w_bar > max_pixels:
+        beta = math.sqrt((height * width) / max_pixels)
+        h_bar = max(factor, math.floor(height / beta / factor) * factor)
+        w_bar = max(factor, math.floor(width / beta / factor) * factor)
+    elif h_bar * w_bar < min_pixels:
+        beta = math.sqrt(min_pixels / (height * width))
+        h_bar = math.ceil(height * beta / factor) * factor
+        w_bar = math.ceil(width * beta / factor) * factor
+    return w_bar, h_bar
+
+class ImagePreprocessor:
+    """
+    Resize images to a per-model pixel budget and pick a wire format by content
+    before they are handed to a VLM.
+    """
+    def __init__(self, min_pixels: int = DEFAULT_MIN_PIXELS, max_pixels: int = DEFAULT_MAX_PIXELS, factor: int = DEFAULT_FACTOR, image_format: str = "auto", quality: int = 90) -> None:
+        self.min_pixels = min_pixels
+        self.max_pixels = max_pixels
+        self.factor = factor
+        self.image_format = image_format.upper()
+        self.quality = quality
+
+    @classmethod
+    def from_config(cls, config: Optional[Dict[str, Any]]) -> "ImagePreprocessor":
+        """
+        Build a preprocessor from a VLMService.model_config entry.
+        """
+        config = config or {}
+        return cls(
+            min_pixels=config.get("min_pixels", DEFAULT_MIN_PIXELS),
+            max_pixels=config.get("max_pixels", DEFAULT_MAX_PIXELS),
+            factor=config.get("image_factor", DEFAULT_FACTOR),
+            image_format=config.get("image_format", "auto"),
+            quality=config.get("image_quality", 90)
+        )
+
+    def _resize(self, image: Image.Image) -> Image.Image:
+        if image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        width, height = smart_resize(image.width, image.height, self.factor, self.min_pixels, self.max_pixels)
+        if (width, height) == image.size:
+            return image
+        logger.info(f"Resizing image {image.width}x{image.height} -> {width}x{height}")
+        return image.resize((width, height), Image.Resampling.LANCZOS)
+
+    def resize(self, image: Image.Image) -> Image.Image:
+        """
+        Return a copy of the image that fits the pixel budget, cached by content.
+        """
+        tag = f"resize:{self.factor}:{self.min_pixels}:{self.max_pixels}"
+        return image_cache.get_or_compute(image, tag, self._resize, lambda img: len(img.getbands()) * img.width * img.height)
+
+    def estimate_tokens(self, image: Image.Image) -> int:
+        """
+        Visual tokens the model spends on an image: one per factor x factor cell after resizing.
+        """
+        width, height = smart_resize(image.width, image.height, self.factor, self.min_pixels, self.max_pixels)
+        # +2 for the vision start/end markers
+        return (width // self.factor) * (height // self.factor) + 2
+
+    def choose_format(self, image: Image.Image) -> str:
+        """
+        Lossless PNG for flat-color content such as line diagrams, lossy format for photos.
+        """
+        if self.image_format != "AUTO":
+            return self.image_format
+
+        def _classify(img: Image.Image) -> str:
+            thumb = img.convert("RGB")
+            # Nearest sampling keeps the original palette, filtering would add blended edge colors
+            thumb.thumbnail((128, 128), Image.Resampling.NEAREST)
+            return "PNG" if thumb.getcolors(maxcolors=DIAGRAM_MAX_COLORS) is not None else "JPEG"
+
+        return image_cache.get_or_compute(image, "format", _classify, len)
+
+    def to_data_url(self, image: Image.Image) -> str:
+        """
+        Resize, pick a format and encode an image as a data URL.
+        """
+        resized = self.resize(image)
+        # Classified on the original, the resized copy already has anti-aliased edges
+        fmt = self.choose_format(image)
+        if fmt == "PNG":
+            b64 = image_cache.encode_base64(resized, format="PNG")
+        elif fmt == "WEBP":
+            b64 = image_cache.encode_base64(resized, format="WEBP", quality=self.quality, method=4)
+        else:
+            b64 = image_cache.encode_base64(resized, format="JPEG", quality=self.quality)
+        return f"data:{FORMAT_MIME.get(fmt, 'image/png')};base64,{b64}"
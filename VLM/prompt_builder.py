@@ -0,0 +1,152 @@
+import json
+import hashlib
+import logging
+from typing import Dict, List, Any, Optional
+from .context import ContextBudget, estimate_text_tokens, split_images
+from .image_store import ImageHandle
+from .skill_registry import skill_registry
+from prompt import SKILL_SELECTION_PROMPT, RESPONSE_PROMPT, STAGE_PROMPT, TOOLS_PROMPT
+
+logger = logging.getLogger("PromptBuilder")
+
+SELECTION_INSTRUCTION = "Select the skill, stage and tool_list for the next step based on the conversation so far. Reply in the response format."
+EXECUTION_INSTRUCTION = "Apply the `{skill}` skill to the conversation so far, following its SKILL INSTRUCTIONS."
+FUSED_DELIMITER = "<<<SKILL OUTPUT>>>"
+FUSED_INSTRUCTION = (
+    "Select the skill, stage and tool_list for the next step based on the conversation so far and reply in the response format. "
+    f"Then write a line containing only {FUSED_DELIMITER} and, after it, the output of the selected skill following its SKILL INSTRUCTIONS."
+)
+NO_IMAGES = "(no images generated)"
+
+def prompt_version() -> str:
+    """
+    Digest of the prompts, request instructions and skills, everything besides the
+    session that shapes the model's replies.
+    """
+    raw = json.dumps([
+        STAGE_PROMPT, TOOLS_PROMPT, SKILL_SELECTION_PROMPT, RESPONSE_PROMPT,
+        SELECTION_INSTRUCTION, EXECUTION_INSTRUCTION, FUSED_INSTRUCTION, skill_registry.version
+    ])
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:16]
+
+class PromptBuilder:
+    """
+    Prefix-cache friendly chat layout for one session.
+    Every request starts with the same system message (stage, tool, skill catalog and response
+    prompts plus all skill instructions), followed by the session history as multi-turn messages
+    that only ever grow at the end, followed by one short instruction for the request at hand.
+    Requests therefore share their longest possible prefix with the previous round, and the system
+    message is shared by every session.
+    Messages are {"role", "content", "images"} dicts; the services turn them into provider formats.
+    """
+    def __init__(self, budget: Optional[ContextBudget] = None) -> None:
+        self.budget = budget
+        # Rounds [1, _compacted_upto) are folded into one summary turn, fixed until the next compaction
+        self._compacted_upto = 1
+        self._summary: Optional[Dict[str, Any]] = None
+        self._system_key: Optional[str] = None
+        self._system = ""
+
+    def system_prompt(self) -> str:
+        # Skill bodies are part of the prompt, so any skill edit rebuilds it
+        version = skill_registry.version
+        if version != self._system_key:
+            catalog = skill_registry.catalog()
+            skills = "\n".join(
+                f"### {skill.name}\n{skill.body.strip()}"
+                for skill in (skill_registry.get(name) for name in skill_registry.names()) if skill
+            )
+            self._system = (
+                STAGE_PROMPT + "\n" +
+                TOOLS_PROMPT + "\n" +
+                SKILL_SELECTION_PROMPT.format(skills=catalog) + "\n" +
+                RESPONSE_PROMPT + "\n" +
+                "SKILL INSTRUCTIONS:\n" + skills
+            )
+            self._system_key = version
+        return self._system
+
+    @staticmethod
+    def _load(images: List[Any]) -> List[Any]:
+        return [img.load() if isinstance(img, ImageHandle) else img for img in images if img]
+
+    @staticmethod
+    def _round_text(index: int, entry: Any) -> str:
+        # Skill/stage are written to an entry after it was first sent, so they stay out of the text
+        return f"No.{index}: {entry.Message}"
+
+    def _tokens(self, entries: List[Any]) -> int:
+        text = sum(estimate_text_tokens(e.Message) for e in entries)
+        images = sum(self.budget.image_tokens(img) for e in entries for img in e.Images if img)
+        return text + images
+
+    def _maybe_compact(self, entries: List[Any]) -> None:
+        """
+        Fold older rounds into a summary once the history no longer fits the budget.
+        This rewrites the history once per compaction instead of on every round.
+        """
+        if self.budget is None:
+            return
+        visible = [entries[0]] + entries[self._compacted_upto:]
+        if self._tokens(visible) <= self.budget.max_tokens:
+            return
+        upto = max(self._compacted_upto, len(entries) - max(1, self.budget.recent_rounds))
+        if upto <= self._compacted_upto:
+            return
+        folded = entries[:upto]
+        pinned = len(split_images(entries[0])[0])
+        images = self.budget.select_images(folded)[pinned:]
+        lines = [f"No.{i}: {self.budget.excerpt(e.Message)}" for i, e in enumerate(folded) if i > 0]
+        self._summary = {
+            "role": "assistant",
+            "content": f"Summary of rounds 1-{upto - 1}:\n" + "\n".join(lines),
+            "images": images
+        }
+        self._compacted_upto = upto
+        logger.info(f"Prompt history compacted up to round {upto}")
+
+    def history(self, entries: List[Any]) -> List[Dict[str, Any]]:
+        """
+        The session as alternating turns: the problem, then every round's output followed by
+        the images generated for it. The last round's images go with the trailing instruction.
+        """
+        if not entries:
+            return []
+        self._maybe_compact(entries)
+        uploads, generated = split_images(entries[0])
+        messages = [{"role": "user", "content": entries[0].Message, "images": self._load(uploads)}]
+        if generated and len(entries) > 1 and self._summary is None:
+            # Images generated before the first round output was written
+            messages.append({"role": "user", "content": "Generated images:", "images": self._load([img for img, _ in generated])})
+        turns = []
+        if self._summary is not None:
+            turns.append((self._summary["content"], self._summary["images"]))
+        for i in range(self._compacted_upto, len(entries)):
+            turns.append((self._round_text(i, entries[i]), entries[i].Images))
+        for i, (text, images) in enumerate(turns):
+            messages.append({"role": "assistant", "content": text, "images": []})
+            if i < len(turns) - 1:
+                images = self._load(images)
+                messages.append({"role": "user", "content": "Generated images:" if images else NO_IMAGES, "images": images})
+        return messages
+
+    def _request(self, entries: List[Any], instruction: str) -> List[Dict[str, Any]]:
+        messages = [{"role": "system", "content": self.system_prompt(), "images": []}]
+        messages += self.history(entries)
+        pending = self._load(entries[-1].Images if len(entries) > 1 else [img for img, _ in split_images(entries[0])[1]])
+        if pending:
+            instruction = "Generated images:\n" + instruction
+        messages.append({"role": "user", "content": instruction, "images": pending})
+        return messages
+
+    def selection_messages(self, entries: List[Any]) -> List[Dict[str, Any]]:
+        return self._request(entries, SELECTION_INSTRUCTION)
+
+    def execution_messages(self, entries: List[Any], skill: str) -> List[Dict[str, Any]]:
+        return self._request(entries, EXECUTION_INSTRUCTION.format(skill=skill or "reasoning"))
+
+    def fused_messages(self, entries: List[Any]) -> List[Dict[str, Any]]:
+        """
+        Selection and skill execution in one request; the skill bodies are already in the system prefix.
+        """
+        return self._request(entries, FUSED_INSTRUCTION)
@@ -0,0 +1,233 @@
+import os
+import io
+import re
+import json
+import time
+import base64
+import hashlib
+import tempfile
+import threading
+import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+from PIL import Image
+from .image_cache import image_cache
+from .phash import dhash_hex
+
+logger = logging.getLogger("RunCache")
+
+DEFAULT_RUN_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "reasoning_with_text_and_image", "runs")
+
+class RunCache:
+    """
+    Whole-run answer cache keyed by (vlm model, image model, prompt version, question, input image hashes).
+    Each entry is the final step sequence of a completed run with its generated images,
+    held in a small in-memory LRU and written atomically to disk as one JSON file,
+    so several worker processes can share one directory. Entries expire after ttl seconds;
+    the directory is bounded by evicting least recently used files.
+    """
+    def __init__(self, directory: Optional[str], ttl: float, max_entries: int, max_bytes: int, image_match: str = "exact") -> None:
+        self.directory = directory
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        # "exact" pixel digests, or "perceptual" dHashes that also match re-encoded/rescaled uploads
+        self.image_match = image_match
+        self._entries: "OrderedDict[str, Tuple[float, List[Dict[str, Any]]]]" = OrderedDict()
+        self._approx_size: Optional[int] = None
+        self._lock = threading.Lock()
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="run-cache")
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+
+    @staticmethod
+    def normalize_text(text: str) -> str:
+        # Whitespace only: case carries meaning in math problems (point A vs side a)
+        return re.sub(r"\s+", " ", (text or "").strip())
+
+    def image_hash(self, image: Image.Image) -> str:
+        if self.image_match == "perceptual":
+            return dhash_hex(image)
+        return image_cache.digest(image)
+
+    def key(self, vlm_model: str, image_model: str, text: str, images: List[Image.Image], version: str = "") -> str:
+        """
+        version identifies the prompts and skills, so editing them stops replaying older runs.
+        """
+        hashes = [self.image_hash(img) for img in images if img]
+        raw = json.dumps([vlm_model, image_model, version, self.normalize_text(text), self.image_match, hashes], ensure_ascii=False)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key + ".json")
+
+    def _expired(self, created: float) -> bool:
+        return self.ttl > 0 and time.time() - created > self.ttl
+
+    def get(self, key: str) -> Optional[List[Dict[str, Any]]]:
+        """
+        Cached steps as dicts (stage, message, is_final, images), None on a miss.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if not self._expired(entry[0]):
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                del self._entries[key]
+        entry = self._read(key) if self.directory else None
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self._remember(key, entry)
+            self.hits += 1
+        return entry[1]
+
+    def put(self, key: str, steps: List[Dict[str, Any]]) -> None:
+        """
+        Store the steps of a completed run, the disk write happens in the background.
+        """
+        created = time.time()
+        with self._lock:
+            self._remember(key, (created, steps))
+            self.stores += 1
+        if self.directory:
+            self._writer.submit(self._write, key, created, steps)
+
+    def _remember(self, key: str, entry: Tuple[float, List[Dict[str, Any]]]) -> None:
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _read(self, key: str) -> Optional[Tuple[float, List[Dict[str, Any]]]]:
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = json.loads(f.read())
+            # Touch for LRU ordering
+            os.utime(path, None)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning(f"Run cache read failed for {key}: {e}")
+            self._unlink(path)
+            return None
+        created = data.get("created", 0.0)
+        if self._expired(created):
+            self._unlink(path)
+            return None
+        try:
+            images = {
+                digest: Image.open(io.BytesIO(base64.b64decode(encoded))).convert("RGB")
+                for digest, encoded in data["images"].items()
+            }
+            steps = [
+                {**step, "images": [images[digest] for digest in step["images"]]}
+                for step in data["steps"]
+            ]
+        except Exception as e:
+            logger.warning(f"Corrupt run cache entry {key}: {e}")
+            self._unlink(path)
+            return None
+        return created, steps
+
+    def _write(self, key: str, created: float, steps: List[Dict[str, Any]]) -> None:
+        # Stage steps repeat the same generated images, each one is encoded once
+        images: Dict[str, str] = {}
+        records = []
+        for step in steps:
+            digests = []
+            for img in step["images"]:
+                digest = image_cache.digest(img)
+                if digest not in images:
+                    buffered = io.BytesIO()
+                    img.save(buffered, format="PNG")
+                    images[digest] = base64.b64encode(buffered.getvalue()).decode("ascii")
+                digests.append(digest)
+            records.append({**step, "images": digests})
+        data = json.dumps({"created": created, "steps": records, "images": images}, ensure_ascii=False).encode("utf-8")
+
+        path = self._path(key)
+        directory = os.path.dirname(path)
+        try:
+            os.makedirs(directory, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+            except BaseException:
+                self._unlink(tmp_path)
+                raise
+        except OSError as e:
+            logger.warning(f"Run cache write failed: {e}")
+            return
+        self._account(len(data))
+
+    def _account(self, added: int) -> None:
+        with self._lock:
+            if self._approx_size is None:
+                self._approx_size = sum(size for _, size, _ in self._files())
+            else:
+                self._approx_size += added
+            if self._approx_size <= self.max_bytes:
+                return
+            self._approx_size = self._evict()
+
+    def _files(self) -> list:
+        entries = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if not name.endswith(".json"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+        return entries
+
+    def _evict(self) -> int:
+        """
+        Delete least recently used entries until the directory is at 90% of its budget.
+        """
+        entries = sorted(self._files())
+        total = sum(size for _, size, _ in entries)
+        target = int(self.max_bytes * 0.9)
+        for _, size, path in entries:
+            if total <= target:
+                break
+            self._unlink(path)
+            total -= size
+        logger.info(f"Run cache evicted down to {total} bytes")
+        return total
+
+    @staticmethod
+    def _unlink(path: str) -> None:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses, "stores": self.stores}
+
+def _env_flag(name: str) -> bool:
+    return os.getenv(name, "").lower() in ("1", "true", "yes")
+
+# Shared by every VlmRun in the process, None when disabled.
+# An empty RUN_CACHE_DIR keeps entries in memory only.
+run_cache = None if _env_flag("RUN_CACHE_DISABLE") else RunCache(
+    os.getenv("RUN_CACHE_DIR", DEFAULT_RUN_CACHE_DIR) or None,
+    float(os.getenv("RUN_CACHE_TTL", str(24 * 3600))),
+    int(os.getenv("RUN_CACHE_MAX_ENTRIES", "64")),
+    int(os.getenv("RUN_CACHE_MAX_BYTES", str(512 * 1024 * 1024))),
+    image_match=os.getenv("RUN_CACHE_IMAGE_MATCH", "exact").lower()
+)
@@ -0,0 +1,151 @@
+import os
+import time
+import threading
+import logging
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Callable, Deque, List, Optional
+
+logger = logging.getLogger("Scheduler")
+
+LOCAL_MAX_BATCH_SIZE = int(os.getenv("LOCAL_MAX_BATCH_SIZE", "4"))
+LOCAL_MAX_QUEUE = int(os.getenv("LOCAL_MAX_QUEUE", "16"))
+# Padded tokens (longest prompt x batch size) allowed in one batch
+LOCAL_MAX_BATCH_TOKENS = int(os.getenv("LOCAL_MAX_BATCH_TOKENS", "16384"))
+# Seconds a new request waits for others to join its batch
+LOCAL_BATCH_WAIT = float(os.getenv("LOCAL_BATCH_WAIT", "0.02"))
+# Seconds a request waits for a queue slot before it is rejected
+LOCAL_ADMISSION_TIMEOUT = float(os.getenv("LOCAL_ADMISSION_TIMEOUT", "5"))
+
+class QueueFullError(RuntimeError):
+    pass
+
+@dataclass
+class GenerationRequest:
+    inputs: Any
+    digests: List[str]
+    streamer: Any # Receives this request's tokens, ended when the request finishes
+    tokens: int
+    max_new_tokens: int = 512
+    cancel: Any = None # CancellationToken, polled while queued and while generating
+    error: Optional[str] = None
+    enqueued_at: float = field(default_factory=time.monotonic)
+
+    @property
+    def cancelled(self) -> bool:
+        return self.cancel is not None and self.cancel.cancelled
+
+    def fail(self, error: Exception) -> None:
+        self.error = str(error)
+        self.streamer.end()
+
+class BatchScheduler:
+    """
+    Single worker in front of a shared model. Requests from concurrent sessions are queued,
+    and the worker takes the oldest one plus any compatible requests behind it (same
+    generation settings, within the batch size and padded token limits) and hands them to
+    run_batch together. Admission is bounded: a request waits up to admission_timeout for
+    one of max_queue slots and is rejected with QueueFullError otherwise.
+    """
+    def __init__(
+        self,
+        run_batch: Callable[[List[GenerationRequest]], None],
+        max_batch_size: int = LOCAL_MAX_BATCH_SIZE,
+        max_queue: int = LOCAL_MAX_QUEUE,
+        max_batch_tokens: int = LOCAL_MAX_BATCH_TOKENS,
+        batch_wait: float = LOCAL_BATCH_WAIT,
+        admission_timeout: float = LOCAL_ADMISSION_TIMEOUT
+    ) -> None:
+        self.run_batch = run_batch
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_queue = max(1, max_queue)
+        self.max_batch_tokens = max_batch_tokens
+        self.batch_wait = batch_wait
+        self.admission_timeout = admission_timeout
+        self._queue: Deque[GenerationRequest] = deque()
+        self._cond = threading.Condition()
+        self._worker: Optional[threading.Thread] = None
+        # Metrics
+        self.batches = 0
+        self.batched_requests = 0
+        self.rejected = 0
+        self.max_batch_seen = 0
+
+    def submit(self, request: GenerationRequest) -> GenerationRequest:
+        deadline = time.monotonic() + self.admission_timeout
+        with self._cond:
+            while len(self._queue) >= self.max_queue:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.rejected += 1
+                    raise QueueFullError(f"Local model is busy ({len(self._queue)} requests queued), try again later")
+                self._cond.wait(remaining)
+            request.enqueued_at = time.monotonic()
+            self._queue.append(request)
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._loop, name="local-vlm-scheduler", daemon=True)
+                self._worker.start()
+            self._cond.notify_all()
+        return request
+
+    def _compatible(self, first: GenerationRequest, other: GenerationRequest) -> bool:
+        return other.max_new_tokens == first.max_new_tokens
+
+    def _take_batch(self) -> List[GenerationRequest]:
+        first = self._queue.popleft()
+        batch = [first]
+        longest = first.tokens
+        rest: Deque[GenerationRequest] = deque()
+        while self._queue:
+            request = self._queue.popleft()
+            padded = max(longest, request.tokens) * (len(batch) + 1)
+            if len(batch) < self.max_batch_size and self._compatible(first, request) and padded <= self.max_batch_tokens:
+                batch.append(request)
+                longest = max(longest, request.tokens)
+            else:
+                rest.append(request)
+        self._queue = rest
+        return batch
+
+    def _loop(self) -> None:
+        while True:
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait()
+                # Give concurrent sessions a moment to join the batch
+                while len(self._queue) < self.max_batch_size:
+                    wait = self.batch_wait - (time.monotonic() - self._queue[0].enqueued_at)
+                    if wait <= 0:
+                        break
+                    self._cond.wait(wait)
+                batch = self._take_batch()
+                # Freed queue slots
+                self._cond.notify_all()
+            # Requests cancelled while queued never reach the model
+            for request in batch:
+                if request.cancelled:
+                    request.streamer.end()
+            batch = [r for r in batch if not r.cancelled]
+            if not batch:
+                continue
+            self.batches += 1
+            self.batched_requests += len(batch)
+            self.max_batch_seen = max(self.max_batch_seen, len(batch))
+            logger.info(f"Local batch: size={len(batch)}, tokens={[r.tokens for r in batch]}, queued={len(self._queue)}")
+            try:
+                self.run_batch(batch)
+            except Exception as e:
+                logger.error(f"Local batch failed: {e}")
+                for request in batch:
+                    request.fail(e)
+
+    def stats(self) -> dict:
+        with self._cond:
+            queued = len(self._queue)
+        return {
+            "queued": queued,
+            "batches": self.batches,
+            "requests": self.batched_requests,
+            "rejected": self.rejected,
+            "max_batch": self.max_batch_seen
+        }
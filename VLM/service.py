@@ -3,54 +3,68 @@ import os
 import base64
 import logging
 import requests
-from typing import Dict, List, Any, Optional, Iterator
+from urllib.parse import urlparse
+import asyncio
+from typing import Dict, List, Any, Optional, Iterator, AsyncIterator
 
 logger = logging.getLogger("VLMService")
 
 import io
-import torch
 from PIL import Image
-from transformers import Qwen2VLForConditionalGeneration, AutoProcessor, BitsAndBytesConfig
+from .skill_registry import skill_registry
 
-def get_skill_categories() -> Dict[str, Any]:
+def get_skill_categories() -> str:
     """
     Get skill categories for different models.
     Including skill name and skill description.
     """
-    skills = {}
-    if not os.path.exists("VLM/skills"):
-        return skills
-    for skill in os.listdir("VLM/skills"):
-        skill_path = os.path.join("VLM/skills", skill, "skill.md")
-        if os.path.exists(skill_path):
-            with open(skill_path, "r", encoding="utf-8") as f:
-                skills[skill] = "".join(f.readlines()[0:4])
-    return json.dumps(skills, indent=4)
+    return skill_registry.catalog()
 
 def get_skill(category: str) -> str:
     """
     Get skill for different models.
     """
-    path = f"VLM/skills/{category}/skill.md"
-    if os.path.exists(path):
-        with open(path, "r", encoding="utf-8") as f:
-            return f.read()
-    return ""
-
-# Attempt imports for specific providers
-try:
-    from openai import OpenAI
-except ImportError:
-    OpenAI = None
+    skill = skill_registry.get(category)
+    return skill.content if skill else ""
+
+async def iterate_in_thread(iterator: Iterator[Any]) -> AsyncIterator[Any]:
+    """
+    Consume a blocking iterator from a worker thread, one item at a time.
+    """
+    done = object()
+    while True:
+        item = await asyncio.to_thread(next, iterator, done)
+        if item is done:
+            return
+        yield item
+
+def __getattr__(name: str) -> Any:
+    # LocalVLMService pulls in torch/transformers, so it is only imported when first asked for
+    if name == "LocalVLMService":
+        from .local import LocalVLMService
+        return LocalVLMService
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+# Shared, pooled OpenAI clients (None if openai is not installed)
+from .client import get_client, get_async_client, OpenAI, AsyncOpenAI
+from .image_cache import image_cache
+from .preprocess import ImagePreprocessor
+from .context import ContextBudget
+from ratelimit import get_limiter, is_throttle_error
+from cancellation import CancellationToken
 
 class VLMService:
     """
     VLM service for different models (API Based).
     """
+    # Image budgets: min/max_pixels and image_factor follow the model's vision patching,
+    # image_format is "auto" (PNG for diagrams, JPEG for photos), "PNG", "JPEG" or "WEBP"
     model_config = {
-        "qvq-72b-preview": {"base_url": "https://dashscope.aliyuncs.com/compatible-mode/v1", "api_key_env": "VLM_API_KEY"},
-        "qwen2.5-math-1.5b-instruct": {"base_url": "https://dashscope.aliyuncs.com/compatible-mode/v1", "api_key_env": "VLM_API_KEY"}, # User example model
-        "qwen3-vl-plus": {"base_url": "https://dashscope.aliyuncs.com/compatible-mode/v1", "api_key_env": "VLM_API_KEY"},
+        "qvq-72b-preview": {"base_url": "https://dashscope.aliyuncs.com/compatible-mode/v1", "api_key_env": "VLM_API_KEY", "min_pixels": 4 * 28 * 28, "max_pixels": 1280 * 28 * 28, "image_factor": 28, "image_format": "auto", "context_budget": 16000},
+        "qwen2.5-math-1.5b-instruct": {"base_url": "https://dashscope.aliyuncs.com/compatible-mode/v1", "api_key_env": "VLM_API_KEY", "min_pixels": 4 * 28 * 28, "max_pixels": 1280 * 28 * 28, "image_factor": 28, "image_format": "auto", "context_budget": 3000}, # User example model
+        "qwen3-vl-plus": {"base_url": "https://dashscope.aliyuncs.com/compatible-mode/v1", "api_key_env": "VLM_API_KEY", "min_pixels": 4 * 32 * 32, "max_pixels": 1280 * 32 * 32, "image_factor": 32, "image_format": "auto", "context_budget": 24000},
+        # Local model served by LocalVLMService, images go to the Qwen2-VL processor
+        "Qwen2-VL-7B-Instruct": {"base_url": None, "api_key_env": "VLM_API_KEY", "min_pixels": 256 * 28 * 28, "max_pixels": 1024 * 28 * 28, "image_factor": 28, "context_budget": 8000},
     }
     
     def __init__(self, model_name: str) -> None:
@@ -70,10 +84,42 @@ class VLMService:
              # Try fallback to specific env requested by user usage example
              self.api_key = os.getenv("DASHSCOPE_API_KEY") 
 
+        self.preprocessor = ImagePreprocessor.from_config(self.config)
+        self.context_budget = ContextBudget.from_config(self.config, self.preprocessor)
+        # One limiter per endpoint host, shared by every model served from it
+        self.limiter = get_limiter("vlm:" + (urlparse(self.config["base_url"]).netloc if self.config["base_url"] else "local"))
+
     def _image_to_base64(self, image: Image.Image) -> str:
-        buffered = io.BytesIO()
-        image.save(buffered, format="PNG")
-        return base64.b64encode(buffered.getvalue()).decode("utf-8")
+        # Content-addressed, so images resent every round are only encoded once
+        return image_cache.encode_base64(image, format="PNG")
+
+    def _preprocess_images(self, images: Optional[List[Image.Image]]) -> List[Image.Image]:
+        """
+        Downscale images to this model's pixel budget before submission.
+        """
+        return [self.preprocessor.resize(img) for img in images if img] if images else []
+
+    def _build_chat_messages(self, messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        Convert {"role", "content", "images"} messages into the OpenAI chat format.
+        """
+        built = []
+        for message in messages:
+            images = [img for img in message.get("images") or [] if img]
+            if not images and message["role"] != "user":
+                built.append({"role": message["role"], "content": message["content"]})
+                continue
+            content = [{"type": "text", "text": message["content"]}]
+            for img in images:
+                content.append({
+                    "type": "image_url",
+                    "image_url": {"url": self.preprocessor.to_data_url(img)}
+                })
+            built.append({"role": message["role"], "content": content})
+        return built
+
+    def _build_messages(self, prompt: str, images: Optional[List[Image.Image]] = None) -> List[Dict[str, Any]]:
+        return self._build_chat_messages([{"role": "user", "content": prompt, "images": images}])
 
     def generate_text(self, prompt: str, images: Optional[List[Image.Image]] = None) -> str:
         logger.info(f"VLM Request Start: model={self.model_name}, prompt_length={len(prompt)}, num_images={len(images) if images else 0}")
@@ -83,30 +129,16 @@ class VLMService:
             return json.dumps({"error": error_msg})
 
         try:
-            client = OpenAI(
-                api_key=self.api_key,
-                base_url=self.config["base_url"]
-            )
-            
-            messages = [{
-                "role": "user", 
-                "content": [{"type": "text", "text": prompt}]
-            }]
-            
-            # Append images if provided
-            if images:
-                for img in images:
-                    b64_image = self._image_to_base64(img)
-                    messages[0]["content"].append({
-                        "type": "image_url",
-                        "image_url": {"url": f"data:image/png;base64,{b64_image}"}
-                    })
+            client = get_client(self.config["base_url"], self.api_key)
+            messages = self._build_messages(prompt, images)
 
             logger.info(f"VLM Request: model={self.model_name}, prompt_length={len(prompt)}, num_images={len(images) if images else 0}")
+            self.limiter.acquire()
             completion = client.chat.completions.create(
                 model=self.model_name,
                 messages=messages
             )
+            self.limiter.on_success()
             
             response_text = completion.choices[0].message.content
             logger.info(f"VLM Response: success, length={len(response_text)}, excerpt={response_text[:100]}...")
@@ -114,152 +146,166 @@ class VLMService:
 
         except Exception as e:
             logger.error(f"VLM Response: error={str(e)}")
+            self._record_error(e)
             return json.dumps({"error": str(e)})
 
-    def generate_stream(self, prompt: str, images: Optional[List[Image.Image]] = None) -> Iterator[str]:
-        num_images = len(images) if images else 0
-        logger.info(f"VLM Stream Start: model={self.model_name}, prompt_length={len(prompt)}, num_images={num_images}")
+    def generate_stream(self, prompt: str, images: Optional[List[Image.Image]] = None, cancel: Optional[CancellationToken] = None) -> Iterator[str]:
+        return self.generate_chat_stream([{"role": "user", "content": prompt, "images": images}], cancel)
+
+    def generate_chat_stream(self, messages: List[Dict[str, Any]], cancel: Optional[CancellationToken] = None) -> Iterator[str]:
+        """
+        Stream the completion. Cancelling the token closes the HTTP stream.
+        """
+        num_images = sum(len(m.get("images") or []) for m in messages)
+        logger.info(f"VLM Stream Start: model={self.model_name}, messages={len(messages)}, num_images={num_images}")
         if not OpenAI:
             yield "openai library not installed."
             return
 
         try:
-            client = OpenAI(
-                api_key=self.api_key,
-                base_url=self.config["base_url"]
-            )
-            
-            messages = [{
-                "role": "user", 
-                "content": [{"type": "text", "text": prompt}]
-            }]
-            
-            if images:
-                for img in images:
-                    b64_image = self._image_to_base64(img)
-                    messages[0]["content"].append({
-                        "type": "image_url",
-                        "image_url": {"url": f"data:image/png;base64,{b64_image}"}
-                    })
+            client = get_client(self.config["base_url"], self.api_key)
+            messages = self._build_chat_messages(messages)
+
+            if num_images:
+                logger.info(f"Image cache stats: {image_cache.stats()}")
 
+            self.limiter.acquire()
+            if cancel is not None and cancel.cancelled:
+                return
             completion = client.chat.completions.create(
                 model=self.model_name,
                 messages=messages,
                 stream=True
             )
+            self.limiter.on_success()
             
-            for chunk in completion:
-                if not chunk.choices: continue
-                delta = chunk.choices[0].delta
-                # Handle varying field names for reasoning content in different API providers
-                content = (getattr(delta, "content", None) or 
-                           getattr(delta, "reasoning_content", None) or
-                           getattr(delta, "reasoning", None) or
-                           (delta.model_extra.get("reasoning") if hasattr(delta, "model_extra") and delta.model_extra else None))
-                
-                if content:
-                    yield content
+            # Closing the response also interrupts a read that is waiting for the next chunk
+            unregister = cancel.on_cancel(completion.close) if cancel is not None else None
+            try:
+                for chunk in completion:
+                    if cancel is not None and cancel.cancelled:
+                        break
+                    content = self._chunk_text(chunk)
+                    if content:
+                        yield content
+            finally:
+                if unregister:
+                    unregister()
+                completion.close()
 
         except Exception as e:
+            if cancel is not None and cancel.cancelled:
+                logger.info(f"VLM Stream cancelled: model={self.model_name}")
+                return
             logger.error(f"VLM Stream Error: {e}")
+            self._record_error(e)
             yield f"Error: {str(e)}"
 
-class LocalVLMService(VLMService):
-    """
-    Local VLM service running Qwen2-VL.
-    """
-    _model = None
-    _processor = None
-
-    def __init__(self, model_name: str) -> None: 
-        super().__init__(model_name)
-        self.device = "cuda" if torch.cuda.is_available() else "cpu"
-        self._load_model()
+    async def agenerate_text(self, prompt: str, images: Optional[List[Image.Image]] = None) -> str:
+        logger.info(f"VLM Async Request Start: model={self.model_name}, prompt_length={len(prompt)}, num_images={len(images) if images else 0}")
+        if not AsyncOpenAI:
+            error_msg = "openai library not installed. Install with `pip install openai`"
+            logger.error(error_msg)
+            return json.dumps({"error": error_msg})
 
-    def _load_model(self):
-        if LocalVLMService._model is None:
-            model_id = "Qwen/Qwen2-VL-7B-Instruct"
-            
-            # 4-bit quantization configuration
-            quantization_config = BitsAndBytesConfig(
-               load_in_4bit=True,
-               bnb_4bit_quant_type="nf4",
-               bnb_4bit_compute_dtype=torch.float16
+        try:
+            client = get_async_client(self.config["base_url"], self.api_key)
+            # Resizing and encoding are CPU bound, keep them off the event loop
+            messages = await asyncio.to_thread(self._build_messages, prompt, images)
+            await self.limiter.aacquire()
+            completion = await client.chat.completions.create(
+                model=self.model_name,
+                messages=messages
             )
+            self.limiter.on_success()
             
-            LocalVLMService._processor = AutoProcessor.from_pretrained(model_id)
-            LocalVLMService._model = Qwen2VLForConditionalGeneration.from_pretrained(
-                model_id, 
-                torch_dtype="auto", 
-                device_map="auto",
-                quantization_config=quantization_config
-            )
+            response_text = completion.choices[0].message.content
+            logger.info(f"VLM Async Response: success, length={len(response_text)}, excerpt={response_text[:100]}...")
+            return response_text
 
-    def generate_stream(self, prompt: str, images: Optional[List[Image.Image]] = None) -> Iterator[str]:
-        from transformers import TextIteratorStreamer
-        from threading import Thread
+        except Exception as e:
+            logger.error(f"VLM Async Response: error={str(e)}")
+            self._record_error(e)
+            return json.dumps({"error": str(e)})
 
-        logger.info(f"VLM Stream Request Start: model={self.model_name}, prompt_length={prompt}, num_images={len(images) if images else 0}")
-        messages = [{"role": "system", "content": [{"type": "text", "text": prompt}]}]
-        if images:
-            for img in images:
-                messages[0]["content"].insert(0, {"type": "image", "image": img})
+    def agenerate_stream(self, prompt: str, images: Optional[List[Image.Image]] = None, cancel: Optional[CancellationToken] = None) -> AsyncIterator[str]:
+        return self.agenerate_chat_stream([{"role": "user", "content": prompt, "images": images}], cancel)
 
-        text = self._processor.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
-        
-        if images:
-            inputs = self._processor(text=[text], images=images, padding=True, return_tensors="pt").to(self.device)
-        else:
-            inputs = self._processor(text=[text], padding=True, return_tensors="pt").to(self.device)
+    async def agenerate_chat_stream(self, messages: List[Dict[str, Any]], cancel: Optional[CancellationToken] = None) -> AsyncIterator[str]:
+        num_images = sum(len(m.get("images") or []) for m in messages)
+        logger.info(f"VLM Async Stream Start: model={self.model_name}, messages={len(messages)}, num_images={num_images}")
+        if not AsyncOpenAI:
+            yield "openai library not installed."
+            return
 
-        streamer = TextIteratorStreamer(self._processor.tokenizer, skip_special_tokens=True, skip_prompt=True)
-        generation_kwargs = dict(inputs, streamer=streamer, max_new_tokens=512)
-        
-        thread = Thread(target=self._model.generate, kwargs=generation_kwargs)
-        thread.start()
+        try:
+            client = get_async_client(self.config["base_url"], self.api_key)
+            # Resizing and encoding are CPU bound, keep them off the event loop
+            messages = await asyncio.to_thread(self._build_chat_messages, messages)
 
-        for new_text in streamer:
-            yield new_text
+            await self.limiter.aacquire()
+            if cancel is not None and cancel.cancelled:
+                return
+            completion = await client.chat.completions.create(
+                model=self.model_name,
+                messages=messages,
+                stream=True
+            )
+            self.limiter.on_success()
+            
+            # The token may be cancelled from any thread, the close runs on this loop
+            loop = asyncio.get_running_loop()
+            unregister = cancel.on_cancel(lambda: asyncio.run_coroutine_threadsafe(completion.close(), loop)) if cancel is not None else None
+            try:
+                async for chunk in completion:
+                    if cancel is not None and cancel.cancelled:
+                        break
+                    content = self._chunk_text(chunk)
+                    if content:
+                        yield content
+            finally:
+                if unregister:
+                    unregister()
+                await completion.close()
 
-    def generate_text(self, prompt: str, images: Optional[List[Image.Image]] = None) -> str:
-        messages = [
-            {
-                "role": "user",
-                "content": [
-                    {"type": "text", "text": prompt},
-                ],
-            }
-        ]
-        if images:
-            for img in images:
-                messages[0]["content"].insert(0, {"type": "image", "image": img})
+        except Exception as e:
+            if cancel is not None and cancel.cancelled:
+                logger.info(f"VLM Async Stream cancelled: model={self.model_name}")
+                return
+            logger.error(f"VLM Async Stream Error: {e}")
+            self._record_error(e)
+            yield f"Error: {str(e)}"
 
-        # Prepare inputs
-        logger.info(f"Local VLM Request: model=Qwen2-VL-7B, prompt_length={len(prompt)}, num_images={len(images) if images else 0}")
-        
-        # Preparation for inference
-        text = self._processor.apply_chat_template(
-            messages, tokenize=False, add_generation_prompt=True
-        )
-        
-        if images:
-            inputs = self._processor(
-                text=[text], images=images, padding=True, return_tensors="pt"
-            ).to(self.device)
-        else:
-            inputs = self._processor(
-                text=[text], padding=True, return_tensors="pt"
-            ).to(self.device)
-
-        # Generate!
-        generated_ids = self._model.generate(**inputs, max_new_tokens=512)
-        generated_ids_trimmed = [
-            out_ids[len(in_ids) :] for in_ids, out_ids in zip(inputs.input_ids, generated_ids)
-        ]
-        output_text = self._processor.batch_decode(
-            generated_ids_trimmed, skip_special_tokens=True, clean_up_tokenization_spaces=False
-        )
-        
-        response_text = output_text[0]
-        logger.info(f"Local VLM Response: success, length={len(response_text)}, excerpt={response_text}...")
-        return response_text
+    def health_check(self) -> bool:
+        """
+        Cheap one-token request that also opens a pooled connection to the endpoint.
+        """
+        if not OpenAI or not self.api_key:
+            return False
+        try:
+            client = get_client(self.config["base_url"], self.api_key)
+            client.chat.completions.create(
+                model=self.model_name,
+                messages=[{"role": "user", "content": "ping"}],
+                max_tokens=1
+            )
+            return True
+        except Exception as e:
+            logger.warning(f"VLM health check failed: model={self.model_name}, error={e}")
+            self._record_error(e)
+            return False
+
+    def _record_error(self, error: Exception) -> None:
+        if is_throttle_error(error):
+            self.limiter.on_throttle()
+
+    @staticmethod
+    def _chunk_text(chunk: Any) -> Optional[str]:
+        if not chunk.choices:
+            return None
+        delta = chunk.choices[0].delta
+        # Handle varying field names for reasoning content in different API providers
+        return (getattr(delta, "content", None) or 
+                getattr(delta, "reasoning_content", None) or
+                getattr(delta, "reasoning", None) or
+                (delta.model_extra.get("reasoning") if hasattr(delta, "model_extra") and delta.model_extra else None))
@@ -0,0 +1,155 @@
+import os
+import json
+import hashlib
+import time
+import threading
+import logging
+from dataclasses import dataclass, field
+from typing import Dict, Any, Optional, Tuple
+
+logger = logging.getLogger("SkillRegistry")
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+SKILLS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "skills")
+# Minimum seconds between mtime checks of the skill files
+SKILL_CHECK_INTERVAL = float(os.getenv("SKILL_CHECK_INTERVAL", "2"))
+
+@dataclass
+class Skill:
+    name: str
+    description: str
+    content: str # Whole skill.md, front-matter included
+    body: str # Instructions after the front-matter
+    metadata: Dict[str, Any] = field(default_factory=dict)
+
+def parse_front_matter(text: str) -> Tuple[Dict[str, Any], str]:
+    """
+    Split a skill.md into its YAML front-matter and body.
+    """
+    if not text.startswith("---"):
+        return {}, text
+    end = text.find("\n---", 3)
+    if end == -1:
+        return {}, text
+    raw = text[3:end]
+    body = text[end + 4:].lstrip("\n")
+    if yaml is not None:
+        try:
+            data = yaml.safe_load(raw) or {}
+            return (data if isinstance(data, dict) else {}), body
+        except yaml.YAMLError as e:
+            logger.warning(f"Invalid skill front-matter: {e}")
+    # Plain "key: value" lines without PyYAML
+    data = {}
+    for line in raw.splitlines():
+        key, sep, value = line.partition(":")
+        if sep:
+            data[key.strip()] = value.strip()
+    return data, body
+
+class SkillRegistry:
+    """
+    Skills from VLM/skills/<name>/skill.md, parsed once and cached together with the rendered
+    skill-selection block. Files are re-read when their mtimes change or on reload().
+    """
+    def __init__(self, directory: str = SKILLS_DIR, check_interval: float = SKILL_CHECK_INTERVAL) -> None:
+        self.directory = directory
+        self.check_interval = check_interval
+        self._skills: Dict[str, Skill] = {}
+        self._catalog = "{}"
+        self._version = ""
+        self._signature: Optional[Tuple] = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def _scan(self) -> Tuple:
+        """
+        (name, mtime, size) of every skill file, used to detect changes.
+        """
+        entries = []
+        try:
+            names = sorted(os.listdir(self.directory))
+        except FileNotFoundError:
+            return ()
+        for name in names:
+            path = os.path.join(self.directory, name, "skill.md")
+            try:
+                st = os.stat(path)
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            entries.append((name, st.st_mtime_ns, st.st_size))
+        return tuple(entries)
+
+    def _load(self, signature: Tuple) -> None:
+        skills = {}
+        for name, _, _ in signature:
+            path = os.path.join(self.directory, name, "skill.md")
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    content = f.read()
+            except OSError as e:
+                logger.warning(f"Failed to read skill {name}: {e}")
+                continue
+            metadata, body = parse_front_matter(content)
+            skills[name] = Skill(
+                name=name,
+                description=str(metadata.get("description", "")),
+                content=content,
+                body=body,
+                metadata=metadata
+            )
+        self._skills = skills
+        self._catalog = json.dumps({name: skill.description for name, skill in skills.items()}, indent=4, ensure_ascii=False)
+        digest = hashlib.sha256()
+        for name, skill in skills.items():
+            digest.update(f"{name}\0{skill.content}\0".encode("utf-8"))
+        self._version = digest.hexdigest()[:16]
+        self._signature = signature
+        logger.info(f"Loaded {len(skills)} skills from {self.directory}")
+
+    def _refresh(self) -> None:
+        now = time.monotonic()
+        if self._signature is not None and now - self._checked_at < self.check_interval:
+            return
+        with self._lock:
+            if self._signature is not None and now - self._checked_at < self.check_interval:
+                return
+            signature = self._scan()
+            if signature != self._signature:
+                self._load(signature)
+            self._checked_at = now
+
+    def reload(self) -> None:
+        with self._lock:
+            self._load(self._scan())
+            self._checked_at = time.monotonic()
+
+    def catalog(self) -> str:
+        """
+        Rendered skill-selection block: JSON mapping skill name to description.
+        """
+        self._refresh()
+        return self._catalog
+
+    @property
+    def version(self) -> str:
+        """
+        Digest of every skill file, changes whenever a skill is edited, added or removed.
+        """
+        self._refresh()
+        return self._version
+
+    def get(self, name: str) -> Optional[Skill]:
+        self._refresh()
+        return self._skills.get(name)
+
+    def names(self) -> list:
+        self._refresh()
+        return list(self._skills)
+
+# Shared by every agent in the process
+skill_registry = SkillRegistry()
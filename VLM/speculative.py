@@ -0,0 +1,115 @@
+import os
+import re
+import threading
+import logging
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger("Speculative")
+
+IMAGE_SPECULATIVE = os.getenv("IMAGE_SPECULATIVE", "1").lower() not in ("0", "false", "no")
+# Speculative generations started per skill output, the rest wait for the tool_list as before
+IMAGE_SPECULATIVE_MAX = int(os.getenv("IMAGE_SPECULATIVE_MAX", "4"))
+
+# "- Image Name: Image Prompt", as the skills ask for it
+DIRECTIVE = re.compile(r"^\s*[-*]\s+(?!\[)(?P<name>[^:\n]{1,80}?)\s*:\s*(?P<prompt>\S.{7,})$")
+# Plain bullets ("- Step 1: ...") use the same shape, only visual ones are generated
+VISUAL_WORDS = re.compile(r"\b(image|figure|fig|diagram|graph|plot|chart|sketch|illustration|visuali[sz]ation|drawing|draw|depict)", re.IGNORECASE)
+
+_speculative_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="image-speculative")
+
+def normalize_prompt(text: str) -> str:
+    return " ".join(re.sub(r"[*_`]", "", text).lower().split()).strip(" .")
+
+def parse_directive(line: str) -> Optional[Tuple[str, str]]:
+    """
+    (name, prompt) of an image directive line, or None.
+    """
+    match = DIRECTIVE.match(line)
+    if not match:
+        return None
+    name = match.group("name").strip(" *_`")
+    prompt = match.group("prompt").strip(" *_`")
+    if not VISUAL_WORDS.search(name) and not VISUAL_WORDS.search(prompt):
+        return None
+    return name, prompt
+
+class LineScanner:
+    """
+    Turns a stream of chunks into complete lines.
+    """
+    def __init__(self) -> None:
+        self._partial = ""
+
+    def feed(self, chunk: str) -> List[str]:
+        text = self._partial + chunk
+        lines = text.split("\n")
+        self._partial = lines.pop()
+        return lines
+
+    def flush(self) -> List[str]:
+        rest, self._partial = self._partial, ""
+        return [rest] if rest.strip() else []
+
+class SpeculativeImages:
+    """
+    Image generations started from the directives of a skill output while it streams,
+    before the next round's skill selection turns them into a tool_list. Each result is
+    indexed by its normalized prompt and handed out once to the generate_image call with
+    the same prompt; a figure name alone is not enough, the same figure is often redrawn
+    differently. Unclaimed ones are dropped when the next skill output starts or the run
+    ends, queued ones are cancelled then.
+    """
+    def __init__(self, generate: Callable[[str], Dict[str, Any]], max_per_output: int = IMAGE_SPECULATIVE_MAX) -> None:
+        self.generate = generate
+        self.max_per_output = max_per_output
+        self._futures: Dict[str, Future] = {}
+        self._started = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.started = 0
+
+    def reset(self) -> None:
+        with self._lock:
+            futures = list(self._futures.values())
+            self._futures = {}
+            self._started = 0
+        for future in futures:
+            future.cancel()
+
+    def scan(self, line: str) -> Optional[Future]:
+        """
+        Start generating the image of a directive line, returns its future if one was started.
+        """
+        directive = parse_directive(line)
+        if directive is None:
+            return None
+        prompt = f"{directive[0]}: {directive[1]}"
+        key = normalize_prompt(prompt)
+        with self._lock:
+            if key in self._futures or self._started >= self.max_per_output:
+                return None
+            future = _speculative_executor.submit(self.generate, prompt)
+            self._started += 1
+            self.started += 1
+            self._futures[key] = future
+        logger.info(f"Speculative image started: {prompt[:80]}")
+        return future
+
+    def take(self, prompt: str) -> Optional[Future]:
+        """
+        Claim the speculative result for a generate_image prompt, if there is one.
+        """
+        with self._lock:
+            # Handed out once
+            future = self._futures.pop(normalize_prompt(prompt), None)
+            if future is not None and not future.cancelled():
+                self.hits += 1
+                return future
+            self.misses += 1
+            return None
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"pending": len(self._futures), "started": self.started, "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,172 @@
+import json
+import logging
+from typing import Any, Dict, List, Optional, Tuple
+
+logger = logging.getLogger("StreamParser")
+
+class IncrementalJSONParser:
+    """
+    Incremental parser for the stage-1 JSON response.
+    Feed it stream chunks; it reports every top-level field as soon as its value is complete,
+    and every entry of the list field (tool_list by default) as soon as that entry is closed.
+    Text before the object (reasoning, ```json fences) is skipped.
+    """
+    def __init__(self, list_field: str = "tool_list") -> None:
+        self.list_field = list_field
+        self.fields: Dict[str, Any] = {}
+        self.items: List[Any] = []
+        self._text = ""
+        self._pos = 0
+        self._reset_object()
+
+    def _reset_object(self) -> None:
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._expect_key = False
+        self._key_start: Optional[int] = None
+        self._key: Optional[str] = None
+        self._value_start: Optional[int] = None
+        self._item_start: Optional[int] = None
+
+    def feed(self, chunk: str) -> List[Tuple[str, Any, Any]]:
+        """
+        Consume a chunk and return the events it completed:
+        ("field", name, value) and ("item", index, value).
+        """
+        events: List[Tuple[str, Any, Any]] = []
+        if not chunk:
+            return events
+        self._text += chunk
+        text = self._text
+        i = self._pos
+        while i < len(text):
+            c = text[i]
+            # A fence quoted inside a string value is just text
+            if c == "`" and not self._in_string:
+                if text.startswith("```json", i):
+                    # A fenced block starts the real answer, drop anything half-parsed before it
+                    self._reset_object()
+                    i += len("```json")
+                    continue
+                if "```json".startswith(text[i:]):
+                    # Possibly a fence split across chunks, wait for more text
+                    break
+            if self._depth == 0:
+                if c == "{":
+                    self._depth = 1
+                    self._expect_key = True
+                i += 1
+                continue
+
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif c == "\\":
+                    self._escape = True
+                elif c == '"':
+                    self._in_string = False
+                    if self._key_start is not None:
+                        self._key = self._loads(text[self._key_start:i + 1])
+                        self._key_start = None
+                i += 1
+                continue
+
+            if c == '"':
+                self._in_string = True
+                if self._depth == 1 and self._expect_key:
+                    self._key_start = i
+                    self._expect_key = False
+                elif self._depth == 1 and self._value_start is None:
+                    self._value_start = i
+            elif c == ":" and self._depth == 1:
+                self._value_start = None
+            elif c in "{[":
+                if self._depth == 1 and self._value_start is None:
+                    self._value_start = i
+                self._depth += 1
+                if c == "{" and self._depth == 3 and self._key == self.list_field and self._item_start is None:
+                    self._item_start = i
+            elif c in "}]":
+                self._depth -= 1
+                if c == "}" and self._depth == 2 and self._item_start is not None:
+                    item = self._loads(text[self._item_start:i + 1])
+                    self._item_start = None
+                    if item is not None:
+                        self.items.append(item)
+                        events.append(("item", len(self.items) - 1, item))
+                elif self._depth == 0:
+                    self._finish_field(text, i, events)
+                    self._reset_object()
+            elif c == "," and self._depth == 1:
+                self._finish_field(text, i, events)
+                self._expect_key = True
+            elif self._depth == 1 and self._value_start is None and not c.isspace():
+                self._value_start = i
+            i += 1
+        self._pos = i
+        return events
+
+    def _finish_field(self, text: str, end: int, events: List[Tuple[str, Any, Any]]) -> None:
+        if self._key is None or self._value_start is None:
+            return
+        raw = text[self._value_start:end].strip()
+        try:
+            value = json.loads(raw)
+        except json.JSONDecodeError:
+            logger.warning(f"Incremental parse failed for field {self._key}")
+        else:
+            self.fields[self._key] = value
+            events.append(("field", self._key, value))
+        self._key = None
+        self._value_start = None
+
+    def _loads(self, raw: str) -> Any:
+        try:
+            return json.loads(raw)
+        except json.JSONDecodeError:
+            return None
+
+class SectionSplitter:
+    """
+    Splits a stream at the first occurrence of a delimiter. feed returns the (before, after)
+    text of each chunk; a tail that may be the start of a delimiter split across chunks is
+    held back until the next chunk or flush.
+    """
+    def __init__(self, delimiter: str) -> None:
+        self.delimiter = delimiter
+        self.split = False
+        self._pending = ""
+        self._strip = False
+
+    def feed(self, chunk: str) -> Tuple[str, str]:
+        if self.split:
+            return "", self._after(chunk)
+        text = self._pending + chunk
+        index = text.find(self.delimiter)
+        if index != -1:
+            self.split = True
+            self._pending = ""
+            self._strip = True
+            return text[:index], self._after(text[index + len(self.delimiter):])
+        keep = 0
+        for k in range(min(len(self.delimiter) - 1, len(text)), 0, -1):
+            if self.delimiter.startswith(text[-k:]):
+                keep = k
+                break
+        self._pending = text[len(text) - keep:]
+        return text[:len(text) - keep], ""
+
+    def _after(self, text: str) -> str:
+        # Drop the line break that ends the delimiter line
+        if self._strip:
+            text = text.lstrip("\r\n")
+            self._strip = not text
+        return text
+
+    def flush(self) -> str:
+        """
+        Text held back before the delimiter, once the stream has ended.
+        """
+        rest, self._pending = self._pending, ""
+        return rest
@@ -1,15 +1,24 @@
 import os
+import asyncio
 import base64
 import json
 import io
 import time
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from dataclasses import dataclass
-from typing import Optional, Iterator, Dict, List, Any
+from concurrent.futures import Future, ThreadPoolExecutor, FIRST_COMPLETED, wait
+from contextlib import closing, aclosing
+from dataclasses import dataclass, field
+from typing import Optional, Iterator, AsyncIterator, Callable, Dict, List, Any, Tuple
 from PIL import Image
 from . import memory
-from .service import get_skill_categories, get_skill, VLMService, LocalVLMService
-from prompt import SKILL_SELECTION_PROMPT, RESPONSE_PROMPT, STAGE_PROMPT, TOOLS_PROMPT
+from . import service
+from .service import VLMService
+from .stream_parser import IncrementalJSONParser, SectionSplitter
+from .context import ContextBudget
+from .prompt_builder import PromptBuilder, FUSED_DELIMITER, prompt_version
+from .speculative import SpeculativeImages, LineScanner, IMAGE_SPECULATIVE
+from .run_cache import run_cache
+from ratelimit import limiter_metrics
+from cancellation import CancellationToken
 import logging
 
 logger = logging.getLogger("VLM")
@@ -20,67 +29,394 @@ class VlmStep:
     message: str
     images: List[Any] # List of PIL Images or similar
     is_final: bool = False
+    # Streaming steps only carry the new text here and leave message empty;
+    # final steps carry the whole stage text in message
+    delta: str = ""
+    # SkillSelection/Stage of a streaming selection, as soon as they are parsed
+    selection: Dict[str, str] = field(default_factory=dict)
+
+class RoundSteps:
+    """
+    VlmSteps of one round, built from the fragments of the agent's streams.
+    Shared by the sync and async loops of VlmRun, which only differ in how they iterate.
+    """
+    def __init__(self, run: "VlmRun") -> None:
+        self.run = run
+        # Selection context of the round, then the next memory context of a fused round
+        self.memory_data: Optional[Dict[str, Any]] = None
+        self.result: Optional[Dict[str, Any]] = None
+        self.skill_chunks: List[str] = []
+        self.run_chunks: List[str] = []
+
+    def _generated(self) -> List[Any]:
+        return self.memory_data.get("GeneratedImages", []) if self.memory_data else []
+
+    def _selecting_step(self, fragment: str) -> VlmStep:
+        self.skill_chunks.append(fragment)
+        return VlmStep(stage="Selecting Skill", message="", images=[], delta=fragment, selection=dict(self.run.agent.selection))
+
+    def selecting(self, fragment: Any) -> Optional[VlmStep]:
+        if isinstance(fragment, str):
+            return self._selecting_step(fragment)
+        self.memory_data = fragment
+        return None
+
+    def selected(self) -> Iterator[VlmStep]:
+        yield VlmStep(stage="Selecting Skill", message="".join(self.skill_chunks), images=self._generated(), is_final=True)
+        if not self.memory_data:
+            self.run.done = True
+            yield VlmStep(stage="Error", message="Failed to select skill", images=[])
+
+    def running(self, fragment: Any) -> Optional[VlmStep]:
+        if isinstance(fragment, str):
+            self.run_chunks.append(fragment)
+            return VlmStep(stage=self.memory_data["Stage"], message="", images=self._generated(), delta=fragment)
+        return None
+
+    def finished(self) -> Iterator[VlmStep]:
+        yield from self._stage_result(self._generated())
+
+    def fused(self, fragment: Any) -> Optional[VlmStep]:
+        if isinstance(fragment, str):
+            if self.memory_data is None:
+                return self._selecting_step(fragment)
+            self.run_chunks.append(fragment)
+            return VlmStep(stage=self.memory_data["Stage"], message="", images=[], delta=fragment)
+        if self.memory_data is None:
+            self.memory_data = fragment
+            return VlmStep(stage="Selecting Skill", message="".join(self.skill_chunks), images=[], is_final=True)
+        self.result = fragment
+        return None
+
+    def fused_finished(self) -> Iterator[VlmStep]:
+        """
+        Final steps of a fused round, the same ones the two-call flow ends a round with.
+        """
+        if self.memory_data is None or self.result is None:
+            self.run.done = True
+            yield VlmStep(stage="Error", message="Failed to run round", images=[])
+            return
+        if self.run.agent.fused_failed:
+            logger.warning("Fused reply could not be parsed, using separate selection and execution calls from now on")
+            self.run.fused = False
+        yield from self._stage_result(self.result.get("GeneratedImages", []))
+
+    def _stage_result(self, images: List[Any]) -> Iterator[VlmStep]:
+        stage = self.memory_data["Stage"]
+        text = "".join(self.run_chunks)
+        yield VlmStep(stage=stage, message=text, images=images, is_final=True)
+        if stage == "Response":
+            self.run.done = True
+            # Yield the final step for the "Response" stage
+            yield VlmStep(stage=stage, message=text, images=images, is_final=True)
 
 class VlmRun:
     """
     Iterator class to execute agent stages and return results.
     Allows for multiple rounds and self-correction.
     """
-    def __init__(self, agent: "VlmAgent"):
+    def __init__(self, agent: "VlmAgent", cancel: Optional[CancellationToken] = None):
         self.agent = agent
         self.round_count = 0
         self.max_rounds = 10
         self.done = False
+        # Shared with the agent's streams and tool calls
+        self.cancel = cancel or CancellationToken()
+        agent.cancel = self.cancel
+        # One request per round for models that support it, two (selection + execution) otherwise
+        self.fused = getattr(agent.vlm_model, "fused", False)
+
+    def _stopped(self) -> bool:
+        if self.cancel.cancelled:
+            logger.info(f"Run cancelled in round {self.round_count}: {self.cancel.reason}")
+            self.done = True
+        return self.done
+
+    def _cache_key(self) -> Optional[str]:
+        if run_cache is None:
+            return None
+        image_service = self.agent.image_service
+        image_model = getattr(image_service, "model_name", None) or type(image_service).__name__
+        input = self.agent.memory.input
+        return run_cache.key(getattr(self.agent.vlm_model, "model_name", ""), image_model, input.get("text", ""), input.get("files", []), version=prompt_version())
+
+    def _lookup(self) -> Tuple[Optional[str], Optional[List[Dict[str, Any]]]]:
+        key = self._cache_key()
+        cached = run_cache.get(key) if key else None
+        if cached is not None:
+            logger.info(f"Run cache hit: {key[:12]}, replaying {len(cached)} steps")
+        return key, cached
+
+    def _replay(self, cached: List[Dict[str, Any]]) -> Iterator[VlmStep]:
+        self.done = True
+        for step in cached:
+            yield VlmStep(stage=step["stage"], message=step["message"], images=list(step["images"]), is_final=step["is_final"])
+
+    def _store(self, key: Optional[str], recorded: List[VlmStep]) -> None:
+        """
+        Cache a run that finished with a Response, not cancelled and without errors.
+        """
+        if key is None or self.cancel.cancelled or not recorded:
+            return
+        last = recorded[-1]
+        if last.stage != "Response" or not last.is_final:
+            return
+        # Provider failures are streamed into the stage text as "Error: ..."
+        if any(step.stage == "Error" or step.message.startswith("Error:") for step in recorded):
+            return
+        run_cache.put(key, [
+            {"stage": step.stage, "message": step.message, "images": list(step.images), "is_final": step.is_final}
+            for step in recorded
+        ])
 
     def __iter__(self) -> Iterator[VlmStep]:
-        while not self.done:
-            self.round_count += 1
-            last_memory = self.agent.memory.get_latest_memory()
-            logger.info(f"Round {self.round_count}")
-            
-            if self.round_count > self.max_rounds:
-                self.done = True
-                msg = last_memory.get("Message", "") + "\n### Max rounds reached, You must change your skill to \"response\" to finish this question"
-                yield VlmStep(stage="Response", message=msg, images=[])
+        key, cached = self._lookup()
+        if cached is not None:
+            yield from self._replay(cached)
+            return
+        recorded = []
+        try:
+            for step in self._rounds():
+                if not step.delta:
+                    recorded.append(step)
+                yield step
+        finally:
+            self.agent._drop_speculative()
+        self._store(key, recorded)
+
+    async def __aiter__(self) -> AsyncIterator[VlmStep]:
+        """
+        Async counterpart of __iter__, for serving many sessions from one event loop.
+        """
+        key, cached = await asyncio.to_thread(self._lookup)
+        if cached is not None:
+            for step in self._replay(cached):
+                yield step
+            return
+        recorded = []
+        try:
+            async for step in self._arounds():
+                if not step.delta:
+                    recorded.append(step)
+                yield step
+        finally:
+            self.agent._drop_speculative()
+        self._store(key, recorded)
+
+    def _start_round(self) -> Tuple[Dict[str, Any], Optional[VlmStep]]:
+        """
+        Context of the next round, and the step that ends the run once max_rounds is exceeded.
+        """
+        self.round_count += 1
+        last_memory = self.agent.memory.get_latest_memory()
+        logger.info(f"Round {self.round_count}")
+        if self.round_count > self.max_rounds:
+            self.done = True
+            msg = last_memory.get("Message", "") + "\n### Max rounds reached, You must change your skill to \"response\" to finish this question"
+            return last_memory, VlmStep(stage="Response", message=msg, images=[])
+        return last_memory, None
+
+    @staticmethod
+    def _steps(fragments: Iterator[Any], handle: Callable[[Any], Optional[VlmStep]]) -> Iterator[VlmStep]:
+        with closing(fragments):
+            for fragment in fragments:
+                step = handle(fragment)
+                if step is not None:
+                    yield step
+
+    @staticmethod
+    async def _asteps(fragments: AsyncIterator[Any], handle: Callable[[Any], Optional[VlmStep]]) -> AsyncIterator[VlmStep]:
+        async with aclosing(fragments):
+            async for fragment in fragments:
+                step = handle(fragment)
+                if step is not None:
+                    yield step
+
+    def _rounds(self) -> Iterator[VlmStep]:
+        while not self._stopped():
+            last_memory, final = self._start_round()
+            if final is not None:
+                yield final
                 return
+            steps = RoundSteps(self)
 
-            # 1. Stream Skill Selection
-            memory_data = None
-            accumulated_skill_text = ""
-            for fragment in self.agent._select_skill_and_tools_stream(last_memory):
-                if isinstance(fragment, str):
-                    accumulated_skill_text += fragment
-                    # print(f"DEBUG: Skill Selection Fragment: {fragment}")
-                    yield VlmStep(stage="Selecting Skill", message=accumulated_skill_text, images=[])
-                else:
-                    memory_data = fragment
-            
-            # Yield final state for this stage
-            yield VlmStep(stage="Selecting Skill", message=accumulated_skill_text, images=memory_data.get("GeneratedImages", []) if memory_data else [], is_final=True)
+            if self.fused:
+                yield from self._steps(self.agent._fused_stream(last_memory), steps.fused)
+                if not self._stopped():
+                    yield from steps.fused_finished()
+                continue
 
-            if not memory_data:
-                yield VlmStep(stage="Error", message="Failed to select skill", images=[])
+            # 1. Stream Skill Selection
+            yield from self._steps(self.agent._select_skill_and_tools_stream(last_memory), steps.selecting)
+            if self._stopped():
+                return
+            yield from steps.selected()
+            if self.done:
                 return
 
             # 2. Stream Skill Execution
-            skill_content = get_skill(memory_data["SkillSelection"])
-            accumulated_run_text = ""
-            for fragment in self.agent._running_stream(memory_data, skill_content):
-                if isinstance(fragment, str):
-                    accumulated_run_text += fragment
-                    yield VlmStep(stage=memory_data["Stage"], message=accumulated_run_text, images=memory_data.get("GeneratedImages", []))
-                else:
-                    # Final result processed
-                    pass
-            
-            # Yield final state for this stage
-            yield VlmStep(stage=memory_data["Stage"], message=accumulated_run_text, images=memory_data.get("GeneratedImages", []), is_final=True)
+            yield from self._steps(self.agent._running_stream(steps.memory_data), steps.running)
+            if self._stopped():
+                return
+            yield from steps.finished()
 
-            if memory_data["Stage"] == "Response":
-                self.done = True
-                # Yield the final step for the "Response" stage
-                yield VlmStep(stage=memory_data["Stage"], message=accumulated_run_text, images=memory_data.get("GeneratedImages", []), is_final=True)
+    async def _arounds(self) -> AsyncIterator[VlmStep]:
+        while not self._stopped():
+            last_memory, final = self._start_round()
+            if final is not None:
+                yield final
+                return
+            steps = RoundSteps(self)
+
+            if self.fused:
+                async for step in self._asteps(self.agent._afused_stream(last_memory), steps.fused):
+                    yield step
+                if not self._stopped():
+                    for step in steps.fused_finished():
+                        yield step
+                continue
 
+            async for step in self._asteps(self.agent._aselect_skill_and_tools_stream(last_memory), steps.selecting):
+                yield step
+            if self._stopped():
+                return
+            for step in steps.selected():
+                yield step
+            if self.done:
+                return
+
+            async for step in self._asteps(self.agent._arunning_stream(steps.memory_data), steps.running):
+                yield step
+            if self._stopped():
+                return
+            for step in steps.finished():
+                yield step
+
+class SkillOutput:
+    """
+    A streamed skill output: accumulated, scanned for image directives and stored in memory once complete.
+    """
+    def __init__(self, agent: "VlmAgent", stage: str) -> None:
+        self.agent = agent
+        self.text = ""
+        self.scanner = agent._begin_output(stage)
+
+    def feed(self, chunk: str) -> None:
+        self.text += chunk
+        self.agent._scan_output(self.scanner, chunk)
+
+    def end(self) -> None:
+        self.agent._scan_output(self.scanner, None)
+
+    def store(self) -> Dict[str, Any]:
+        response = self.agent._sanitize_response({"Message": self.text})
+        self.agent.memory.append_message(response.get("Message", self.text))
+        return response
+
+class SelectionReply:
+    """
+    The stage-1 JSON of one round, fed by the sync or async stream: tool_list entries are
+    dispatched as soon as they are parsed, an invalid reply is retried up to max_retries times.
+    """
+    def __init__(self, agent: "VlmAgent", dispatch: Callable[[Any], None], max_retries: int = 3) -> None:
+        self.agent = agent
+        self.dispatch = dispatch
+        self.max_retries = max_retries
+        self.attempt = -1
+        self.full_response = ""
+        self.response: Optional[Dict[str, Any]] = None
+        self.parser = IncrementalJSONParser()
+
+    def next_attempt(self) -> bool:
+        """
+        Start another attempt, False once the reply parsed or the retries are used up.
+        """
+        if self.response is not None or self.attempt + 1 >= self.max_retries:
+            return False
+        self.attempt += 1
+        self.full_response = ""
+        self.parser = IncrementalJSONParser()
+        self.agent.selection = {}
+        return True
+
+    @property
+    def notice(self) -> Optional[str]:
+        if self.attempt == 0:
+            return None
+        return f"\n\n[Warning: Invalid JSON. Retrying attempt {self.attempt+1}/{self.max_retries}...]\n\n"
+
+    def feed(self, chunk: str) -> None:
+        self.full_response += chunk
+        self.agent._handle_parse_events(self.parser.feed(chunk), self.dispatch)
+
+    def end_attempt(self) -> None:
+        self.response = self.agent._parse_selection_response(self.full_response, self.attempt)
+        if self.response is None:
+            logger.warning(f"JSON Parse failed on attempt {self.attempt+1} {self.full_response}")
+
+    def finish(self) -> Dict[str, Any]:
+        response = self.agent._finalize_selection(self.response, self.full_response)
+        # Anything the incremental parser missed is dispatched now
+        for tool_item in response.get("tool_list", []):
+            self.dispatch(tool_item)
+        return response
+
+class FusedReply:
+    """
+    A fused reply split into its selection header and the skill output, fed by the sync or
+    async stream. feed() and finish() return the fragments to yield: header chunks, the
+    selection dict once the delimiter arrives and output chunks.
+    """
+    def __init__(self, agent: "VlmAgent", dispatch: Callable[[Any], None]) -> None:
+        self.agent = agent
+        self.dispatch = dispatch
+        self.parser = IncrementalJSONParser()
+        self.splitter = SectionSplitter(FUSED_DELIMITER)
+        self.header = ""
+        self.selection: Optional[Dict[str, Any]] = None
+        self.output: Optional[SkillOutput] = None
+        agent.selection = {}
+
+    def _feed_header(self, text: str) -> None:
+        self.header += text
+        self.agent._handle_parse_events(self.parser.feed(text), self.dispatch)
+
+    def _select(self) -> Dict[str, Any]:
+        self.selection = self.agent._fused_selection(self.header, self.parser, self.dispatch)
+        self.output = SkillOutput(self.agent, self.selection.get("Stage", ""))
+        return self.selection
+
+    def feed(self, chunk: str) -> List[Any]:
+        fragments = []
+        head, body = self.splitter.feed(chunk)
+        if head:
+            self._feed_header(head)
+            fragments.append(head)
+        if self.splitter.split and self.selection is None:
+            fragments.append(self._select())
+        if body:
+            self.output.feed(body)
+            fragments.append(body)
+        return fragments
+
+    def finish(self) -> List[Any]:
+        """
+        Fragments left once the stream ended.
+        """
+        if self.selection is not None:
+            self.output.end()
+            return []
+        # No delimiter: the whole reply is the header, its Message stands in for the output
+        fragments = []
+        rest = self.splitter.flush()
+        if rest:
+            self._feed_header(rest)
+            fragments.append(rest)
+        fragments.append(self._select())
+        self.output.text = self.selection.get("Message", "")
+        if self.output.text:
+            fragments.append(self.output.text)
+        return fragments
 
 class VlmAgent:
     """
@@ -88,59 +424,209 @@ class VlmAgent:
     """
     def __init__(self, VLM_model: "VlmModel", image_service: Any, input: Dict[str, Any]) -> None:
         self.memory = memory.MemoryService(input)
+        # Static system prefix + append-only history, so rounds reuse the provider/KV prefix cache
+        self.prompt_builder = PromptBuilder(getattr(VLM_model, "context_budget", None))
         self.vlm_model = VLM_model
         self.image_service = image_service
+        # SkillSelection/Stage of the current round, filled in as soon as they are parsed from the stream
+        # and shown on the live "Selecting Skill" steps
+        self.selection: Dict[str, str] = {}
+        # Replaced by the token of the run driving this agent
+        self.cancel = CancellationToken()
+        # Set when the last fused round's selection could not be parsed
+        self.fused_failed = False
         self.TOOLS = {
-            "memory": {
-                "get_all_memory": {"function": self.memory.get_all_memory, "params": {}}
-            },
             "image_service": {
                 "generate_image": {"function": self.image_service.generate_image, "params": {"prompt": ""}}
             }
         }
+        if hasattr(self.image_service, "agenerate_image"):
+            self.TOOLS["image_service"]["generate_image"]["async_function"] = self.image_service.agenerate_image
+        # Images requested in a skill output are started while it streams, the next tool_list claims them
+        self.speculative: Optional[SpeculativeImages] = None
+        if IMAGE_SPECULATIVE and hasattr(self.image_service, "generate_image"):
+            self.speculative = SpeculativeImages(lambda prompt: self._call_tool(self.image_service.generate_image, {"prompt": prompt}))
     
-    def run(self) -> VlmRun:
-        return VlmRun(self)
+    def run(self, cancel: Optional[CancellationToken] = None) -> VlmRun:
+        return VlmRun(self, cancel)
 
-    def _tool_processing(self, tool_list: List[Dict]) -> List[Dict[str, Any]]:
-        if not tool_list:
-            return []
-        
-        exceptions = []
-        results = []
+    def close(self) -> None:
+        self._drop_speculative()
+        self.memory.close()
+
+    def _drop_speculative(self) -> None:
+        """
+        Cancel the queued speculative images and drop the rest, once no tool_list can claim them.
+        """
+        if self.speculative is not None:
+            self.speculative.reset()
+
+    def _tool_key(self, tool_item: Dict[str, Any]) -> str:
+        return json.dumps({k: tool_item.get(k) for k in ("category", "name", "params")}, sort_keys=True, ensure_ascii=False, default=str)
+
+    def _resolve_tool(self, tool_item: Any) -> Optional[tuple]:
+        """
+        Look up a tool_list entry, returns (tool_info, params) or None for unknown tools.
+        """
+        if not isinstance(tool_item, dict):
+            return None
+        category = tool_item.get("category")
+        name = tool_item.get("name")
         
-        with ThreadPoolExecutor() as executor:
-            future_to_tool = {}
-            for tool_item in tool_list:
-                category = tool_item.get("category")
-                name = tool_item.get("name")
-                
-                if category in self.TOOLS and name in self.TOOLS[category]:
-                    tool_info = self.TOOLS[category][name]
-                    func = tool_info["function"]
-                    base_params = tool_info["params"].copy()
-                    
-                    # Merge dynamic params
-                    if tool_item.get("params"):
-                        for k, v in tool_item["params"].items():
-                            if k in base_params:
-                                base_params[k] = v
-                    
-                    # Store tool name with future
-                    future = executor.submit(func, **base_params)
-                    future_to_tool[future] = name
-                    time.sleep(1)
+        if category in self.TOOLS and name in self.TOOLS[category]:
+            tool_info = self.TOOLS[category][name]
+            base_params = tool_info["params"].copy()
+            
+            # Merge dynamic params
+            if isinstance(tool_item.get("params"), dict):
+                for k, v in tool_item["params"].items():
+                    if k in base_params:
+                        base_params[k] = v
             
-            for future in as_completed(future_to_tool):
+            return tool_info, base_params
+        return None
+
+    def _submit_tool(self, executor: ThreadPoolExecutor, tool_item: Any) -> Optional[Future]:
+        """
+        Submit one tool_list entry to the executor. Returns None for unknown tools.
+        """
+        resolved = self._resolve_tool(tool_item)
+        if not resolved:
+            return None
+        tool_info, params = resolved
+        speculative = self._claim_speculative(tool_info, params)
+        if speculative is not None:
+            return speculative
+        return executor.submit(self._call_tool, tool_info["function"], params)
+
+    def _claim_speculative(self, tool_info: Dict[str, Any], params: Dict[str, Any]) -> Optional[Future]:
+        if self.speculative is None or tool_info is not self.TOOLS["image_service"]["generate_image"]:
+            return None
+        future = self.speculative.take(str(params.get("prompt", "")))
+        if future is not None:
+            logger.info(f"Tool generate_image served by speculative generation: {self.speculative.stats()}")
+        return future
+
+    def _begin_output(self, stage: str) -> Optional[LineScanner]:
+        """
+        Start scanning a skill output for image directives. Speculative images nobody
+        claimed since the previous output are dropped. A Response output ends the run,
+        so no later tool_list would claim its images.
+        """
+        if self.speculative is None:
+            return None
+        self.speculative.reset()
+        return LineScanner() if stage != "Response" else None
+
+    def _scan_output(self, scanner: Optional[LineScanner], chunk: Optional[str]) -> None:
+        """
+        Feed an output chunk, or None at the end of the output, to the directive scanner.
+        """
+        if scanner is None or self.cancel.cancelled:
+            return
+        for line in (scanner.feed(chunk) if chunk is not None else scanner.flush()):
+            self.speculative.scan(line)
+
+    def _call_tool(self, function: Any, params: Dict[str, Any]) -> Any:
+        # Queued calls of a cancelled run are dropped before they reach a paid API
+        self.cancel.raise_if_cancelled()
+        return function(**params)
+
+    async def _acall_tool(self, coro_function: Any, params: Dict[str, Any]) -> Any:
+        self.cancel.raise_if_cancelled()
+        return await coro_function(**params)
+
+    def _asubmit_tool(self, tool_item: Any) -> Optional["asyncio.Task"]:
+        """
+        Schedule one tool_list entry on the running event loop. Returns None for unknown tools.
+        """
+        resolved = self._resolve_tool(tool_item)
+        if not resolved:
+            return None
+        tool_info, params = resolved
+        speculative = self._claim_speculative(tool_info, params)
+        if speculative is not None:
+            return asyncio.wrap_future(speculative)
+        if "async_function" in tool_info:
+            coro = self._acall_tool(tool_info["async_function"], params)
+        else:
+            coro = asyncio.to_thread(self._call_tool, tool_info["function"], params)
+        return asyncio.ensure_future(coro)
+
+    def _collect_tool_results(self, future_to_tool: Dict[Future, str]) -> List[Dict[str, Any]]:
+        """
+        Results in completion order. On cancellation the pending calls are cancelled and left out.
+        """
+        results = []
+        pending = set(future_to_tool)
+        cancelled = self.cancel.as_future()
+        while pending and not self.cancel.cancelled:
+            done, pending = wait(pending | {cancelled}, return_when=FIRST_COMPLETED)
+            pending.discard(cancelled)
+            for future in done:
+                if future is cancelled:
+                    continue
                 tool_name = future_to_tool[future]
                 try:
                     res = future.result()
                     results.append({"tool": tool_name, "result": res})
                 except Exception as e:
                     results.append({"tool": tool_name, "error": str(e)})
+        for future in pending:
+            future.cancel()
+        return results
 
+    async def _acollect_tool_results(self, task_to_tool: Dict["asyncio.Task", str]) -> List[Dict[str, Any]]:
+        results = []
+        pending = set(task_to_tool)
+        cancelled = asyncio.wrap_future(self.cancel.as_future())
+        try:
+            while pending and not self.cancel.cancelled:
+                done, pending = await asyncio.wait(pending | {cancelled}, return_when=asyncio.FIRST_COMPLETED)
+                pending.discard(cancelled)
+                for task in done:
+                    if task is cancelled:
+                        continue
+                    tool_name = task_to_tool[task]
+                    if task.cancelled():
+                        results.append({"tool": tool_name, "error": "cancelled"})
+                    elif task.exception() is not None:
+                        results.append({"tool": tool_name, "error": str(task.exception())})
+                    else:
+                        results.append({"tool": tool_name, "result": task.result()})
+        finally:
+            cancelled.cancel()
+            for task in pending:
+                task.cancel()
         return results
 
+    def _shutdown_tools(self, executor: ThreadPoolExecutor) -> None:
+        """
+        Normally wait for the tool threads; after cancellation drop queued calls and
+        return right away, leaving calls already in flight to finish in the background.
+        """
+        if self.cancel.cancelled:
+            executor.shutdown(wait=False, cancel_futures=True)
+        else:
+            executor.shutdown(wait=True)
+
+    def _tool_processing(self, tool_list: List[Dict]) -> List[Dict[str, Any]]:
+        if not tool_list:
+            return []
+        
+        executor = ThreadPoolExecutor()
+        try:
+            future_to_tool = {}
+            for tool_item in tool_list:
+                future = self._submit_tool(executor, tool_item)
+                if future:
+                    # Store tool name with future, remote tools are paced by their provider's rate limiter
+                    future_to_tool[future] = tool_item.get("name")
+            
+            return self._collect_tool_results(future_to_tool)
+        finally:
+            self._shutdown_tools(executor)
+
     def _sanitize_response(self, response: Dict[str, Any]) -> Dict[str, Any]:
         """
         Ensure fields like Message, SkillSelection, and Stage are strings.
@@ -155,147 +641,375 @@ class VlmAgent:
                     response[field] = str(val)
         return response
 
-    def _select_skill_and_tools_stream(self, last_memory: Dict[str, Any]) -> Iterator[str | Dict[str, Any]]:
-        try:
-            skill_prompt = SKILL_SELECTION_PROMPT.format(skills=get_skill_categories())
-            prompt = (
-                STAGE_PROMPT + "\n" + 
-                "Last Memory:\n" + str(last_memory.get("Message", "")) + "\n" +
-                TOOLS_PROMPT + "\n" + 
-                skill_prompt + "\n" +
-                RESPONSE_PROMPT
-            )
-            logger.info(f"DEBUG: Stage 1 Prompt:\n{prompt}")
-            max_retries = 3
-            response = None
-            
-            for attempt in range(max_retries):
-                full_response = ""
-                if attempt > 0:
-                     msg = f"\n\n[Warning: Invalid JSON. Retrying attempt {attempt+1}/{max_retries}...]\n\n"
-                     yield msg
-                     
-                for chunk in self.vlm_model.generate_stream(prompt, last_memory.get("Images", [])):
-                    full_response += chunk
-                    yield chunk
-                
-                # Parse final JSON
-                parsed = False
-                try:
-                    response = json.loads(full_response)
-                    parsed = True
-                except json.JSONDecodeError as e:
-                    # Simple heuristic if JSON is wrapped in backticks
-                    logger.warning(f"JSON Parse failed on attempt {attempt+1} {e.msg}")
-                    if "```json" in full_response:
-                        try:
-                            json_str = full_response.split("```json")[1].split("```")[0].strip()
-                            response = json.loads(json_str)
-                            parsed = True
-                        except json.JSONDecodeError:
-                            logger.warning(f"JSON Parse failed on because {e.msg}")
-                            pass
-                
-                if parsed:
-                    break
-                
-                logger.warning(f"JSON Parse failed on attempt {attempt+1} {full_response}")
-            
-            if not response:
-                 # Fallback if all retries fail
-                 response = {"Message": full_response, "Stage": "Thinking", "SkillSelection": "reasoning"}
-            
-            print(f"DEBUG: Stage 1 JSON Response:\n{json.dumps(response, indent=2, ensure_ascii=False)}")
-            
-            response = self._sanitize_response(response)
-            self.memory.update_memory_skill_stage(response.get("SkillSelection", ""), response.get("Stage", ""))
-            
-            tool_results = self._tool_processing(response.get("tool_list", []))
-            generated_images = []
-            for res_item in tool_results:
-                tool_name = res_item["tool"]
-                res = res_item.get("result")
-                if not res: continue
-                if tool_name == "generate_image":
-                    if "images" in res:
-                        for img in res["images"]:
-                            if img:
-                                self.memory.append_image(img)
-                                generated_images.append(img)
-                    elif "image" in res:
-                        img = res["image"]
+    def _apply_tool_results(self, tool_results: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """
+        Store generated images in memory and build the context for the skill execution stage.
+        """
+        generated_images = []
+        for res_item in tool_results:
+            tool_name = res_item["tool"]
+            res = res_item.get("result")
+            if not res: continue
+            if tool_name == "generate_image":
+                label = res.get("prompt", "")
+                if "images" in res:
+                    for img in res["images"]:
                         if img:
-                            self.memory.append_image(img)
+                            self.memory.append_image(img, label)
                             generated_images.append(img)
-                    elif "error" in res:
-                        logger.error(f"Generate Image Error: {res['error']}")
-                        print(f"DEBUG: Generate Image Error: {res['error']}")
-            
-            next_memory_context = self.memory.get_latest_memory()
-            next_memory_context["GeneratedImages"] = generated_images
-            for res_item in tool_results:
-                if res_item["tool"] == "get_all_memory" and res_item.get("result"):
-                    logger.info(f"DEBUG: Get All Memory Result: {res_item['result']}")
-                    next_memory_context["Message"] = res_item["result"]
-            
-            yield next_memory_context
+                elif "image" in res:
+                    img = res["image"]
+                    if img:
+                        self.memory.append_image(img, label)
+                        generated_images.append(img)
+                elif "error" in res:
+                    logger.error(f"Generate Image Error: {res['error']}")
+                    print(f"DEBUG: Generate Image Error: {res['error']}")
+        
+        next_memory_context = self.memory.get_latest_memory()
+        next_memory_context["GeneratedImages"] = generated_images
+        return next_memory_context
+
+    def _parse_selection_response(self, full_response: str, attempt: int) -> Optional[Dict[str, Any]]:
+        """
+        Parse the stage-1 JSON, returns None if it is invalid.
+        """
+        try:
+            return json.loads(full_response)
+        except json.JSONDecodeError as e:
+            # Simple heuristic if JSON is wrapped in backticks
+            logger.warning(f"JSON Parse failed on attempt {attempt+1} {e.msg}")
+            if "```json" in full_response:
+                try:
+                    json_str = full_response.split("```json")[1].split("```")[0].strip()
+                    return json.loads(json_str)
+                except json.JSONDecodeError:
+                    logger.warning(f"JSON Parse failed on because {e.msg}")
+        return None
+
+    def _finalize_selection(self, response: Optional[Dict[str, Any]], full_response: str) -> Dict[str, Any]:
+        if not isinstance(response, dict):
+             # Fallback if all retries fail
+             response = {"Message": full_response, "Stage": "Thinking", "SkillSelection": "reasoning"}
+        
+        print(f"DEBUG: Stage 1 JSON Response:\n{json.dumps(response, indent=2, ensure_ascii=False)}")
+
+        # A reply that leaves out a field still drives the round, with the same defaults as the fallback
+        response.setdefault("SkillSelection", "reasoning")
+        response.setdefault("Stage", "Thinking")
+        response = self._sanitize_response(response)
+        if not isinstance(response.get("tool_list"), list):
+            response["tool_list"] = []
+        self.memory.update_memory_skill_stage(response.get("SkillSelection", ""), response.get("Stage", ""))
+        return response
+
+    def _tool_dispatcher(self, submit: Any, pending: Dict[Any, str]) -> Any:
+        """
+        dispatch(tool_item) for one round: submits every distinct tool_list entry once and
+        records its future/task in pending, so entries can be sent as soon as they are parsed.
+        """
+        dispatched = set()
+
+        def dispatch(tool_item: Any) -> None:
+            if not isinstance(tool_item, dict):
+                return
+            key = self._tool_key(tool_item)
+            if key in dispatched:
+                return
+            handle = submit(tool_item)
+            if handle:
+                dispatched.add(key)
+                pending[handle] = tool_item.get("name")
+                logger.info(f"Tool dispatched: {tool_item.get('name')}")
+        return dispatch
+
+    def _handle_parse_events(self, events: List[tuple], dispatch: Any) -> None:
+        for kind, name, value in events:
+            if kind == "item":
+                dispatch(value)
+            elif name in ("SkillSelection", "Stage"):
+                self.selection[name] = str(value)
+                logger.info(f"Stage 1 {name} parsed: {value}")
+
+    def _selection_messages(self) -> List[Dict[str, Any]]:
+        messages = self.prompt_builder.selection_messages(self.memory.visible_entries())
+        logger.info(f"DEBUG: Stage 1 Messages: {len(messages)}, last: {messages[-1]['content']}")
+        return messages
+
+    def _select_skill_and_tools_stream(self, last_memory: Dict[str, Any]) -> Iterator[str | Dict[str, Any]]:
+        try:
+            messages = self._selection_messages()
+            # Tools are dispatched as soon as each tool_list entry is complete in the stream,
+            # so image generation overlaps with the rest of the stage-1 output
+            executor = ThreadPoolExecutor()
+            try:
+                future_to_tool = {}
+                reply = SelectionReply(self, self._tool_dispatcher(lambda tool_item: self._submit_tool(executor, tool_item), future_to_tool))
+                while reply.next_attempt():
+                    if reply.notice:
+                        yield reply.notice
+                    with closing(self.vlm_model.generate_chat_stream(messages, self.cancel)) as stream:
+                        for chunk in stream:
+                            reply.feed(chunk)
+                            yield chunk
+                    if self.cancel.cancelled:
+                        return
+                    reply.end_attempt()
+                reply.finish()
+                tool_results = self._collect_tool_results(future_to_tool)
+                if self.cancel.cancelled:
+                    return
+            finally:
+                self._shutdown_tools(executor)
+
+            logger.info(f"Rate limiter metrics: {limiter_metrics()}")
+            yield self._apply_tool_results(tool_results)
 
         except Exception as e:
             logger.error(f"Error in _select_skill_and_tools_stream: {e}")
             yield last_memory
 
-    def _running_stream(self, last_memory: Dict[str, Any], skill_content: str) -> Iterator[str | Dict[str, Any]]:
+    async def _aselect_skill_and_tools_stream(self, last_memory: Dict[str, Any]) -> AsyncIterator[str | Dict[str, Any]]:
+        """
+        Async counterpart of _select_skill_and_tools_stream, tools run as tasks on the event loop.
+        """
         try:
-            prompt = "SKILL INSTRUCTIONS:\n" + str(skill_content) + "\n" + str(last_memory.get("Message", ""))
-            full_response = ""
-            for chunk in self.vlm_model.generate_stream(prompt, last_memory.get("Images", [])):
-                full_response += chunk
-                yield chunk
-            
-            # Simple response parsing
-            response = {"Message": full_response}
-            response = self._sanitize_response(response)
-            self.memory.append_message(response.get("Message", full_response))
-            yield response
+            # Loading stored images is blocking, build the messages off the event loop
+            messages = await asyncio.to_thread(self._selection_messages)
+            task_to_tool = {}
+            reply = SelectionReply(self, self._tool_dispatcher(self._asubmit_tool, task_to_tool))
+            try:
+                while reply.next_attempt():
+                    if reply.notice:
+                        yield reply.notice
+                    async with aclosing(self.vlm_model.agenerate_chat_stream(messages, self.cancel)) as stream:
+                        async for chunk in stream:
+                            reply.feed(chunk)
+                            yield chunk
+                    if self.cancel.cancelled:
+                        return
+                    reply.end_attempt()
+                reply.finish()
+                tool_results = await self._acollect_tool_results(task_to_tool)
+                if self.cancel.cancelled:
+                    return
+            except BaseException:
+                # Abandoned or failed round: do not leave tool tasks running
+                for task in task_to_tool:
+                    task.cancel()
+                raise
+
+            logger.info(f"Rate limiter metrics: {limiter_metrics()}")
+            yield self._apply_tool_results(tool_results)
+
+        except Exception as e:
+            logger.error(f"Error in _aselect_skill_and_tools_stream: {e}")
+            yield last_memory
+
+    def _running_stream(self, last_memory: Dict[str, Any]) -> Iterator[str | Dict[str, Any]]:
+        try:
+            # The skill instructions are already part of the system prefix, the request only names the skill
+            messages = self.prompt_builder.execution_messages(self.memory.visible_entries(), last_memory.get("SkillSelection", ""))
+            output = SkillOutput(self, last_memory.get("Stage", ""))
+            with closing(self.vlm_model.generate_chat_stream(messages, self.cancel)) as stream:
+                for chunk in stream:
+                    output.feed(chunk)
+                    yield chunk
+            output.end()
+            if self.cancel.cancelled:
+                # A partial output is not stored in memory
+                return
+            yield output.store()
         except Exception as e:
             logger.error(f"Error in _running_stream: {e}")
             yield {"Message": f"Error: {e}"}
 
+    async def _arunning_stream(self, last_memory: Dict[str, Any]) -> AsyncIterator[str | Dict[str, Any]]:
+        try:
+            messages = await asyncio.to_thread(self.prompt_builder.execution_messages, self.memory.visible_entries(), last_memory.get("SkillSelection", ""))
+            output = SkillOutput(self, last_memory.get("Stage", ""))
+            async with aclosing(self.vlm_model.agenerate_chat_stream(messages, self.cancel)) as stream:
+                async for chunk in stream:
+                    output.feed(chunk)
+                    yield chunk
+            output.end()
+            if self.cancel.cancelled:
+                return
+            yield output.store()
+        except Exception as e:
+            logger.error(f"Error in _arunning_stream: {e}")
+            yield {"Message": f"Error: {e}"}
+
+    def _fused_selection(self, header: str, parser: IncrementalJSONParser, dispatch: Any) -> Dict[str, Any]:
+        """
+        Selection from the header of a fused reply, falling back to the fields the
+        incremental parser saw when the header as a whole is not valid JSON.
+        """
+        response = self._parse_selection_response(header, 0)
+        if response is None and "SkillSelection" in parser.fields and "Stage" in parser.fields:
+            response = {**parser.fields, "tool_list": parser.items}
+        self.fused_failed = response is None
+        response = self._finalize_selection(response, header)
+        for tool_item in response.get("tool_list", []):
+            dispatch(tool_item)
+        return response
+
+    def _finish_fused(self, reply: FusedReply, tool_results: List[Dict[str, Any]]) -> Dict[str, Any]:
+        # Images requested by the previous round's output belong to its entry, so they are stored first
+        next_memory_context = self._apply_tool_results(tool_results)
+        reply.output.store()
+        return next_memory_context
+
+    def _fused_stream(self, last_memory: Dict[str, Any]) -> Iterator[str | Dict[str, Any]]:
+        """
+        One request per round: the selection JSON, the delimiter line, then the skill output.
+        Yields header chunks, the selection dict once the delimiter arrives, output chunks and
+        finally the next memory context. The tool_list is dispatched while the output streams.
+        """
+        try:
+            messages = self.prompt_builder.fused_messages(self.memory.visible_entries())
+            executor = ThreadPoolExecutor()
+            try:
+                future_to_tool = {}
+                reply = FusedReply(self, self._tool_dispatcher(lambda tool_item: self._submit_tool(executor, tool_item), future_to_tool))
+                with closing(self.vlm_model.generate_chat_stream(messages, self.cancel)) as stream:
+                    for chunk in stream:
+                        yield from reply.feed(chunk)
+                if self.cancel.cancelled:
+                    return
+                yield from reply.finish()
+                tool_results = self._collect_tool_results(future_to_tool)
+                if self.cancel.cancelled:
+                    return
+            finally:
+                self._shutdown_tools(executor)
+
+            logger.info(f"Rate limiter metrics: {limiter_metrics()}")
+            yield self._finish_fused(reply, tool_results)
+
+        except Exception as e:
+            logger.error(f"Error in _fused_stream: {e}")
+
+    async def _afused_stream(self, last_memory: Dict[str, Any]) -> AsyncIterator[str | Dict[str, Any]]:
+        """
+        Async counterpart of _fused_stream.
+        """
+        try:
+            messages = await asyncio.to_thread(self.prompt_builder.fused_messages, self.memory.visible_entries())
+            task_to_tool = {}
+            reply = FusedReply(self, self._tool_dispatcher(self._asubmit_tool, task_to_tool))
+            try:
+                async with aclosing(self.vlm_model.agenerate_chat_stream(messages, self.cancel)) as stream:
+                    async for chunk in stream:
+                        for fragment in reply.feed(chunk):
+                            yield fragment
+                if self.cancel.cancelled:
+                    return
+                for fragment in reply.finish():
+                    yield fragment
+                tool_results = await self._acollect_tool_results(task_to_tool)
+                if self.cancel.cancelled:
+                    return
+            except BaseException:
+                for task in task_to_tool:
+                    task.cancel()
+                raise
+
+            logger.info(f"Rate limiter metrics: {limiter_metrics()}")
+            yield self._finish_fused(reply, tool_results)
+
+        except Exception as e:
+            logger.error(f"Error in _afused_stream: {e}")
+
     def _select_skill_and_tools(self, last_memory: Dict[str, Any]) -> Dict[str, Any]:
         # Legacy/Internal method
         for res in self._select_skill_and_tools_stream(last_memory):
             if isinstance(res, dict): return res
         return last_memory
 
-    def _running(self, last_memory: Dict[str, Any], skill_content: str) -> Dict[str, Any]:
+    def _running(self, last_memory: Dict[str, Any]) -> Dict[str, Any]:
         # Legacy/Internal method
-        for res in self._running_stream(last_memory, skill_content):
+        for res in self._running_stream(last_memory):
             if isinstance(res, dict): return res
         return {"Message": "Error"}
 
 class VlmModel:
+    # Service class names in VLM.service, resolved on first use so that
+    # local backends (torch/transformers) are only imported when selected
     Model_service = {
-        "qwen2-vl": LocalVLMService,
+        "qwen2-vl": "LocalVLMService",
+    }
+    # Round mode per model: "fused" selects the skill and runs it in one request, "two_call"
+    # uses separate selection and execution requests. Override for every model with VLM_ROUND_MODE
+    Round_mode = {
+        "qwen3-vl": "fused",
+        "qvq": "fused",
     }
     def __init__(self, model_name: str) -> None:
         self.model_name = model_name
-        # Find which service class to use
-        service_class = None
-        for key, cls in self.Model_service.items():
+        self.service = self.service_class(model_name)(model_name)
+
+    @classmethod
+    def service_class_name(cls, model_name: str) -> str:
+        for key, class_name in cls.Model_service.items():
             if key in model_name.lower():
-                service_class = cls
-                break
-        if not service_class:
-            service_class = VLMService
-            
-        self.service = service_class(model_name)
+                return class_name
+        return "VLMService"
+
+    @classmethod
+    def service_class(cls, model_name: str) -> type:
+        """
+        Find which service class to use for a model.
+        """
+        return getattr(service, cls.service_class_name(model_name))
+
+    @classmethod
+    def is_local(cls, model_name: str) -> bool:
+        return cls.service_class_name(model_name) == "LocalVLMService"
+
+    @property
+    def context_budget(self) -> Optional[ContextBudget]:
+        return getattr(self.service, "context_budget", None)
+
+    @property
+    def round_mode(self) -> str:
+        override = os.getenv("VLM_ROUND_MODE", "").lower()
+        if override in ("fused", "two_call"):
+            return override
+        for key, mode in self.Round_mode.items():
+            if key in self.model_name.lower():
+                return mode
+        return "two_call"
+
+    @property
+    def fused(self) -> bool:
+        return self.round_mode == "fused"
+
+    def health_check(self) -> bool:
+        return self.service.health_check()
 
     def generate_text(self, prompt: str, images: Optional[List[Image.Image]] = None) -> Any:
         logger.info(f"VLM Request Start: model={self.model_name}, prompt={prompt}, images={len(images) if images else 0}")  
         return self.service.generate_text(prompt, images)
 
-    def generate_stream(self, prompt: str, images: Optional[List[Image.Image]] = None) -> Iterator[str]:
+    def generate_stream(self, prompt: str, images: Optional[List[Image.Image]] = None, cancel: Optional[CancellationToken] = None) -> Iterator[str]:
         logger.info(f"VLM Stream Request Start: model={self.model_name}, prompt_length={len(prompt)}")
-        return self.service.generate_stream(prompt, images)
+        return self.service.generate_stream(prompt, images, cancel)
+
+    async def agenerate_text(self, prompt: str, images: Optional[List[Image.Image]] = None) -> Any:
+        logger.info(f"VLM Async Request Start: model={self.model_name}, prompt_length={len(prompt)}, images={len(images) if images else 0}")
+        return await self.service.agenerate_text(prompt, images)
+
+    def agenerate_stream(self, prompt: str, images: Optional[List[Image.Image]] = None, cancel: Optional[CancellationToken] = None) -> AsyncIterator[str]:
+        logger.info(f"VLM Async Stream Request Start: model={self.model_name}, prompt_length={len(prompt)}")
+        return self.service.agenerate_stream(prompt, images, cancel)
+
+    def generate_chat_stream(self, messages: List[Dict[str, Any]], cancel: Optional[CancellationToken] = None) -> Iterator[str]:
+        logger.info(f"VLM Chat Stream Request Start: model={self.model_name}, messages={len(messages)}")
+        return self.service.generate_chat_stream(messages, cancel)
+
+    def agenerate_chat_stream(self, messages: List[Dict[str, Any]], cancel: Optional[CancellationToken] = None) -> AsyncIterator[str]:
+        logger.info(f"VLM Async Chat Stream Request Start: model={self.model_name}, messages={len(messages)}")
+        return self.service.agenerate_chat_stream(messages, cancel)
 
         
\ No newline at end of file
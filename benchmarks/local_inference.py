@@ -0,0 +1,111 @@
+"""
+Load time, memory and generation speed of the local Qwen2-VL backend per load path.
+
+Each mode runs in a fresh interpreter with its own LOCAL_* settings:
+
+    gpu-4bit       the bitsandbytes 4-bit path (needs CUDA)
+    cpu-fp32       CPU without quantization
+    cpu-int8-cold  CPU dynamic int8, converting from the float weights
+    cpu-int8-warm  CPU dynamic int8, loading the cached quantized model written by the cold run
+
+    python benchmarks/local_inference.py
+    python benchmarks/local_inference.py cpu-int8-cold cpu-int8-warm --json --image figure.png
+"""
+import os
+import sys
+import json
+import argparse
+import tempfile
+import subprocess
+from typing import Dict, List, Any
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODES = {
+    "gpu-4bit": {"LOCAL_DEVICE": "cuda"},
+    "cpu-fp32": {"LOCAL_DEVICE": "cpu", "LOCAL_CPU_QUANTIZE": "0"},
+    "cpu-int8-cold": {"LOCAL_DEVICE": "cpu", "LOCAL_CPU_QUANTIZE": "1"},
+    "cpu-int8-warm": {"LOCAL_DEVICE": "cpu", "LOCAL_CPU_QUANTIZE": "1"},
+}
+DEFAULT_PROMPT = "A triangle has sides 3, 4 and 5. Explain step by step why it is a right triangle and compute its area."
+
+PROBE = """
+import sys, time, json, resource
+from PIL import Image
+start = time.perf_counter()
+from VLM.local import LocalVLMService
+service = LocalVLMService("Qwen2-VL-7B-Instruct")
+load_seconds = time.perf_counter() - start
+images = [Image.open({image!r}).convert("RGB")] if {image!r} else None
+start = time.perf_counter()
+first = None
+chunks = []
+for chunk in service.generate_stream({prompt!r}, images):
+    if first is None:
+        first = time.perf_counter() - start
+    chunks.append(chunk)
+generate_seconds = time.perf_counter() - start
+text = "".join(chunks)
+tokens = len(service._processor.tokenizer(text)["input_ids"])
+maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+if sys.platform == "darwin":
+    maxrss //= 1024
+print(json.dumps({{
+    "load_seconds": load_seconds,
+    "first_token_seconds": first,
+    "generate_seconds": generate_seconds,
+    "tokens": tokens,
+    "tokens_per_second": tokens / generate_seconds if generate_seconds else 0.0,
+    "max_rss_mb": maxrss / 1024
+}}))
+"""
+
+def measure(mode: str, prompt: str, image: str, cache_dir: str) -> Dict[str, Any]:
+    env = dict(
+        os.environ,
+        PYTHONPATH=ROOT + os.pathsep + os.environ.get("PYTHONPATH", ""),
+        LOCAL_QUANT_CACHE_DIR=cache_dir,
+        # Every mode does a full prefill
+        LOCAL_KV_CACHE="0",
+        **MODES[mode]
+    )
+    proc = subprocess.run(
+        [sys.executable, "-c", PROBE.format(prompt=prompt, image=image or "")],
+        cwd=ROOT, env=env, capture_output=True, text=True
+    )
+    if proc.returncode != 0:
+        return {"mode": mode, "error": proc.stderr.strip().splitlines()[-1:] or ["run failed"]}
+    result = json.loads(proc.stdout.strip().splitlines()[-1])
+    result["mode"] = mode
+    return result
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("modes", nargs="*", default=list(MODES), choices=list(MODES))
+    parser.add_argument("--prompt", default=DEFAULT_PROMPT)
+    parser.add_argument("--image", default=None, help="Optional image sent with the prompt")
+    parser.add_argument("--cache-dir", default=None, help="Quantized model cache, a temporary directory by default")
+    parser.add_argument("--json", action="store_true", help="Print machine readable results")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory(prefix="local-inference-") as tmp:
+        cache_dir = args.cache_dir or tmp
+        results = []
+        for mode in args.modes:
+            if mode == "cpu-int8-warm" and "cpu-int8-cold" not in args.modes and not args.cache_dir:
+                # Nothing cached yet, a warm run needs a cold one first
+                measure("cpu-int8-cold", args.prompt, args.image, cache_dir)
+            results.append(measure(mode, args.prompt, args.image, cache_dir))
+
+    if args.json:
+        print(json.dumps({"results": results}, indent=2))
+    else:
+        print(f"{'mode':<16}{'load s':>10}{'first tok s':>13}{'tokens/s':>10}{'max rss MB':>12}")
+        for result in results:
+            if "error" in result:
+                print(f"{result['mode']:<16}{'error':>10}  {result['error'][0]}")
+                continue
+            print(f"{result['mode']:<16}{result['load_seconds']:>10.1f}{result['first_token_seconds'] or 0:>13.2f}{result['tokens_per_second']:>10.2f}{result['max_rss_mb']:>12.0f}")
+    return 1 if any("error" in r for r in results) else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,85 @@
+"""
+Import-time report for the application entry points.
+
+Each target is imported in a fresh interpreter so results are not skewed by modules
+already loaded. For every target the wall time, peak RSS and the heavy dependencies
+that ended up in sys.modules are reported.
+
+    python benchmarks/startup_report.py
+    python benchmarks/startup_report.py --json --max-seconds 3 --forbid torch transformers
+"""
+import os
+import sys
+import json
+import argparse
+import subprocess
+from typing import Dict, List, Any
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TARGETS = ["VLM.vlm", "Image.service", "registry", "main"]
+HEAVY_MODULES = ["torch", "transformers", "bitsandbytes", "dashscope", "huggingface_hub", "gradio"]
+
+PROBE = """
+import sys, time, json, resource
+start = time.perf_counter()
+import importlib
+importlib.import_module({target!r})
+elapsed = time.perf_counter() - start
+maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+if sys.platform == "darwin":
+    maxrss //= 1024
+print(json.dumps({{
+    "seconds": elapsed,
+    "max_rss_mb": maxrss / 1024,
+    "loaded": [m for m in {heavy!r} if m in sys.modules]
+}}))
+"""
+
+def measure(target: str) -> Dict[str, Any]:
+    env = dict(os.environ, PYTHONPATH=ROOT + os.pathsep + os.environ.get("PYTHONPATH", ""))
+    proc = subprocess.run(
+        [sys.executable, "-c", PROBE.format(target=target, heavy=HEAVY_MODULES)],
+        cwd=ROOT, env=env, capture_output=True, text=True
+    )
+    if proc.returncode != 0:
+        return {"target": target, "error": proc.stderr.strip().splitlines()[-1:] or ["import failed"]}
+    result = json.loads(proc.stdout.strip().splitlines()[-1])
+    result["target"] = target
+    return result
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("targets", nargs="*", default=TARGETS)
+    parser.add_argument("--json", action="store_true", help="Print machine readable results")
+    parser.add_argument("--max-seconds", type=float, default=None, help="Fail if any import takes longer")
+    parser.add_argument("--forbid", nargs="*", default=[], help="Fail if any of these modules gets imported")
+    args = parser.parse_args(argv)
+
+    results = [measure(target) for target in args.targets]
+    failures = []
+    for result in results:
+        if "error" in result:
+            failures.append(f"{result['target']}: {result['error'][0]}")
+            continue
+        if args.max_seconds is not None and result["seconds"] > args.max_seconds:
+            failures.append(f"{result['target']}: import took {result['seconds']:.2f}s > {args.max_seconds:.2f}s")
+        forbidden = sorted(set(result["loaded"]) & set(args.forbid))
+        if forbidden:
+            failures.append(f"{result['target']}: imported {', '.join(forbidden)}")
+
+    if args.json:
+        print(json.dumps({"results": results, "failures": failures}, indent=2))
+    else:
+        print(f"{'target':<16}{'seconds':>10}{'max rss MB':>12}  heavy modules")
+        for result in results:
+            if "error" in result:
+                print(f"{result['target']:<16}{'error':>10}{'':>12}  {result['error'][0]}")
+                continue
+            loaded = ", ".join(result["loaded"]) or "-"
+            print(f"{result['target']:<16}{result['seconds']:>10.2f}{result['max_rss_mb']:>12.1f}  {loaded}")
+        for failure in failures:
+            print(f"FAIL {failure}")
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,93 @@
+import threading
+import logging
+from concurrent.futures import Future
+from typing import Callable, Dict, Optional
+
+logger = logging.getLogger("Cancellation")
+
+class RunCancelled(Exception):
+    pass
+
+class CancellationToken:
+    """
+    Thread-safe, one-shot cancellation flag for everything working on one chat run:
+    VlmRun checks it between steps, streams and tool calls register callbacks that
+    close connections, and the local model polls it from a stopping criterion.
+    """
+    def __init__(self) -> None:
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks: Dict[int, Callable[[], None]] = {}
+        self._next_key = 0
+        self._detach: Callable[[], None] = lambda: None
+        self.reason: Optional[str] = None
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def cancel(self, reason: str = "cancelled") -> bool:
+        """
+        Cancel and run the registered callbacks. Returns False if it already was cancelled.
+        """
+        with self._lock:
+            if self._event.is_set():
+                return False
+            self.reason = reason
+            self._event.set()
+            callbacks = list(self._callbacks.values())
+            self._callbacks.clear()
+        logger.info(f"Cancelled: {reason}")
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logger.warning(f"Cancellation callback failed: {e}")
+        return True
+
+    def on_cancel(self, callback: Callable[[], None]) -> Callable[[], None]:
+        """
+        Run callback on cancellation, right away if already cancelled.
+        Returns a function that unregisters it.
+        """
+        with self._lock:
+            if not self._event.is_set():
+                key = self._next_key
+                self._next_key += 1
+                self._callbacks[key] = callback
+
+                def unregister() -> None:
+                    with self._lock:
+                        self._callbacks.pop(key, None)
+                return unregister
+        callback()
+        return lambda: None
+
+    def raise_if_cancelled(self) -> None:
+        if self._event.is_set():
+            raise RunCancelled(self.reason)
+
+    def as_future(self) -> Future:
+        """
+        A new Future resolved on cancellation, to wait on it together with tool futures.
+        """
+        future: Future = Future()
+
+        def resolve() -> None:
+            if not future.done():
+                future.set_result(self.reason)
+        self.on_cancel(resolve)
+        return future
+
+    def child(self) -> "CancellationToken":
+        """
+        Token cancelled with this one but also cancellable on its own, e.g. for one stream.
+        Call detach() on it once its work is done.
+        """
+        child = CancellationToken()
+        child._detach = self.on_cancel(lambda: child.cancel(self.reason or "cancelled"))
+        return child
+
+    def detach(self) -> None:
+        self._detach()
+        self._detach = lambda: None
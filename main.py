@@ -1,7 +1,6 @@
 import asyncio
 import os
 import sys
-import time
 import logging
 from dotenv import load_dotenv
 import gradio as gr
@@ -17,64 +16,70 @@ logging.basicConfig(
 logger = logging.getLogger("ReasoningApp")
 sys.path.append(os.getcwd())
 
-from VLM.vlm import VlmAgent, VlmModel
-from Image.service import ImageService, ImageApiCall
+from VLM.vlm import VlmAgent
+from registry import model_registry, preload_local_enabled
+from ui_stream import StepCoalescer
+from Image.delivery import image_delivery
+from cancellation import CancellationToken
 
 # --- The "Big Message" Logic ---
 
-def agent_execution(message: Dict[str, Any], history: List[Any], vlm_model_name: str, image_model_name: str):
+def build_agent(message: Dict[str, Any], vlm_model_name: str, image_model_name: str) -> VlmAgent:
     user_input = {
         "text": message.get("text", ""),
         "files": [Image.open(f["path"] if isinstance(f, dict) else f).convert("RGB") for f in message.get("files", [])]
     }
-    vlm_model = VlmModel(vlm_model_name)
-    image_api_call = ImageApiCall(image_model_name) 
-    image_service = ImageService(image_api_call)
-    agent = VlmAgent(vlm_model, image_service, user_input)
-    
-    finalized_blocks = [] 
-    current_thought = ""
+    # Models and image services are shared, warm instances; only the agent is per message
+    vlm_model = model_registry.get_vlm_model(vlm_model_name)
+    image_service = model_registry.get_image_service(image_model_name)
+    return VlmAgent(vlm_model, image_service, user_input)
 
-    for step in agent.run():
-        if step.stage == "Selecting Skill":
-            current_thought = step.message
-        
-        display_content = list(finalized_blocks) 
-        
-        current_status = f"**[{step.stage}]**\n{step.message}"
-        
-        if display_content and isinstance(display_content[-1], str):
-            display_content[-1] += f"\n\n{current_status}"
-        else:
-            display_content.append(current_status)
+def agent_execution(message: Dict[str, Any], history: List[Any], vlm_model_name: str, image_model_name: str):
+    agent = build_agent(message, vlm_model_name, image_model_name)
+    # Streamed tokens are batched into one UI update per flush window
+    coalescer = StepCoalescer(image_delivery)
+    cancel = CancellationToken()
 
-        if step.is_final:
-            finalized_blocks.append(f"✅ **{step.stage} Finished**\n{step.message}\n")
-            
-            if step.images:
-                for i, img in enumerate(step.images):
-                    tmp_dir = os.path.abspath("temp_images")
-                    os.makedirs(tmp_dir, exist_ok=True)
-                    img_path = os.path.join(tmp_dir, f"gen_{int(time.time()*1000)}_{i}.png")
-                    img.save(img_path)
-                    
-                    finalized_blocks.append({"path": img_path, "alt": f"Result {i}"})
-                
-                finalized_blocks.append("\n---\n")
-            
-            display_content = list(finalized_blocks)
+    try:
+        for step in agent.run(cancel):
+            update = coalescer.feed(step)
+            if update is not None:
+                yield update
+    except BaseException:
+        # Stopped or abandoned chat: stop generation, close streams and drop queued image calls
+        cancel.cancel("session abandoned")
+        raise
+    finally:
+        # Free the session's stored images as soon as the run ends or is abandoned
+        agent.close()
 
-        yield {
-            "role": "assistant",
-            "content": display_content,
-            "thought": current_thought
-        }
+    coalescer.wait()
+    yield coalescer.final()
 
-    yield {
-        "role": "assistant",
-        "content": finalized_blocks,
-        "thought": current_thought
-    }
+async def agent_execution_async(message: Dict[str, Any], history: List[Any], vlm_model_name: str, image_model_name: str):
+    """
+    Async variant of agent_execution: the run is driven on Gradio's event loop,
+    so concurrent sessions do not each hold a worker thread.
+    """
+    # Opening uploads and building (possibly local) models is blocking
+    agent = await asyncio.to_thread(build_agent, message, vlm_model_name, image_model_name)
+    coalescer = StepCoalescer(image_delivery)
+    cancel = CancellationToken()
+
+    try:
+        async for step in agent.run(cancel):
+            update = coalescer.feed(step)
+            if update is not None:
+                yield update
+    except BaseException:
+        cancel.cancel("session abandoned")
+        raise
+    finally:
+        agent.close()
+
+    # Image files are written in the background, wait for the last ones off the event loop
+    await asyncio.to_thread(coalescer.wait)
+    yield coalescer.final()
 
 # --- UI Definition ---
 
@@ -113,5 +118,7 @@ def create_ui(process_callback):
 
 if __name__ == "__main__":
     load_dotenv()
-    demo = create_ui(agent_execution)
+    # Build and health-check every selectable model in the background, including the local Qwen2-VL
+    model_registry.warm_up(MODELS["VLM"], MODELS["Text-to-Image"], preload_local=preload_local_enabled())
+    demo = create_ui(agent_execution_async)
     demo.launch()
\ No newline at end of file
@@ -6,9 +6,6 @@ SKILL_SELECTION_PROMPT = """
 TOOLS_PROMPT = """
     Here are the available tools: 
     {
-        "memory": {
-            "get_all_memory": {"function": "get_all_memory", "params": {}}
-        },
         "image_service": {
             "generate_image": {"function": "generate_image", "params": {"prompt": "Your Prompt"}}
         }
@@ -31,7 +28,6 @@ RESPONSE_PROMPT = """
     You are an math assistant.
     What you need to do is to respond to the user based on the last memory.
     You must generate a tool_list to use the tool by review input's visualization ideas.
-    Do not use get_all_memory tool when you are in solution_initializing stage.
     For Message, It's just a simple version of the last memory's message that you read.
     Here is the response format:
     {
@@ -0,0 +1,157 @@
+import os
+import time
+import asyncio
+import threading
+import logging
+from typing import Dict, Any, Optional, Tuple
+
+logger = logging.getLogger("RateLimit")
+
+# Default (requests per second, burst) per provider, override with RATE_LIMIT_<PROVIDER>="rate:burst"
+# e.g. RATE_LIMIT_DASHSCOPE_IMAGE="2:4"
+DEFAULT_LIMITS: Dict[str, Tuple[float, float]] = {
+    "dashscope-image": (2.0, 2.0),
+    "hf-fal": (1.0, 2.0),
+    "vlm": (5.0, 10.0),
+}
+
+class TokenBucketLimiter:
+    """
+    Thread-safe token bucket shared by every session calling one provider.
+    Callers reserve a token and sleep until it is due, so waiters are served in order.
+    The rate adapts: halved on a 429/throttling response, then recovered additively on success.
+    """
+    def __init__(self, name: str, rate: float, burst: float, min_rate: Optional[float] = None) -> None:
+        self.name = name
+        self.max_rate = rate
+        self.min_rate = min_rate if min_rate is not None else rate / 16
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._last = time.monotonic()
+        self._blocked_until = 0.0
+        self._backoff = 1.0
+        self._lock = threading.Lock()
+        # Metrics
+        self.waiting = 0
+        self.acquired = 0
+        self.throttled = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def _reserve(self) -> float:
+        """
+        Take one token and return how long the caller has to wait for it.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+            wait = max(wait, self._blocked_until - now)
+            self.acquired += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+            if wait > 0:
+                self.waiting += 1
+            return wait
+
+    def _release_waiter(self) -> None:
+        with self._lock:
+            self.waiting -= 1
+
+    def acquire(self) -> float:
+        """
+        Block until a request may be sent. Returns the time spent waiting.
+        """
+        wait = self._reserve()
+        if wait > 0:
+            try:
+                time.sleep(wait)
+            finally:
+                self._release_waiter()
+        return wait
+
+    async def aacquire(self) -> float:
+        wait = self._reserve()
+        if wait > 0:
+            try:
+                await asyncio.sleep(wait)
+            finally:
+                self._release_waiter()
+        return wait
+
+    def on_throttle(self) -> None:
+        """
+        Report a 429/throttling response: halve the rate and pause the bucket briefly.
+        """
+        with self._lock:
+            self.throttled += 1
+            self.rate = max(self.min_rate, self.rate / 2)
+            self._blocked_until = max(self._blocked_until, time.monotonic() + self._backoff)
+            self._backoff = min(self._backoff * 2, 30.0)
+            logger.warning(f"Provider {self.name} throttled, rate lowered to {self.rate:.2f}/s")
+
+    def on_success(self) -> None:
+        with self._lock:
+            self._backoff = 1.0
+            if self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "provider": self.name,
+                "rate": self.rate,
+                "burst": self.burst,
+                "queue_depth": self.waiting,
+                "acquired": self.acquired,
+                "throttled": self.throttled,
+                "total_wait": self.total_wait,
+                "max_wait": self.max_wait,
+                "avg_wait": self.total_wait / self.acquired if self.acquired else 0.0
+            }
+
+_limiters: Dict[str, TokenBucketLimiter] = {}
+_limiters_lock = threading.Lock()
+
+def _configured_limits(provider: str) -> Tuple[float, float]:
+    env = os.getenv("RATE_LIMIT_" + provider.upper().replace("-", "_").replace(".", "_").replace(":", "_"))
+    if env:
+        try:
+            rate, _, burst = env.partition(":")
+            return float(rate), float(burst or rate)
+        except ValueError:
+            logger.warning(f"Invalid rate limit for {provider}: {env}")
+    return DEFAULT_LIMITS.get(provider, DEFAULT_LIMITS.get(provider.split(":")[0], (5.0, 10.0)))
+
+def get_limiter(provider: str) -> TokenBucketLimiter:
+    """
+    Return the process-wide limiter for a provider, e.g. "dashscope-image", "hf-fal" or "vlm:<host>".
+    """
+    limiter = _limiters.get(provider)
+    if limiter is None:
+        with _limiters_lock:
+            limiter = _limiters.get(provider)
+            if limiter is None:
+                rate, burst = _configured_limits(provider)
+                limiter = TokenBucketLimiter(provider, rate, burst)
+                _limiters[provider] = limiter
+    return limiter
+
+def is_throttle_error(error: Any) -> bool:
+    """
+    Recognise 429/throttling responses from openai, requests, huggingface_hub and DashScope.
+    """
+    status = getattr(error, "status_code", None)
+    if status is None and getattr(error, "response", None) is not None:
+        status = getattr(error.response, "status_code", None)
+    if status == 429:
+        return True
+    text = str(getattr(error, "code", "") or "") + " " + str(error)
+    return "429" in text or "Throttling" in text or "rate limit" in text.lower()
+
+def limiter_metrics() -> Dict[str, Dict[str, Any]]:
+    with _limiters_lock:
+        return {name: limiter.metrics() for name, limiter in _limiters.items()}
@@ -0,0 +1,72 @@
+import os
+import threading
+import logging
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, TypeVar
+
+from VLM.vlm import VlmModel
+from Image.service import ImageService, ImageApiCall
+
+logger = logging.getLogger("ModelRegistry")
+
+T = TypeVar("T")
+
+class ModelRegistry:
+    """
+    Process-level registry handing out shared VlmModel and ImageService instances.
+    Each model is built once; concurrent requests for a model that is still loading wait for that build.
+    """
+    def __init__(self) -> None:
+        self._vlm_models: Dict[str, Future] = {}
+        self._image_services: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self._warmup_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="model-warmup")
+
+    def _get(self, table: Dict[str, Future], name: str, build: Callable[[str], T]) -> T:
+        with self._lock:
+            future = table.get(name)
+            owner = future is None
+            if owner:
+                future = Future()
+                table[name] = future
+        if owner:
+            try:
+                future.set_result(build(name))
+            except BaseException as e:
+                # Let the next caller retry a failed build
+                with self._lock:
+                    table.pop(name, None)
+                future.set_exception(e)
+        return future.result()
+
+    def get_vlm_model(self, model_name: str) -> VlmModel:
+        return self._get(self._vlm_models, model_name, VlmModel)
+
+    def get_image_service(self, model_name: str) -> ImageService:
+        return self._get(self._image_services, model_name, lambda name: ImageService(ImageApiCall(name)))
+
+    def _warm_vlm(self, model_name: str) -> None:
+        try:
+            model = self.get_vlm_model(model_name)
+            healthy = model.health_check()
+            logger.info(f"Warmed VLM model {model_name}: healthy={healthy}")
+        except Exception as e:
+            logger.error(f"Warm-up failed for VLM model {model_name}: {e}")
+
+    def warm_up(self, vlm_model_names: Iterable[str], image_model_names: Iterable[str], preload_local: bool = True) -> None:
+        """
+        Build and health-check models in the background so the first chat message does not pay for it.
+        Local models are loaded only when preload_local is set.
+        """
+        for name in image_model_names:
+            self._warmup_executor.submit(self.get_image_service, name)
+        for name in vlm_model_names:
+            if VlmModel.is_local(name) and not preload_local:
+                continue
+            self._warmup_executor.submit(self._warm_vlm, name)
+
+# Shared by every Gradio session in the process
+model_registry = ModelRegistry()
+
+def preload_local_enabled() -> bool:
+    return os.getenv("PRELOAD_LOCAL_MODELS", "1").lower() not in ("0", "false", "no")
@@ -0,0 +1,77 @@
+import unittest
+from PIL import Image, ImageDraw
+from VLM.memory import MemoryService
+
+def figure(size=(256, 256)) -> Image.Image:
+    image = Image.new("RGB", size, "white")
+    draw = ImageDraw.Draw(image)
+    w, h = size
+    draw.polygon([(w * 0.1, h * 0.9), (w * 0.9, h * 0.9), (w * 0.5, h * 0.1)], outline="black", width=4)
+    draw.ellipse([w * 0.35, h * 0.45, w * 0.65, h * 0.75], fill="gray")
+    return image
+
+def other_figure() -> Image.Image:
+    image = Image.new("RGB", (256, 256), "white")
+    draw = ImageDraw.Draw(image)
+    for x in range(0, 256, 32):
+        draw.rectangle([x, 0, x + 15, 255], fill="black")
+    return image
+
+class MemoryDedupTest(unittest.TestCase):
+    def service(self, policy="latest", distance=4):
+        memory = MemoryService({"text": "question", "files": []}, dedup_distance=distance, dedup_policy=policy)
+        self.addCleanup(memory.close)
+        return memory
+
+    def generate(self, memory, *images):
+        memory.append_message("round")
+        for i, image in enumerate(images):
+            memory.append_image(image, f"Figure {i}: prompt")
+
+    def visible_images(self, memory):
+        return [h for m in memory.visible_entries() for h in m.Images]
+
+    def test_latest_supersedes_the_older_copy(self):
+        memory = self.service("latest")
+        self.generate(memory, figure(), other_figure())
+        self.generate(memory, figure(size=(200, 200)))
+        self.assertEqual(memory.duplicates, 1)
+        visible = self.visible_images(memory)
+        self.assertEqual(len(visible), 2)
+        self.assertIs(visible[-1], memory.memory[-1].Images[0])
+        # Stored entries keep every copy, only the requests leave the old one out
+        self.assertEqual(sum(len(m.Images) for m in memory.memory), 3)
+
+    def test_first_collapses_into_the_older_copy(self):
+        memory = self.service("first")
+        self.generate(memory, figure())
+        self.generate(memory, figure(size=(200, 200)))
+        self.assertEqual(memory.duplicates, 1)
+        self.assertEqual(memory.memory[-1].Images, [])
+        self.assertEqual(len(self.visible_images(memory)), 1)
+        # The round still reports the image it asked for
+        self.assertEqual(len(memory.get_latest_memory()["Images"]), 1)
+
+    def test_labels_stay_aligned(self):
+        memory = self.service("latest")
+        self.generate(memory, figure(), other_figure())
+        self.generate(memory, other_figure())
+        entry = memory.visible_entries()[1]
+        self.assertEqual(len(entry.Images), len(entry.ImageLabels))
+        self.assertEqual(entry.ImageLabels, ["Figure 0: prompt"])
+
+    def test_disabled(self):
+        for memory in (self.service(distance=-1), self.service(policy="off")):
+            self.generate(memory, figure())
+            self.generate(memory, figure())
+            self.assertEqual(memory.duplicates, 0)
+            self.assertEqual(len(self.visible_images(memory)), 2)
+
+    def test_distinct_images_are_kept(self):
+        memory = self.service("latest")
+        self.generate(memory, figure(), other_figure())
+        self.assertEqual(memory.duplicates, 0)
+        self.assertEqual(len(self.visible_images(memory)), 2)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,55 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+from VLM.context import ContextBudget
+from VLM.memory import Memory
+from VLM.prompt_builder import PromptBuilder, SELECTION_INSTRUCTION
+from VLM.skill_registry import SkillRegistry
+
+def entries(rounds: int):
+    return [Memory("", "Initializing", "problem", [], [])] + [
+        Memory("reasoning", "Thinking", f"round {i} " + "word " * 60, [], []) for i in range(1, rounds + 1)
+    ]
+
+class PromptBuilderTest(unittest.TestCase):
+    def test_history_is_append_only(self):
+        builder = PromptBuilder()
+        first = builder.selection_messages(entries(2))
+        second = builder.selection_messages(entries(3))
+        self.assertEqual(first[0], second[0])
+        self.assertEqual(first[:-1], second[:len(first) - 1])
+        self.assertEqual(second[-1]["content"], SELECTION_INSTRUCTION)
+
+    def test_old_rounds_are_compacted_into_a_summary(self):
+        builder = PromptBuilder(ContextBudget(max_tokens=250, recent_rounds=2, excerpt_chars=40))
+        messages = builder.selection_messages(entries(5))
+        contents = [m["content"] for m in messages[1:] if m["role"] == "assistant"]
+        self.assertTrue(contents[0].startswith("Summary of rounds 1-3:\nNo.1: round 1 word"))
+        self.assertTrue(contents[0].splitlines()[1].endswith(" ..."))
+        self.assertEqual([c.split(":")[0] for c in contents[1:]], ["No.4", "No.5"])
+        # The summary stays fixed while later rounds still fit
+        later = builder.selection_messages(entries(6))
+        self.assertEqual(later[:len(messages) - 1], messages[:-1])
+
+    def test_system_prompt_follows_skill_edits(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "draw", "skill.md")
+            os.makedirs(os.path.dirname(path))
+
+            def write(body):
+                with open(path, "w", encoding="utf-8") as f:
+                    f.write(f"---\ndescription: Draw figures\n---\n{body}\n")
+
+            write("Draw the figure.")
+            registry = SkillRegistry(directory, check_interval=0)
+            with mock.patch("VLM.prompt_builder.skill_registry", registry):
+                builder = PromptBuilder()
+                self.assertIn("Draw the figure.", builder.system_prompt())
+                # Same description, new instructions
+                write("Draw the figure with labelled vertices.")
+                registry.reload()
+                self.assertIn("Draw the figure with labelled vertices.", builder.system_prompt())
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,105 @@
+import os
+import tempfile
+import unittest
+from PIL import Image, ImageDraw
+from VLM.phash import dhash, hamming
+from VLM.run_cache import RunCache
+
+def figure(size=(256, 256), offset=0) -> Image.Image:
+    image = Image.new("RGB", size, "white")
+    draw = ImageDraw.Draw(image)
+    w, h = size
+    draw.polygon([(w * 0.1 + offset, h * 0.9), (w * 0.9, h * 0.9), (w * 0.5, h * 0.1)], outline="black", width=4)
+    draw.ellipse([w * 0.3, h * 0.4, w * 0.7, h * 0.8], fill="gray")
+    return image
+
+def steps(text="answer"):
+    return [
+        {"stage": "Drawing", "message": "drawn", "is_final": True, "images": [figure()]},
+        {"stage": "Answer", "message": text, "is_final": True, "images": [figure()]},
+    ]
+
+class RunCacheKeyTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = RunCache(None, ttl=0, max_entries=4, max_bytes=0)
+
+    def test_whitespace_is_normalized_case_is_not(self):
+        key = self.cache.key("vlm", "img", "Find  side a\n", [])
+        self.assertEqual(key, self.cache.key("vlm", "img", "Find side a", []))
+        self.assertNotEqual(key, self.cache.key("vlm", "img", "Find side A", []))
+
+    def test_models_version_and_images_are_part_of_the_key(self):
+        key = self.cache.key("vlm", "img", "q", [figure()], version="1")
+        self.assertEqual(key, self.cache.key("vlm", "img", "q", [figure()], version="1"))
+        self.assertNotEqual(key, self.cache.key("vlm", "img", "q", [figure()], version="2"))
+        self.assertNotEqual(key, self.cache.key("other", "img", "q", [figure()], version="1"))
+        self.assertNotEqual(key, self.cache.key("vlm", "img", "q", [figure(offset=20)], version="1"))
+
+    def test_perceptual_match_survives_rescaling(self):
+        self.assertLessEqual(hamming(dhash(figure()), dhash(figure((180, 180)))), 4)
+        exact = RunCache(None, ttl=0, max_entries=4, max_bytes=0)
+        perceptual = RunCache(None, ttl=0, max_entries=4, max_bytes=0, image_match="perceptual")
+        self.assertNotEqual(exact.key("v", "i", "q", [figure()]), exact.key("v", "i", "q", [figure((180, 180))]))
+        self.assertEqual(perceptual.key("v", "i", "q", [figure()]), perceptual.key("v", "i", "q", [figure((180, 180))]))
+
+class RunCacheStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def flush(self, cache):
+        # The single writer thread runs jobs in order
+        cache._writer.submit(lambda: None).result(5)
+
+    def test_memory_lru(self):
+        cache = RunCache(None, ttl=0, max_entries=2, max_bytes=0)
+        cache.put("a", steps("a"))
+        cache.put("b", steps("b"))
+        self.assertIsNotNone(cache.get("a"))
+        cache.put("c", steps("c"))
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a")[1]["message"], "a")
+        self.assertEqual(cache.stats(), {"entries": 2, "hits": 2, "misses": 1, "stores": 3})
+
+    def test_disk_round_trip(self):
+        writer = RunCache(self.tmp.name, ttl=3600, max_entries=4, max_bytes=10 * 1024 * 1024)
+        writer.put("ab12", steps())
+        self.flush(writer)
+        reader = RunCache(self.tmp.name, ttl=3600, max_entries=4, max_bytes=10 * 1024 * 1024)
+        cached = reader.get("ab12")
+        self.assertEqual([s["message"] for s in cached], ["drawn", "answer"])
+        self.assertEqual(cached[1]["images"][0].tobytes(), figure().tobytes())
+        # Both steps share one stored image
+        self.assertEqual(len(os.listdir(os.path.join(self.tmp.name, "ab"))), 1)
+
+    def test_expired_entries_are_dropped(self):
+        cache = RunCache(self.tmp.name, ttl=3600, max_entries=4, max_bytes=10 * 1024 * 1024)
+        cache.put("ab12", steps())
+        self.flush(cache)
+        cache.ttl = 1e-9
+        self.assertIsNone(cache.get("ab12"))
+        self.assertFalse(os.path.exists(cache._path("ab12")))
+
+    def test_corrupt_entry_is_a_miss(self):
+        cache = RunCache(self.tmp.name, ttl=0, max_entries=4, max_bytes=10 * 1024 * 1024)
+        os.makedirs(os.path.dirname(cache._path("ab12")))
+        with open(cache._path("ab12"), "w") as f:
+            f.write("{not json")
+        with self.assertLogs("RunCache", "WARNING"):
+            self.assertIsNone(cache.get("ab12"))
+        self.assertFalse(os.path.exists(cache._path("ab12")))
+
+    def test_directory_budget_evicts_oldest(self):
+        cache = RunCache(self.tmp.name, ttl=0, max_entries=1, max_bytes=10 * 1024 * 1024)
+        cache.put("aa00", steps())
+        self.flush(cache)
+        size = os.path.getsize(cache._path("aa00"))
+        os.utime(cache._path("aa00"), (1, 1))
+        cache.max_bytes = int(size * 1.5)
+        cache.put("bb00", steps())
+        self.flush(cache)
+        self.assertFalse(os.path.exists(cache._path("aa00")))
+        self.assertTrue(os.path.exists(cache._path("bb00")))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,85 @@
+import threading
+import unittest
+from collections import deque
+from VLM.scheduler import BatchScheduler, GenerationRequest, QueueFullError
+
+class FakeStreamer:
+    def __init__(self) -> None:
+        self.ended = False
+
+    def end(self) -> None:
+        self.ended = True
+
+def request(tokens: int, max_new_tokens: int = 512) -> GenerationRequest:
+    return GenerationRequest(inputs=None, digests=[], streamer=FakeStreamer(), tokens=tokens, max_new_tokens=max_new_tokens)
+
+class TakeBatchTest(unittest.TestCase):
+    def take(self, requests, **kwargs):
+        scheduler = BatchScheduler(lambda batch: None, **kwargs)
+        scheduler._queue = deque(requests)
+        return scheduler._take_batch(), list(scheduler._queue)
+
+    def test_batch_size_limit(self):
+        requests = [request(10) for _ in range(5)]
+        batch, rest = self.take(requests, max_batch_size=3, max_batch_tokens=10_000)
+        self.assertEqual(batch, requests[:3])
+        self.assertEqual(rest, requests[3:])
+
+    def test_incompatible_requests_keep_their_order(self):
+        a, b, c, d = request(10), request(10, max_new_tokens=64), request(10), request(10, max_new_tokens=64)
+        batch, rest = self.take([a, b, c, d], max_batch_size=4, max_batch_tokens=10_000)
+        self.assertEqual(batch, [a, c])
+        self.assertEqual(rest, [b, d])
+
+    def test_padded_token_limit(self):
+        # 100 x 2 fits, 600 x 2 does not, 100 x 3 fits again
+        a, b, c = request(100), request(600), request(100)
+        batch, rest = self.take([a, b, c], max_batch_size=4, max_batch_tokens=1000)
+        self.assertEqual(batch, [a, c])
+        self.assertEqual(rest, [b])
+
+    def test_oversized_first_request_still_runs(self):
+        a, b = request(5000), request(10)
+        batch, rest = self.take([a, b], max_batch_size=4, max_batch_tokens=1000)
+        self.assertEqual(batch, [a])
+        self.assertEqual(rest, [b])
+
+class SubmitTest(unittest.TestCase):
+    def test_requests_are_batched(self):
+        ran = []
+        done = threading.Event()
+
+        def run_batch(batch):
+            ran.append(batch)
+            for r in batch:
+                r.streamer.end()
+            if sum(len(b) for b in ran) == 3:
+                done.set()
+
+        scheduler = BatchScheduler(run_batch, max_batch_size=4, max_batch_tokens=10_000, batch_wait=0.5)
+        requests = [scheduler.submit(request(10)) for _ in range(3)]
+        self.assertTrue(done.wait(5))
+        self.assertEqual(ran, [requests])
+        self.assertEqual(scheduler.stats()["max_batch"], 3)
+
+    def test_full_queue_rejects(self):
+        blocked = threading.Event()
+        release = threading.Event()
+
+        def run_batch(batch):
+            blocked.set()
+            release.wait(5)
+
+        scheduler = BatchScheduler(run_batch, max_batch_size=1, max_queue=1, batch_wait=0, admission_timeout=0.05)
+        try:
+            scheduler.submit(request(10))
+            self.assertTrue(blocked.wait(5))
+            scheduler.submit(request(10))
+            with self.assertRaises(QueueFullError):
+                scheduler.submit(request(10))
+            self.assertEqual(scheduler.stats()["rejected"], 1)
+        finally:
+            release.set()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,68 @@
+import threading
+import unittest
+from VLM.speculative import LineScanner, SpeculativeImages, parse_directive
+
+class ParseDirectiveTest(unittest.TestCase):
+    def test_visual_directive(self):
+        self.assertEqual(
+            parse_directive("- **Figure 1**: a right triangle ABC with the altitude from C"),
+            ("Figure 1", "a right triangle ABC with the altitude from C")
+        )
+
+    def test_plain_bullets_are_ignored(self):
+        self.assertIsNone(parse_directive("- Step 1: compute the area of the triangle"))
+        self.assertIsNone(parse_directive("- [x] Figure: checkbox items are not directives"))
+        self.assertIsNone(parse_directive("Figure 1: not a bullet at all, just text"))
+
+class LineScannerTest(unittest.TestCase):
+    def test_lines_across_chunks(self):
+        scanner = LineScanner()
+        self.assertEqual(scanner.feed("first li"), [])
+        self.assertEqual(scanner.feed("ne\nsecond\nthi"), ["first line", "second"])
+        self.assertEqual(scanner.flush(), ["thi"])
+        self.assertEqual(scanner.flush(), [])
+
+class SpeculativeImagesTest(unittest.TestCase):
+    LINE = "- Diagram A: a circle inscribed in a square with side 4"
+
+    def setUp(self):
+        self.prompts = []
+        self.gate = threading.Event()
+
+        def generate(prompt):
+            self.prompts.append(prompt)
+            self.gate.wait(5)
+            return {"images": [prompt]}
+
+        self.speculative = SpeculativeImages(generate, max_per_output=2)
+
+    def tearDown(self):
+        self.gate.set()
+
+    def test_claimed_by_the_same_prompt_once(self):
+        future = self.speculative.scan(self.LINE)
+        self.assertIsNotNone(future)
+        self.assertIsNone(self.speculative.scan(self.LINE))
+        # Formatting and case do not matter, the prompt does
+        self.assertIs(self.speculative.take("**Diagram A**: A circle inscribed in a square with side 4."), future)
+        self.assertIsNone(self.speculative.take("Diagram A: a circle inscribed in a square with side 4"))
+        self.gate.set()
+        self.assertEqual(future.result(5), {"images": ["Diagram A: a circle inscribed in a square with side 4"]})
+        self.assertEqual(self.speculative.stats()["hits"], 1)
+        self.assertEqual(self.speculative.stats()["misses"], 1)
+
+    def test_same_figure_name_is_not_a_match(self):
+        self.speculative.scan("- Triangle ABC diagram: draw triangle ABC with a right angle at C")
+        self.assertIsNone(self.speculative.take("Triangle ABC diagram: draw an obtuse triangle ABC with the angle at C over 90 degrees"))
+        self.assertEqual(self.speculative.stats()["pending"], 1)
+
+    def test_limit_per_output_and_reset(self):
+        lines = [f"- Figure {i}: a plot of y = x^{i} on [0, 1]" for i in range(3)]
+        started = [self.speculative.scan(line) for line in lines]
+        self.assertIsNone(started[2])
+        self.speculative.reset()
+        self.assertIsNone(self.speculative.take("Figure 0: a plot of y = x^0 on [0, 1]"))
+        self.assertIsNotNone(self.speculative.scan(lines[2]))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,100 @@
+import json
+import unittest
+from VLM.stream_parser import IncrementalJSONParser, SectionSplitter
+
+def feed_all(parser, chunks):
+    events = []
+    for chunk in chunks:
+        events.extend(parser.feed(chunk))
+    return events
+
+class IncrementalJSONParserTest(unittest.TestCase):
+    RESPONSE = '{"Skill": "draw", "Stage": "Drawing", "tool_list": [{"name": "a", "args": {"p": 1}}, {"name": "b"}], "done": true}'
+
+    def test_whole_response(self):
+        parser = IncrementalJSONParser()
+        events = parser.feed(self.RESPONSE)
+        self.assertEqual(events, [
+            ("field", "Skill", "draw"),
+            ("field", "Stage", "Drawing"),
+            ("item", 0, {"name": "a", "args": {"p": 1}}),
+            ("item", 1, {"name": "b"}),
+            ("field", "tool_list", [{"name": "a", "args": {"p": 1}}, {"name": "b"}]),
+            ("field", "done", True),
+        ])
+        self.assertEqual(parser.fields["Stage"], "Drawing")
+        self.assertEqual(len(parser.items), 2)
+
+    def test_chunk_boundaries_do_not_matter(self):
+        expected = IncrementalJSONParser().feed(self.RESPONSE)
+        for size in (1, 2, 3, 7):
+            parser = IncrementalJSONParser()
+            chunks = [self.RESPONSE[i:i + size] for i in range(0, len(self.RESPONSE), size)]
+            self.assertEqual(feed_all(parser, chunks), expected, f"chunk size {size}")
+
+    def test_items_reported_before_list_closes(self):
+        parser = IncrementalJSONParser()
+        events = parser.feed('{"tool_list": [{"name": "a"}, {"name": ')
+        self.assertEqual(events, [("item", 0, {"name": "a"})])
+
+    def test_strings_with_structural_characters(self):
+        parser = IncrementalJSONParser()
+        events = parser.feed('{"Stage": "a, {b} [c] \\"d\\"", "n": 2}')
+        self.assertEqual(events, [("field", "Stage", 'a, {b} [c] "d"'), ("field", "n", 2)])
+
+    def test_reasoning_and_fence_skipped(self):
+        parser = IncrementalJSONParser()
+        events = feed_all(parser, ["Let me think {about it", "\n``", '`json\n{"Stage": "x"}\n```'])
+        self.assertEqual(events, [("field", "Stage", "x")])
+
+    def test_fence_inside_a_string(self):
+        response = json.dumps({
+            "Message": "Use this:\n```json\n{\"a\": 1}\n```",
+            "tool_list": [{"name": "a", "params": {"p": 1}}],
+            "SkillSelection": "draw"
+        })
+        expected = [
+            ("field", "Message", "Use this:\n```json\n{\"a\": 1}\n```"),
+            ("item", 0, {"name": "a", "params": {"p": 1}}),
+            ("field", "tool_list", [{"name": "a", "params": {"p": 1}}]),
+            ("field", "SkillSelection", "draw"),
+        ]
+        for size in (1, 4, len(response)):
+            parser = IncrementalJSONParser()
+            chunks = [response[i:i + size] for i in range(0, len(response), size)]
+            self.assertEqual(feed_all(parser, chunks), expected, f"chunk size {size}")
+
+class SectionSplitterTest(unittest.TestCase):
+    def split(self, chunks, delimiter="===SPLIT==="):
+        splitter = SectionSplitter(delimiter)
+        before, after = "", ""
+        for chunk in chunks:
+            b, a = splitter.feed(chunk)
+            before += b
+            after += a
+        return before + splitter.flush(), after, splitter
+
+    def test_no_delimiter(self):
+        before, after, splitter = self.split(["hello ", "world ==="])
+        self.assertEqual((before, after), ("hello world ===", ""))
+        self.assertFalse(splitter.split)
+
+    def test_delimiter_split_across_chunks(self):
+        text = "thinking\n===SPLIT===\nanswer text"
+        for size in (1, 2, 5, len(text)):
+            chunks = [text[i:i + size] for i in range(0, len(text), size)]
+            before, after, splitter = self.split(chunks)
+            self.assertEqual((before, after), ("thinking\n", "answer text"), f"chunk size {size}")
+            self.assertTrue(splitter.split)
+
+    def test_held_back_tail_is_not_emitted_early(self):
+        splitter = SectionSplitter("===SPLIT===")
+        self.assertEqual(splitter.feed("abc==="), ("abc", ""))
+        self.assertEqual(splitter.flush(), "===")
+
+    def test_only_first_delimiter_splits(self):
+        before, after, _ = self.split(["a===SPLIT===b===SPLIT===c"])
+        self.assertEqual((before, after), ("a", "b===SPLIT===c"))
+
+if __name__ == "__main__":
+    unittest.main()
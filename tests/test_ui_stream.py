@@ -0,0 +1,82 @@
+import unittest
+from concurrent.futures import Future
+from ui_stream import StepCoalescer, TextBuffer
+from VLM.vlm import VlmStep
+
+class FakeDelivery:
+    def __init__(self) -> None:
+        self.futures = []
+
+    def deliver(self, image) -> Future:
+        future = Future()
+        self.futures.append((future, image))
+        return future
+
+class TextBufferTest(unittest.TestCase):
+    def test_append_and_reset(self):
+        buffer = TextBuffer("a")
+        buffer.append("b")
+        buffer.append("")
+        buffer.append("c")
+        self.assertEqual(buffer.pending, 2)
+        self.assertEqual(buffer.text, "abc")
+        self.assertEqual(buffer.pending, 0)
+        buffer.reset("x")
+        self.assertEqual(buffer.text, "x")
+
+class StepCoalescerTest(unittest.TestCase):
+    def test_deltas_wait_for_the_flush_window(self):
+        coalescer = StepCoalescer(interval=3600, max_chars=10)
+        # Finished stages always flush, and start the window
+        self.assertIsNotNone(coalescer.feed(VlmStep("Selecting Skill", "draw", [], is_final=True)))
+        self.assertIsNone(coalescer.feed(VlmStep("Drawing", "", [], delta="hi")))
+        self.assertIsNone(coalescer.feed(VlmStep("Drawing", "", [], delta=" there")))
+        message = coalescer.feed(VlmStep("Drawing", "", [], delta=" everyone"))
+        self.assertEqual(message["content"][-1], "✅ **Selecting Skill Finished**\ndraw\n\n\n**[Drawing]**\nhi there everyone")
+
+    def test_final_step_replaces_the_live_block(self):
+        coalescer = StepCoalescer(interval=0)
+        coalescer.feed(VlmStep("Selecting Skill", "", [], delta="thinking"))
+        message = coalescer.feed(VlmStep("Selecting Skill", "picked draw", [], is_final=True))
+        self.assertEqual(message["content"], ["✅ **Selecting Skill Finished**\npicked draw\n"])
+        self.assertEqual(message["thought"], "picked draw")
+        message = coalescer.feed(VlmStep("Drawing", "", [], delta="x"))
+        self.assertEqual(message["content"], ["✅ **Selecting Skill Finished**\npicked draw\n\n\n**[Drawing]**\nx"])
+
+    def test_selection_is_shown_as_soon_as_it_is_parsed(self):
+        coalescer = StepCoalescer(interval=0)
+        message = coalescer.feed(VlmStep("Selecting Skill", "", [], delta='{"SkillSelection": "draw"', selection={"SkillSelection": "draw"}))
+        self.assertEqual(message["content"], ['**[Selecting Skill: draw]**\n{"SkillSelection": "draw"'])
+        message = coalescer.feed(VlmStep("Selecting Skill", "", [], delta=', "Stage": "Drawing"', selection={"SkillSelection": "draw", "Stage": "Drawing"}))
+        self.assertTrue(message["content"][0].startswith("**[Selecting Skill: draw → Drawing]**\n"))
+        message = coalescer.feed(VlmStep("Drawing", "", [], delta="x"))
+        self.assertEqual(message["content"], ["**[Drawing]**\nx"])
+
+    def test_images_are_added_in_order_once_written(self):
+        delivery = FakeDelivery()
+        coalescer = StepCoalescer(delivery, interval=0)
+        coalescer.feed(VlmStep("Drawing", "done", ["img0", "img1"], is_final=True))
+        coalescer.feed(VlmStep("Checking", "ok", [], is_final=True))
+        (first, _), (second, _) = delivery.futures
+        second.set_result("/tmp/1.png")
+        self.assertEqual(coalescer.final()["content"], ["✅ **Drawing Finished**\ndone\n"])
+        first.set_result("/tmp/0.png")
+        self.assertEqual(coalescer.final()["content"], [
+            "✅ **Drawing Finished**\ndone\n",
+            {"path": "/tmp/0.png", "alt": "Result 0"},
+            {"path": "/tmp/1.png", "alt": "Result 1"},
+            "\n---\n",
+            "✅ **Checking Finished**\nok\n",
+        ])
+
+    def test_failed_delivery_is_skipped(self):
+        delivery = FakeDelivery()
+        coalescer = StepCoalescer(delivery, interval=0)
+        coalescer.feed(VlmStep("Drawing", "done", ["img0"], is_final=True))
+        delivery.futures[0][0].set_exception(OSError("disk full"))
+        with self.assertLogs("UIStream", "ERROR"):
+            content = coalescer.final()["content"]
+        self.assertEqual(content, ["✅ **Drawing Finished**\ndone\n", "\n---\n"])
+
+if __name__ == "__main__":
+    unittest.main()
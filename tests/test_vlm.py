@@ -0,0 +1,102 @@
+import json
+import unittest
+from unittest import mock
+from PIL import Image
+from Image.service import ImageApiCall, ImageService
+from VLM.run_cache import RunCache
+from VLM.vlm import VlmAgent
+from VLM.prompt_builder import FUSED_DELIMITER, SELECTION_INSTRUCTION
+
+class FakeModel:
+    model_name = "fake-vlm"
+    context_budget = None
+
+    def __init__(self, header, output="skill output\n", fused=True) -> None:
+        self.header = header
+        self.output = output
+        self.fused = fused
+        self.requests = 0
+
+    def generate_chat_stream(self, messages, cancel=None):
+        self.requests += 1
+        if self.fused:
+            text = json.dumps(self.header) + "\n" + FUSED_DELIMITER + "\n" + self.output
+        elif messages[-1]["content"].endswith(SELECTION_INSTRUCTION):
+            text = json.dumps(self.header)
+        else:
+            text = self.output
+        for i in range(0, len(text), 5):
+            yield text[i:i + 5]
+
+class FakeImages:
+    def generate_image(self, prompt):
+        return {"images": [Image.new("RGB", (8, 8))], "prompt": prompt}
+
+def agent(header, text="question", **kwargs):
+    return VlmAgent(FakeModel(header, **kwargs), FakeImages(), {"text": text, "files": []})
+
+@mock.patch("VLM.vlm.run_cache", None)
+class FusedRoundTest(unittest.TestCase):
+    def test_header_without_stage(self):
+        vlm = agent({"SkillSelection": "reasoning", "Message": "m", "tool_list": []})
+        run = vlm.run()
+        run.max_rounds = 2
+        steps = [step for step in run if not step.delta]
+        self.assertEqual([step.stage for step in steps], ["Selecting Skill", "Thinking", "Selecting Skill", "Thinking", "Response"])
+        self.assertEqual(steps[1].message, "skill output\n")
+        vlm.close()
+
+    def test_response_ends_the_run(self):
+        vlm = agent({"SkillSelection": "response", "Stage": "Response", "Message": "m", "tool_list": []})
+        steps = [step for step in vlm.run() if step.is_final]
+        self.assertEqual([step.stage for step in steps], ["Selecting Skill", "Response", "Response"])
+        self.assertEqual(vlm.vlm_model.requests, 1)
+        vlm.close()
+
+    def test_selection_reaches_the_steps_while_streaming(self):
+        vlm = agent({"SkillSelection": "response", "Stage": "Response", "Message": "m", "tool_list": []})
+        selections = [step.selection for step in vlm.run() if step.delta and step.stage == "Selecting Skill"]
+        self.assertEqual(selections[0], {})
+        self.assertIn({"SkillSelection": "response"}, selections)
+        self.assertEqual(selections[-1], {"SkillSelection": "response", "Stage": "Response"})
+        vlm.close()
+
+    def test_unclaimed_speculative_images_dropped_at_run_end(self):
+        vlm = agent({"SkillSelection": "draw", "Stage": "Drawing", "tool_list": []}, output="- Figure 1: a square with its diagonals drawn\n")
+        run = vlm.run()
+        run.max_rounds = 1
+        list(run)
+        self.assertEqual(vlm.speculative.stats()["started"], 1)
+        self.assertEqual(vlm.speculative.stats()["pending"], 0)
+        vlm.close()
+
+@mock.patch("VLM.vlm.run_cache", None)
+class TwoCallRoundTest(unittest.TestCase):
+    def test_selection_then_execution(self):
+        header = {"SkillSelection": "response", "Stage": "Response", "tool_list": [
+            {"category": "image_service", "name": "generate_image", "params": {"prompt": "Figure 1: a unit square"}}
+        ]}
+        vlm = agent(header, fused=False)
+        steps = [step for step in vlm.run() if step.is_final]
+        self.assertEqual([step.stage for step in steps], ["Selecting Skill", "Response", "Response"])
+        self.assertEqual(steps[1].message, "skill output\n")
+        self.assertEqual(len(steps[1].images), 1)
+        self.assertEqual(vlm.vlm_model.requests, 2)
+        vlm.close()
+
+class RunCacheKeyTest(unittest.TestCase):
+    def key(self, image_service, text="question"):
+        vlm = VlmAgent(FakeModel({}), image_service, {"text": text, "files": []})
+        self.addCleanup(vlm.close)
+        with mock.patch("VLM.vlm.run_cache", RunCache(None, ttl=0, max_entries=1, max_bytes=0)):
+            return vlm.run()._cache_key()
+
+    def test_image_model_is_part_of_the_key(self):
+        qwen = self.key(ImageService(ImageApiCall("qwen-image-max")))
+        self.assertEqual(qwen, self.key(ImageService(ImageApiCall("qwen-image-max"))))
+        self.assertNotEqual(qwen, self.key(ImageService(ImageApiCall("hf-fal"))))
+        self.assertNotEqual(qwen, self.key(ImageService(ImageApiCall("stable-diffusion-3.5-large-turbo"))))
+        self.assertNotEqual(qwen, self.key(ImageService(ImageApiCall("qwen-image-max")), text="other question"))
+
+if __name__ == "__main__":
+    unittest.main()
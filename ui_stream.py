@@ -0,0 +1,142 @@
+import os
+import time
+import logging
+from concurrent.futures import wait
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger("UIStream")
+
+# Default coalescing window, overridable from the environment
+UI_FLUSH_INTERVAL = float(os.getenv("UI_FLUSH_INTERVAL", "0.05"))
+UI_FLUSH_CHARS = int(os.getenv("UI_FLUSH_CHARS", "2048"))
+
+class TextBuffer:
+    """
+    Append-only text accumulator. Chunks are only joined when the text is read,
+    and each read only joins what arrived since the previous one.
+    """
+    def __init__(self, text: str = "") -> None:
+        self._text = text
+        self._chunks: List[str] = []
+        self.pending = 0
+
+    def append(self, chunk: str) -> None:
+        if chunk:
+            self._chunks.append(chunk)
+            self.pending += len(chunk)
+
+    def reset(self, text: str = "") -> None:
+        self._text = text
+        self._chunks = []
+        self.pending = 0
+
+    @property
+    def text(self) -> str:
+        if self._chunks:
+            self._text += "".join(self._chunks)
+            self._chunks = []
+        self.pending = 0
+        return self._text
+
+class StepCoalescer:
+    """
+    Sits between VlmRun and Gradio: collects streamed VlmStep deltas and only produces
+    a chatbot message when the flush window (time or size) has passed or a stage finishes.
+    Finished stages become immutable blocks that are shared between messages, so only the
+    live block changes from one message to the next.
+    Images of finished stages are handed to delivery (anything with deliver(image) -> Future[path])
+    and their blocks are added, in order, once the files are written.
+    """
+    def __init__(self, delivery: Any = None, interval: float = UI_FLUSH_INTERVAL, max_chars: int = UI_FLUSH_CHARS) -> None:
+        self.delivery = delivery
+        self.interval = interval
+        self.max_chars = max_chars
+        self.finalized_blocks: List[Any] = []
+        # Finished blocks waiting behind an image that is still being written
+        self._queue: List[Any] = []
+        self.thought = ""
+        self._stage: Optional[str] = None
+        # Skill and stage parsed so far while the skill is being selected
+        self._selection: Dict[str, str] = {}
+        self._buffer = TextBuffer()
+        self._last_flush = 0.0
+        self.flushes = 0
+
+    def _settle(self) -> None:
+        while self._queue:
+            block = self._queue[0]
+            if isinstance(block, tuple):
+                future, alt = block
+                if not future.done():
+                    return
+                try:
+                    self.finalized_blocks.append({"path": future.result(), "alt": alt})
+                except Exception as e:
+                    logger.error(f"Image delivery failed: {e}")
+            else:
+                self.finalized_blocks.append(block)
+            self._queue.pop(0)
+
+    def _render(self) -> Dict[str, Any]:
+        self._settle()
+        text = self._buffer.text
+        if self._stage == "Selecting Skill":
+            self.thought = text
+        self._last_flush = time.monotonic()
+        self.flushes += 1
+        content = list(self.finalized_blocks)
+        if self._stage is not None:
+            label = self._stage
+            chosen = [self._selection[k] for k in ("SkillSelection", "Stage") if self._selection.get(k)]
+            if chosen:
+                label += ": " + " → ".join(chosen)
+            current_status = f"**[{label}]**\n{text}"
+            if content and isinstance(content[-1], str):
+                content[-1] = content[-1] + f"\n\n{current_status}"
+            else:
+                content.append(current_status)
+        return {"role": "assistant", "content": content, "thought": self.thought}
+
+    def feed(self, step: Any) -> Optional[Dict[str, Any]]:
+        """
+        Take one VlmStep, returns the message to send or None while the window is still open.
+        """
+        if step.stage != self._stage:
+            self._stage = step.stage
+            self._selection = {}
+            self._buffer.reset()
+
+        if not step.is_final:
+            if step.selection:
+                self._selection = step.selection
+            if step.delta:
+                self._buffer.append(step.delta)
+            else:
+                # Steps without a delta carry their full text
+                self._buffer.reset(step.message)
+            if time.monotonic() - self._last_flush < self.interval and self._buffer.pending < self.max_chars:
+                return None
+            return self._render()
+
+        if step.stage == "Selecting Skill":
+            self.thought = step.message
+        self._queue.append(f"✅ **{step.stage} Finished**\n{step.message}\n")
+        if step.images and self.delivery is not None:
+            for i, img in enumerate(step.images):
+                self._queue.append((self.delivery.deliver(img), f"Result {i}"))
+            self._queue.append("\n---\n")
+        # The live block starts over with the next stage, the finished one is rendered in its place
+        self._stage = None
+        self._selection = {}
+        self._buffer.reset()
+        return self._render()
+
+    def wait(self, timeout: Optional[float] = None) -> None:
+        """
+        Block until every queued image has been written.
+        """
+        wait([block[0] for block in self._queue if isinstance(block, tuple)], timeout=timeout)
+
+    def final(self) -> Dict[str, Any]:
+        self._settle()
+        return {"role": "assistant", "content": list(self.finalized_blocks), "thought": self.thought}